@@ -0,0 +1,347 @@
+"""
+Admission control: reject what can't be served in time right away, instead of letting every request in and having
+all of them time out together.
+
+Without it an overloaded app accepts every request: uploads pile up until memory or disk runs out, the /items/
+endpoints queue inside the connection pool until pool_timeout and then fail with a 500 after 30 seconds, and the
+requests that do get through are slow because everything else is still in the way. With it, endpoints belong to
+admission groups, each with a fixed number of slots:
+
+    @app.post("/upload_file")
+    @admitted("uploads")                     # one slot of the "uploads" group per request
+    async def create_upload_file(...): ...
+
+    setup_admission(app, "upload", limits={"uploads": Limit(concurrency=8, max_queue=32, charge_body=True)})
+
+ - At most `concurrency` requests of a group run at a time, the next max_queue wait in FIFO order. A request that
+   waited queue_timeout seconds without getting a slot gets a 503: by then the client has mostly given up anyway, and
+   its slot goes to a request that can still be served in time. When the queue is full a request is rejected at
+   once with a 429. Both come with a Retry-After estimated from the queue length and the group's recent service time.
+ - Request bodies of a group with charge_body=True are charged against one byte budget for the whole app
+   (ADMISSION_MAX_INFLIGHT_BYTES), from admission until the response is sent: Content-Length, or
+   unknown_length_bytes for a chunked body. A request that doesn't fit waits in the queue like one without a slot,
+   one bigger than the whole budget is rejected with a 413.
+ - With a disk_path, a request of a charge_body group is rejected with a 503 when its body (and every other in-flight
+   body) would leave less than min_free_disk_bytes free on that file system.
+ - The slot and the bytes are held until the response is complete, including streamed responses, which keep their
+   database connection as long as they stream.
+Queue wait time, shed requests by reason, slots in use, queued requests and in-flight bytes are exported on
+GET /metrics (admission_*). The state lives in the event loop of one worker process, every uvicorn worker admits
+for itself.
+"""
+
+import asyncio
+import json
+import math
+import os
+import shutil
+import time
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI
+from pydantic import BaseModel, Field
+from starlette.datastructures import Headers
+from starlette.routing import Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from metrics import REGISTRY
+
+POLICY_ATTRIBUTE = "__admission_group__"
+
+QUEUE_WAIT = REGISTRY.histogram(
+    "admission_queue_wait_seconds", "Time admitted requests waited for a slot", ["app", "group"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+SHED = REGISTRY.counter(
+    "admission_shed_total", "Requests rejected by admission control, by reason (queue_full, deadline, too_large, disk)",
+    ["app", "group", "reason"])
+
+_controllers: List["AdmissionController"] = []
+
+def _group_stats(stat: str):
+    def collect():
+        for controller in list(_controllers):
+            for name, group in controller.groups.items():
+                yield (controller.name, name), getattr(group, stat)
+    return collect
+
+def _inflight_bytes():
+    for controller in list(_controllers):
+        yield (controller.name,), controller.budget.used
+
+REGISTRY.gauge("admission_active", "Requests holding a slot", ["app", "group"], callback=_group_stats("active"))
+REGISTRY.gauge("admission_queued", "Requests waiting for a slot", ["app", "group"], callback=_group_stats("queued"))
+REGISTRY.gauge("admission_inflight_bytes", "Request body bytes admitted and not yet completed", ["app"],
+               callback=_inflight_bytes)
+
+
+class AdmissionSettings(BaseModel):
+    """
+    Every field can be overridden with an environment variable named ADMISSION_<FIELD NAME>, e.g. ADMISSION_QUEUE_TIMEOUT=2.
+    """
+    enabled: bool = Field(default=True, description="admission control on, off lets every request in")
+    queue_timeout: float = Field(default=5, gt=0, description="seconds a request may wait for a slot before it gets a 503")
+    max_inflight_bytes: int = Field(default=512 * 1024 * 1024, ge=1, description="budget for the bodies of admitted uploads")
+    unknown_length_bytes: int = Field(default=10 * 1024 * 1024, ge=0, description="what a body without Content-Length is charged")
+    min_free_disk_bytes: int = Field(default=256 * 1024 * 1024, ge=0, description="disk space uploads must leave free")
+    max_retry_after: int = Field(default=60, ge=1, description="upper bound of the Retry-After sent with a rejection")
+
+    @classmethod
+    def from_env(cls, prefix: str = "ADMISSION_", **overrides) -> "AdmissionSettings":
+        values = {}
+        for name in cls.model_fields:
+            env_value = os.getenv(prefix + name.upper())
+            if env_value is not None:
+                values[name] = env_value
+        values.update(overrides)
+        return cls(**values)
+
+
+@dataclass
+class Limit:
+    concurrency: int
+    max_queue: int = 0  # 0: twice the concurrency
+    queue_timeout: Optional[float] = None  # ADMISSION_QUEUE_TIMEOUT when None
+    charge_body: bool = False  # charge the request body to the byte budget and check the disk headroom
+
+
+def admitted(group: str) -> Callable:
+    """
+    the endpoint's requests take a slot of `group`, see setup_admission()
+    """
+    def mark(endpoint):
+        setattr(endpoint, POLICY_ATTRIBUTE, group)
+        return endpoint
+    return mark
+
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, reason: str, detail: str, retry_after: Optional[int] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.reason = reason
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+# ------------------------------
+# Slots and bytes
+# ------------------------------
+class ByteBudget:
+    """
+    bytes charged by the admitted requests, against a fixed budget
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.used = 0
+
+    def fits(self, size: int) -> bool:
+        return self.used + size <= self.capacity
+
+
+class AdmissionGroup:
+    """
+    `concurrency` slots with a bounded FIFO queue in front of them. Slots are handed over directly from a finishing
+    request to the first waiter that (still) waits, so a new arrival can't overtake the queue.
+    """
+
+    def __init__(self, name: str, limit: Limit, budget: ByteBudget, queue_timeout: float):
+        self.name = name
+        self.limit = limit
+        self.budget = budget
+        self.queue_timeout = limit.queue_timeout or queue_timeout
+        self.max_queue = limit.max_queue or 2 * limit.concurrency
+        self.active = 0
+        self._waiters: Deque[Tuple[asyncio.Future, int]] = deque()
+        self.service_time = 0.0  # moving average of the seconds a request holds its slot, for Retry-After
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for future, _ in self._waiters if not future.done())
+
+    def _can_run(self, size: int) -> bool:
+        return self.active < self.limit.concurrency and self.budget.fits(size)
+
+    def retry_after(self, maximum: int) -> int:
+        # the time for the queue ahead to drain through the slots, at least a second
+        waves = (self.queued + 1) / self.limit.concurrency
+        return max(1, min(maximum, math.ceil(waves * (self.service_time or 1.0))))
+
+    async def acquire(self, size: int) -> float:
+        """
+        wait for a slot and `size` bytes of the budget, returns the seconds waited. Raises Rejected.
+        """
+        while self._waiters and self._waiters[0][0].done():
+            self._waiters.popleft()
+        if not self._waiters and self._can_run(size):
+            self._take(size)
+            return 0.0
+        if self.queued >= self.max_queue:
+            raise Rejected(429, "queue_full", f"Too many requests waiting for {self.name}")
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((future, size))
+        try:
+            # a waiter that timed out or whose client went away is cancelled, wake() skips it
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise Rejected(503, "deadline", f"No capacity for {self.name} within {self.queue_timeout:g}s")
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just as the request was cancelled: pass it on
+                self.active -= 1
+                self.budget.used -= size
+                self.wake()
+            raise
+        return time.perf_counter() - started
+
+    def _take(self, size: int) -> None:
+        self.active += 1
+        self.budget.used += size
+
+    def release(self, size: int, held: float) -> None:
+        self.active -= 1
+        self.budget.used -= size
+        self.service_time = held if not self.service_time else 0.9 * self.service_time + 0.1 * held
+
+    def wake(self) -> None:
+        """
+        hand the free slots (and bytes) to the waiters at the head of the queue
+        """
+        while self._waiters:
+            future, size = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if not self._can_run(size):
+                return
+            self._waiters.popleft()
+            self._take(size)
+            future.set_result(None)
+
+
+# ------------------------------
+# Middleware
+# ------------------------------
+class AdmissionController:
+    def __init__(self, name: str, limits: Dict[str, Limit], settings: AdmissionSettings,
+                 disk_path: Optional[Path] = None):
+        self.name = name
+        self.settings = settings
+        self.budget = ByteBudget(settings.max_inflight_bytes)
+        self.groups = {group: AdmissionGroup(group, limit, self.budget, settings.queue_timeout)
+                       for group, limit in limits.items()}
+        self.disk_path = disk_path
+        self._disk_free: Tuple[float, int] = (0.0, 0)  # (checked at, free bytes), statvfs at most once a second
+        self._routes: Optional[list] = None
+        _controllers.append(self)
+
+    def match(self, scope: Scope) -> Optional[AdmissionGroup]:
+        if self._routes is None:
+            # the routes are all registered by the time the first request comes in
+            self._routes = [(route, getattr(getattr(route, "endpoint", None), POLICY_ATTRIBUTE, None))
+                            for route in scope["app"].router.routes]
+        for route, group in self._routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return self.groups.get(group) if group is not None else None
+        return None
+
+    def body_size(self, scope: Scope) -> int:
+        content_length = Headers(scope=scope).get("content-length")
+        try:
+            return int(content_length)
+        except (TypeError, ValueError):
+            return self.settings.unknown_length_bytes
+
+    def _disk_free_bytes(self) -> int:
+        now = time.monotonic()
+        checked_at, free = self._disk_free
+        if now - checked_at > 1:
+            # the upload directory may not exist yet before the first upload, its file system is the one of its parent
+            path = Path(self.disk_path)
+            while not path.exists() and path.parent != path:
+                path = path.parent
+            free = shutil.disk_usage(path).free
+            self._disk_free = (now, free)
+        return free
+
+    def check_body(self, group: AdmissionGroup, size: int) -> None:
+        if size > self.budget.capacity:
+            raise Rejected(413, "too_large", "Request body is larger than the upload budget of the server")
+        if self.disk_path is not None:
+            free = self._disk_free_bytes() - self.budget.used - size
+            if free < self.settings.min_free_disk_bytes:
+                raise Rejected(503, "disk", "Not enough free disk space for the upload")
+
+    async def admit(self, group: AdmissionGroup, size: int) -> float:
+        try:
+            if group.limit.charge_body:
+                self.check_body(group, size)
+            waited = await group.acquire(size)
+        except Rejected as rejected:
+            SHED.inc(app=self.name, group=group.name, reason=rejected.reason)
+            if rejected.status_code != 413:
+                rejected.retry_after = group.retry_after(self.settings.max_retry_after)
+            raise
+        QUEUE_WAIT.observe(waited, app=self.name, group=group.name)
+        return waited
+
+    def release(self, group: AdmissionGroup, size: int, held: float) -> None:
+        group.release(size, held)
+        # bytes freed by one group can let the waiters of another one in
+        group.wake()
+        for other in self.groups.values():
+            if other is not group:
+                other.wake()
+
+
+async def send_rejection(rejected: Rejected, send: Send) -> None:
+    body = json.dumps({"detail": rejected.detail}).encode()
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    if rejected.retry_after is not None:
+        headers.append((b"retry-after", str(rejected.retry_after).encode()))
+    await send({"type": "http.response.start", "status": rejected.status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    def __init__(self, app: ASGIApp, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        group = self.controller.match(scope)
+        if group is None:
+            return await self.app(scope, receive, send)
+        size = self.controller.body_size(scope) if group.limit.charge_body else 0
+        try:
+            await self.controller.admit(group, size)
+        except Rejected as rejected:
+            return await send_rejection(rejected, send)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(group, size, time.perf_counter() - started)
+
+
+def setup_admission(app: FastAPI, name: str, limits: Dict[str, Limit], settings: Optional[AdmissionSettings] = None,
+                    disk_path: Optional[Path] = None) -> Optional[AdmissionController]:
+    """
+    add the admission middleware to `app` (settings from ADMISSION_* environment variables by default), with one
+    group per entry of `limits`. Call it before setup_response_cache(), so a cache hit doesn't need a slot.
+    The controller is also put on app.state.admission, None when ADMISSION_ENABLED=false.
+    """
+    settings = settings or AdmissionSettings.from_env()
+    controller = None
+    if settings.enabled:
+        controller = AdmissionController(name, limits, settings, disk_path)
+        app.add_middleware(AdmissionMiddleware, controller=controller)
+    app.state.admission = controller
+    return controller
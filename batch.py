@@ -0,0 +1,82 @@
+"""
+The POST /batch endpoints of pydantic_learn.py (todos) and main.py (orders): many changes in one request.
+
+A client that syncs a list of changes used to send one request per change, each paying for routing, validation,
+serialisation and, with a durable journal, an fsync. POST /batch takes them all at once:
+
+    {"atomic": false, "operations": [{"op": "create", ...}, {"op": "update", ..., "if_match": 3}, ...]}
+
+ - The body is parsed and validated in one pass by a TypeAdapter (pydantic-core reads the JSON bytes directly), the
+   operations are a union discriminated by "op". An invalid operation rejects the whole batch with a 422 before
+   anything is applied, like a single request with an invalid body.
+ - The operations are applied in order by DurableStore.execute_batch() (storage.py): one lock acquisition and one
+   journal append for the whole batch.
+ - Every operation gets the status its own request would have had (201, 200, 404, 409, 412) and the result or error.
+   By default the failed ones are simply skipped. With "atomic": true the first failure undoes the whole batch:
+   nothing is kept, the operations that were not (or no longer) applied get a 424 Failed Dependency.
+ - if_match is the version of the todo / order the client last saw (the number in its ETag), like the If-Match
+   header of the single endpoints.
+The response itself is 200 whenever the batch was processed, the outcome is in the per-operation statuses.
+"""
+
+from typing import Any, Callable, List, Optional
+
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from concurrency import VersionConflict, format_etag
+
+MAX_BATCH_OPERATIONS = 1000
+
+
+class OperationResult(BaseModel):
+    status: int
+    etag: Optional[str] = None
+    result: Any = None
+    error: Optional[str] = None
+
+
+class BatchResult(BaseModel):
+    committed: bool
+    results: List[OperationResult]
+
+
+async def parse_batch(request: Request, adapter: TypeAdapter) -> Any:
+    """
+    validate the raw request body with `adapter`, a 422 with the same error format as FastAPI's own validation otherwise
+    """
+    try:
+        return adapter.validate_json(await request.body())
+    except ValidationError as error:
+        raise RequestValidationError([{**detail, "loc": ("body", *detail["loc"])} for detail in error.errors(include_url=False)])
+
+
+def failed(error: Exception) -> OperationResult:
+    if isinstance(error, VersionConflict):
+        etag = format_etag(error.current) if error.current is not None else None
+        return OperationResult(status=412, etag=etag, error="The resource was changed since it was read (if_match)")
+    # a KeyError, execute_batch() only returns the rejections of storage.REJECTIONS
+    return OperationResult(status=409, error=f"Already exists: {error.args[0] if error.args else error}")
+
+
+def batch_result(operations: list, results: List[Any], committed: bool,
+                 succeeded: Callable[[Any, Any], OperationResult], not_found: str) -> BatchResult:
+    """
+    one OperationResult per operation.
+    :param succeeded: (operation, what the store returned) -> the result of an operation that was applied
+    :param not_found: error message of an operation the store returned None for
+    """
+    out = []
+    for operation, result in zip(operations, results):
+        if isinstance(result, Exception):
+            out.append(failed(result))
+        elif result is None:
+            out.append(OperationResult(status=404, error=not_found))
+        elif committed:
+            out.append(succeeded(operation, result))
+        else:
+            out.append(OperationResult(status=424, error="Undone, a later operation of this atomic batch failed"))
+    out.extend(OperationResult(status=424, error="Not applied, an earlier operation of this atomic batch failed")
+               for _ in operations[len(results):])
+    return BatchResult(committed=committed, results=out)
@@ -0,0 +1,124 @@
+"""
+Benchmark: goodput and latency of an overloaded endpoint, with and without admission control (admission.py).
+
+The endpoint mimics an /items/ query: it checks a connection out of a pool of --pool connections (waiting up to
+--pool-timeout seconds for one, like SQLAlchemy's QueuePool, then failing with a 500) and holds it for --service-ms.
+Requests arrive at a fixed rate of --load times what the pool can serve, for --duration seconds, and every client
+gives up after --client-timeout seconds. A client that gave up doesn't stop the server from working on its request:
+the request is shielded, like a real server that only notices the disconnect when it writes the response.
+
+ off:       every request is let in and waits in the pool. The queue grows for as long as the overload lasts, the
+            pool serves requests whose clients are long gone, and goodput drops towards zero.
+ admission: the endpoint is @admitted("db") with one slot per pool connection. Requests that can't get a slot within
+            ADMISSION_QUEUE_TIMEOUT (--queue-timeout here) or find the queue full are turned away at once with a 503 /
+            429, so the pool only works on requests that can still be answered in time.
+
+goodput is the number of 200s the client received within its timeout, per second. The latencies are of those.
+
+Run it from the repository root:  python benchmarks/bench_admission.py --load 2 --duration 10
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from typing import List
+
+import httpx
+from fastapi import FastAPI, HTTPException
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from admission import AdmissionSettings, Limit, admitted, setup_admission
+
+
+def build_app(mode: str, pool: int, service: float, pool_timeout: float, queue_timeout: float) -> FastAPI:
+    app = FastAPI()
+    connections = asyncio.Semaphore(pool)
+
+    @app.get("/items/")
+    @admitted("db")
+    async def get_items():
+        try:
+            await asyncio.wait_for(connections.acquire(), pool_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=500, detail="QueuePool limit reached, connection timed out")
+        try:
+            await asyncio.sleep(service)
+        finally:
+            connections.release()
+        return []
+
+    if mode == "admission":
+        setup_admission(app, "bench", limits={"db": Limit(concurrency=pool, queue_timeout=queue_timeout)},
+                        settings=AdmissionSettings())
+    return app
+
+
+async def run_mode(mode: str, args) -> dict:
+    service = args.service_ms / 1000
+    app = build_app(mode, args.pool, service, args.pool_timeout, args.queue_timeout)
+    rate = args.load * args.pool / service
+    outcomes: Counter = Counter()
+    latencies: List[float] = []
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        async def one_request():
+            started = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(asyncio.shield(client.get("/items/")), args.client_timeout)
+            except asyncio.TimeoutError:
+                outcomes["client timeout"] += 1
+                return
+            outcomes[response.status_code] += 1
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - started)
+
+        tasks = []
+        started = time.perf_counter()
+        total = int(rate * args.duration)
+        for n in range(total):
+            # open loop: the arrivals don't slow down when the server does
+            delay = started + n / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one_request()))
+        await asyncio.gather(*tasks)
+        # let the server finish the requests nobody waits for any more
+        while any(not task.done() for task in asyncio.all_tasks() if task is not asyncio.current_task()):
+            await asyncio.sleep(0.05)
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "goodput": len(latencies) / args.duration,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else float("nan"),
+        "p99_ms": latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000 if latencies else float("nan"),
+        "outcomes": dict(outcomes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=["off", "admission"], choices=["off", "admission"])
+    parser.add_argument("--pool", type=int, default=15, help="connections, DB_POOL_SIZE + DB_MAX_OVERFLOW")
+    parser.add_argument("--service-ms", type=float, default=20, help="time a request holds its connection")
+    parser.add_argument("--load", type=float, default=2.0, help="arrival rate as a multiple of the pool's capacity")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of arrivals")
+    parser.add_argument("--client-timeout", type=float, default=2.0)
+    parser.add_argument("--pool-timeout", type=float, default=30.0)
+    parser.add_argument("--queue-timeout", type=float, default=1.0)
+    args = parser.parse_args()
+
+    capacity = args.pool / (args.service_ms / 1000)
+    print(f"capacity {capacity:.0f} req/s, offered {args.load * capacity:.0f} req/s")
+    print(f"{'mode':<11}{'goodput/s':>10}{'p50 ms':>10}{'p99 ms':>10}  outcomes")
+    for mode in args.modes:
+        result = asyncio.run(run_mode(mode, args))
+        print(f"{result['mode']:<11}{result['goodput']:>10.1f}{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}"
+              f"  {result['outcomes']}")
+
+
+if __name__ == "__main__":
+    main()
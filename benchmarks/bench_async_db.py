@@ -0,0 +1,138 @@
+"""
+Benchmark: concurrent requests per second of the /items/ endpoints with the three ways of talking to the database.
+
+ blocking: the old code, a sync Session used directly inside `async def`, every query blocks the event loop.
+ sync:     the sync fallback of item_service, the same Session work run in the threadpool.
+ async:    the aiosqlite AsyncEngine of item_service.
+
+Each mode gets a fresh SQLite file, is seeded with --rows items and then hit by --concurrency clients doing a mix of
+GET /items/?limit=50 and POST /items/ through httpx's in-process ASGI transport (no network, only the app is measured).
+
+A local SQLite file answers in microseconds, so without --latency-ms the blocking mode usually wins: there is nothing to
+wait for and it skips the threadpool/greenlet hand-offs. --latency-ms adds a sleep to every SQL statement, inside the
+thread that executes it, to mimic the round trip to a networked database like Supabase. That is where blocking the
+event loop serialises the whole worker and the sync/async modes pull ahead.
+
+Run it from the repository root:  python benchmarks/bench_async_db.py --requests 2000 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import httpx
+from fastapi import FastAPI
+from sqlalchemy import event
+from sqlmodel import SQLModel, Session, create_engine, select
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from item_service import Item, router as item_router
+from database import Database, create_async_engine_or_none
+
+
+def add_latency(engine, latency: float) -> None:
+    """
+    sleep for `latency` seconds on every statement, in whatever thread runs the sqlite3 connection
+    """
+    def on_connect(dbapi_connection, connection_record):
+        # aiosqlite wraps the sqlite3 connection, which lives in aiosqlite's own thread
+        raw = getattr(getattr(dbapi_connection, "driver_connection", None), "_conn", dbapi_connection)
+        raw.set_trace_callback(lambda statement: time.sleep(latency))
+    event.listen(engine, "connect", on_connect)
+
+
+def build_app(mode: str, db_file: Path, latency: float) -> FastAPI:
+    url = f"sqlite:///{db_file}"
+    engine = create_engine(url)
+    if latency:
+        add_latency(engine, latency)
+    SQLModel.metadata.create_all(engine)
+    app = FastAPI()
+    async_engine = None
+
+    if mode == "blocking":
+        # reproduces the original sqlmodel_learn.py handlers
+        @app.post("/items/", response_model=Item)
+        async def create_item(item: Item) -> Item:
+            with Session(engine) as session:
+                session.add(item)
+                session.commit()
+                session.refresh(item)
+                return item
+
+        @app.get("/items/", response_model=List[Item])
+        async def get_items(limit: Optional[int] = None):
+            with Session(engine) as session:
+                return session.exec(select(Item).limit(limit)).all()
+    else:
+        if mode == "async":
+            async_engine = create_async_engine_or_none(url)
+            if async_engine is None:
+                raise SystemExit("aiosqlite is not installed, cannot run the async mode")
+            if latency:
+                add_latency(async_engine.sync_engine, latency)
+        app.include_router(item_router)
+    app.state.database = Database.from_engines(engine, async_engine)
+    return app
+
+
+async def run_mode(mode: str, rows: int, requests: int, concurrency: int, write_ratio: float, latency: float) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        app = build_app(mode, Path(tmp) / "bench.db", latency)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for i in range(rows):
+                await client.post("/items/", json={"name": f"item {i}", "price": i})
+
+            writes_every = int(1 / write_ratio) if write_ratio > 0 else 0
+            counter = iter(range(requests))
+            latencies: List[float] = []
+
+            async def worker():
+                for n in counter:
+                    started = time.perf_counter()
+                    if writes_every and n % writes_every == 0:
+                        response = await client.post("/items/", json={"name": f"bench {n}", "price": n})
+                    else:
+                        response = await client.get("/items/", params={"limit": 50})
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+
+        await app.state.database.dispose()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "requests_per_second": requests / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=["blocking", "sync", "async"], choices=["blocking", "sync", "async"])
+    parser.add_argument("--rows", type=int, default=1000, help="items inserted before measuring")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--write-ratio", type=float, default=0.1, help="fraction of the requests that are POSTs")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated network round trip per SQL statement")
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for mode in args.modes:
+        result = asyncio.run(run_mode(mode, args.rows, args.requests, args.concurrency, args.write_ratio,
+                                   args.latency_ms / 1000))
+        print(f"{result['mode']:<10}{result['requests_per_second']:>10.1f}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark: CPU time of the database layer of item_service.py per call, without HTTP, against an in-memory SQLite
+database (so the query itself costs next to nothing and the Python side is what is measured).
+
+ list:   one page of --limit items with a price filter. orm: select(Item) built for every call, executed through the
+         Session and hydrated into Item objects. cached: fetch_items(), the statement cache + Core rows as dicts.
+ insert: one item. orm: session.add() + commit() + refresh() (a second SELECT). returning: insert_item(),
+         INSERT ... RETURNING.
+
+Run it from the repository root:  python benchmarks/bench_item_queries.py --calls 5000
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from sqlalchemy import insert
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel, Session, create_engine, select
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from item_service import Item, ItemFilter, fetch_items, insert_item
+
+
+def orm_list(session: Session, limit: int) -> list:
+    return session.exec(select(Item).where(Item.price >= 10.0).order_by(Item.id).limit(limit)).all()
+
+
+def cached_list(session: Session, limit: int) -> list:
+    return fetch_items(session, None, limit, ItemFilter(min_price=10.0))
+
+
+def orm_insert(session: Session, i: int) -> Item:
+    item = Item(name=f"new {i}", price=1.0)
+    session.add(item)
+    session.commit()
+    session.refresh(item)
+    return item
+
+
+def returning_insert(session: Session, i: int) -> Item:
+    return insert_item(session, Item(name=f"new {i}", price=1.0))
+
+
+def timed(fn, session: Session, arg, calls: int) -> float:
+    fn(session, arg)
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn(session, arg)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=5000, help="calls per variant")
+    parser.add_argument("--limit", type=int, default=50, help="page size of the list query")
+    parser.add_argument("--rows", type=int, default=1000, help="items in the table")
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.execute(insert(Item.__table__), [{"name": f"item {i}", "price": i * 0.5} for i in range(args.rows)])
+        session.commit()
+
+    print(f"{'query':<8} {'variant':<10} {'us/call':>8}")
+    with Session(engine) as session:
+        for name, fn, arg in (("list", orm_list, args.limit), ("list", cached_list, args.limit),
+                              ("insert", orm_insert, 0), ("insert", returning_insert, 0)):
+            variant = fn.__name__.split("_")[0]
+            print(f"{name:<8} {variant:<10} {timed(fn, session, arg, args.calls):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark: the two order store layouts of main.py (ORDERS_LAYOUT, see order_columns.py) with many orders.
+
+ dict:     order_store.OrderStore, a dict per order plus the per-user OrderIndex
+ columnar: order_columns.ColumnarOrderStore, typed arrays and interned item names
+
+For each layout --orders orders spread over --users users are loaded, then it reports:
+ memory:     bytes per order allocated by the store (tracemalloc)
+ load:       seconds to build the store
+ stats:      milliseconds for the aggregates of GET /orders/stats over every order, and of GET /users/{user_id}/stats
+             for one user (median of --repeat runs)
+ user query: microseconds for one filtered GET /users/{user_id}/ lookup (item + price range)
+The aggregates use NumPy when it is installed, the output says which.
+
+Run it from the repository root:  python benchmarks/bench_order_columns.py --orders 1000000 --users 10000
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import order_stats
+from order_columns import ColumnarOrderStore
+from order_store import OrderStore
+
+ITEMS = ["SSD", "Wireless Mouse", "Laptop Stand", "USB-C Hub", "Keyboard", "Monitor", "Webcam", "Headset"]
+
+
+def make_data(orders: int, users: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    data = {user_id: [] for user_id in range(users)}
+    for order_id in range(orders):
+        data[order_id % users].append({"order_id": order_id, "item": rng.choice(ITEMS), "quantity": rng.randint(1, 5),
+                                       "price": round(rng.uniform(5, 500), 2)})
+    return data
+
+
+def median_ms(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=200000, help="orders in the store")
+    parser.add_argument("--users", type=int, default=1000, help="users the orders are spread over")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, the median is reported")
+    args = parser.parse_args()
+
+    print(f"{args.orders} orders, {args.users} users, aggregates with {'NumPy' if order_stats.numpy else 'the array module'}")
+    print(f"{'layout':<9} {'bytes/order':>11} {'load s':>7} {'stats ms':>9} {'user stats ms':>13} {'user query us':>13}")
+    for name, layout in (("dict", OrderStore), ("columnar", ColumnarOrderStore)):
+        # the input dicts are traced too: the dict layout keeps them, the columnar one lets them go
+        tracemalloc.start()
+        data = make_data(args.orders, args.users)
+        start = time.perf_counter()
+        store = layout(data)
+        load = time.perf_counter() - start
+        del data
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        stats = median_ms(lambda: store.stats(), args.repeat)
+        user_stats = median_ms(lambda: store.stats(1), args.repeat)
+        query = median_ms(lambda: store[1].query("mouse", 100, 300), args.repeat) * 1000
+        print(f"{name:<9} {memory / args.orders:>11.0f} {load:>7.2f} {stats:>9.1f} {user_stats:>13.2f} {query:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
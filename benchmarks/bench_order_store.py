@@ -0,0 +1,125 @@
+"""
+Benchmark: cost of one order CRUD operation as a user's number of orders grows.
+
+ list:  the old storage, dummy_data_2 = {user_id: [order, ...]}. create scans for a duplicate order_id, update/delete
+        scan for the order and delete scans again in list.remove.
+ store: order_store.UserOrders, the ordered order_id -> order mapping main.py uses now.
+
+For every size in --sizes a user is filled with that many orders, then each operation is timed --ops times on random
+order_ids: get, create (duplicate check + insert), update (price change), rename (order_id change) and delete.
+Every change is undone after it is timed, so the user has exactly that many orders for every operation.
+The numbers are microseconds per operation; for the store they should stay flat from 10 to 100k orders, the list
+grows linearly. The list mode is skipped above --list-max orders to keep the run short.
+
+Run it from the repository root:  python benchmarks/bench_order_store.py --sizes 10 100 1000 10000 100000
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from order_store import UserOrders
+
+ITEMS = ["SSD", "Wireless Mouse", "Laptop Stand", "USB-C Hub", "Keyboard", "Monitor", "Webcam", "Headset"]
+
+
+def make_order(order_id: int, rng: random.Random) -> dict:
+    return {"order_id": order_id, "item": rng.choice(ITEMS), "quantity": rng.randint(1, 5),
+            "price": round(rng.uniform(5, 500), 2)}
+
+
+class ListOrders:
+    """
+    the previous implementation of the order endpoints, on a plain list
+    """
+
+    def __init__(self, orders: List[dict]):
+        self.orders = list(orders)
+
+    def get(self, order_id: int):
+        for order in self.orders:
+            if order["order_id"] == order_id:
+                return order
+        return None
+
+    def add(self, order: dict) -> None:
+        if any(existing["order_id"] == order["order_id"] for existing in self.orders):
+            raise KeyError(order["order_id"])
+        self.orders.append(order)
+
+    def update(self, order_id: int, changes: dict):
+        for order in self.orders:
+            if order["order_id"] == order_id:
+                order.update({key: value for key, value in changes.items() if value is not None})
+                return order
+        return None
+
+    def remove(self, order_id: int):
+        for order in self.orders:
+            if order["order_id"] == order_id:
+                self.orders.remove(order)
+                return order
+        return None
+
+
+def time_op(op: Callable[[int], object], ops: int, undo: Optional[Callable[[int], object]] = None) -> float:
+    """
+    average microseconds of op(i); undo(i) runs outside the timing and puts the user's orders back the way they were,
+    so every operation sees the same number of orders
+    """
+    total = 0.0
+    for i in range(ops):
+        start = time.perf_counter()
+        op(i)
+        total += time.perf_counter() - start
+        if undo is not None:
+            undo(i)
+    return total / ops * 1e6
+
+
+def run(kind: str, size: int, ops: int, seed: int) -> Dict[str, float]:
+    rng = random.Random(seed)
+    orders = [make_order(order_id, rng) for order_id in range(size)]
+    store = UserOrders(orders) if kind == "store" else ListOrders(orders)
+    targets = [rng.randrange(size) for _ in range(ops)]
+    new_orders = [make_order(size + i, rng) for i in range(ops)]
+    removed = {}
+
+    def delete(i: int) -> None:
+        removed[i] = store.remove(targets[i])
+
+    return {
+        "get": time_op(lambda i: store.get(targets[i]), ops),
+        "create": time_op(lambda i: store.add(new_orders[i]), ops, lambda i: store.remove(size + i)),
+        "update": time_op(lambda i: store.update(targets[i], {"price": 9.99}), ops),
+        "rename": time_op(lambda i: store.update(targets[i], {"order_id": size + i}), ops,
+                          lambda i: store.update(size + i, {"order_id": targets[i]})),
+        "delete": time_op(delete, ops, lambda i: store.add(removed.pop(i))),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000],
+                        help="orders per user to measure at")
+    parser.add_argument("--ops", type=int, default=2000, help="operations timed per size and operation")
+    parser.add_argument("--list-max", type=int, default=10000, help="largest size the old list version is run for")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    operations = ["get", "create", "update", "rename", "delete"]
+    print(f"{'mode':<6} {'orders':>8}  " + "  ".join(f"{op + ' us':>10}" for op in operations))
+    for size in args.sizes:
+        for kind in ("list", "store"):
+            if kind == "list" and size > args.list_max:
+                continue
+            results = run(kind, size, args.ops, args.seed)
+            print(f"{kind:<6} {size:>8}  " + "  ".join(f"{results[op]:>10.2f}" for op in operations))
+
+
+if __name__ == "__main__":
+    main()
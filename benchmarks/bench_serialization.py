@@ -0,0 +1,92 @@
+"""
+Benchmark: CPU per request of the list endpoints, FastAPI's default response path vs @fast_json (fast_json.py).
+
+ default: the endpoint returns models / dicts, FastAPI validates them against the response model,
+          runs jsonable_encoder and json.dumps.
+ fast:    the same endpoint under @fast_json, the return value is written to JSON bytes by pydantic-core
+          (TypeAdapter.dump_json) or orjson, without re-validation.
+
+Three list shapes, each --rows long, built in memory so only the response path is measured (no database, no cache):
+ todos:  List[Todo] like GET /todos of pydantic_learn.py
+ items:  Sequence[Item] (SQLModel table models) like GET /items/ of item_service.py
+ orders: a plain dict holding a list of order dicts, like GET /users/{user_id}/ of main.py
+
+Each request goes through the whole app in process (httpx ASGITransport), the time is process CPU time per request.
+
+Run it from the repository root:  python benchmarks/bench_serialization.py --rows 10 100 1000
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+from typing import List, Sequence
+
+import httpx
+from fastapi import FastAPI
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from fast_json import fast_json
+from item_service import Item
+from pydantic_learn import Priority, Todo
+
+
+def build_app(rows: int, fast: bool) -> FastAPI:
+    todos = [Todo(todo_id=i, todo_name=f"todo {i}", todo_description=f"description of todo number {i}",
+                  priority=Priority(i % 3 + 1)) for i in range(rows)]
+    items = [Item(id=i, name=f"item {i}", price=i * 1.25, is_offered=i % 2 == 0) for i in range(rows)]
+    orders = [{"order_id": i, "item": f"item {i}", "quantity": i % 5 + 1, "price": i * 2.5} for i in range(rows)]
+    wrap = fast_json if fast else (lambda endpoint: endpoint)
+    app = FastAPI()
+
+    @app.get("/todos")
+    @wrap
+    def get_todos() -> List[Todo]:
+        return todos
+
+    @app.get("/items/", response_model=List[Item])
+    @wrap
+    async def get_items() -> Sequence[Item]:
+        return items
+
+    @app.get("/users/{user_id}/")
+    @wrap
+    async def get_user_orders(user_id: int):
+        return {"user_id": user_id, "filters_applied": {"item": None, "min_price": None, "max_price": None,
+                                                         "quantity": None}, "results": orders}
+
+    return app
+
+
+async def measure(app: FastAPI, path: str, requests: int) -> float:
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for _ in range(min(20, requests)):  # warm up: TypeAdapters, route caches
+            (await client.get(path)).raise_for_status()
+        start = time.process_time()
+        for _ in range(requests):
+            await client.get(path)
+        return (time.process_time() - start) / requests * 1e6
+
+
+async def run(rows_list: List[int], requests: int) -> None:
+    paths = {"todos": "/todos", "items": "/items/", "orders": "/users/101/"}
+    print(f"{'endpoint':<8} {'rows':>6}  {'default us':>11}  {'fast us':>9}  {'speedup':>7}")
+    for rows in rows_list:
+        apps = {fast: build_app(rows, fast) for fast in (False, True)}
+        for name, path in paths.items():
+            default = await measure(apps[False], path, requests)
+            fast = await measure(apps[True], path, requests)
+            print(f"{name:<8} {rows:>6}  {default:>11.1f}  {fast:>9.1f}  {default / fast:>6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10, 100, 1000], help="list lengths to measure")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint and mode")
+    args = parser.parse_args()
+    asyncio.run(run(args.rows, args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Benchmark: cold start of the apps, i.e. how long a new worker process (a container scaled up, a uvicorn --reload)
+takes until it has answered its first request.
+
+Every run is a fresh Python process, timed in four parts:
+ import   importing the app's module (FastAPI, SQLAlchemy ... and the app's own modules)
+ create   create_app(): the database apps only configure their engines, main / todos open their order / todo store
+ startup  the app's lifespan up to its yield, what uvicorn waits for before it accepts connections
+ first    the first request (the path in TARGETS), including the startup work it waits for, e.g. the schema check
+          and connection warm-up of the database apps
+The first run of a target starts from an empty working directory (no database.db, no uploads/), the next ones reuse
+it, like a container restarted on the same volume: with an up to date schema the database apps skip creating it.
+The results are the first run and the median of the others; with --budget-ms a median total over budget is reported
+(and the exit code is 1 with --fail-over-budget). --importtime N lists the N slowest imports of every target, from
+an extra run under -X importtime.
+
+Run it from the repository root:  python benchmarks/bench_startup.py --targets sqlite upload --runs 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+UPLOAD_BACKEND = ROOT / "file-upload-app" / "backend"
+PHASES = ["import", "create", "startup", "first"]
+
+# name: (module, directory, first request)
+TARGETS: Dict[str, Tuple[str, Path, str]] = {
+    "sqlite": ("sqlmodel_learn", ROOT, "/items/?limit=1"),
+    "upload": ("file_upload", UPLOAD_BACKEND, "/files"),
+    "main": ("main", ROOT, "/users/101/"),
+    "todos": ("pydantic_learn", ROOT, "/todos"),
+}
+
+# runs in the child process: argv[1] is the module, argv[2] the path of the first request
+CHILD = """
+import asyncio, json, sys, time
+import httpx
+started = time.perf_counter()
+module = __import__(sys.argv[1])  # not importlib.import_module(): -X importtime doesn't list the module for it
+imported = time.perf_counter()
+app = module.create_app()
+created = time.perf_counter()
+
+async def serve():
+    async with app.router.lifespan_context(app):
+        up = time.perf_counter()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://startup") as client:
+            response = await client.get(sys.argv[2])
+        answered = time.perf_counter()
+    return up, answered, response.status_code
+
+if __name__ == "__main__":
+    up, answered, status = asyncio.run(serve())
+    print(json.dumps({"import": imported - started, "create": created - imported, "startup": up - created,
+                      "first": answered - up, "status": status}))
+"""
+
+
+def run_once(module: str, directory: Path, path: str, workdir: Path, importtime: bool = False) -> dict:
+    # the upload backend also imports the modules it shares with the apps at the root (metrics.py ...)
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [str(directory), str(ROOT), os.environ.get("PYTHONPATH")]))}
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", CHILD, module, path]
+    process = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"{module} failed to start:\n{process.stderr[-2000:]}")
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    if importtime:
+        result["importtime"] = process.stderr
+    return result
+
+
+def slowest_imports(importtime: str, module: str, count: int) -> List[Tuple[int, str]]:
+    """
+    the `count` direct imports of `module` with the highest cumulative time (us), from -X importtime output
+    """
+    children = []
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # a module is listed after everything it imports
+        if depth == 1:
+            children.append((int(cumulative), name.strip()))
+        elif depth == 0:
+            if name.strip() == module:
+                return sorted(children, reverse=True)[:count]
+            children = []
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument("--runs", type=int, default=5, help="processes started per target, the first one on an empty directory")
+    parser.add_argument("--budget-ms", type=float, default=1000, help="median total a start should stay under")
+    parser.add_argument("--fail-over-budget", action="store_true")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N", help="print the N slowest imports of each target")
+    args = parser.parse_args()
+
+    over_budget = []
+    print(f"{'target':<8}{'run':<8}" + "".join(f"{phase + ' ms':>12}" for phase in PHASES) + f"{'total ms':>12}")
+    for name in args.targets:
+        module, directory, path = TARGETS[name]
+        with tempfile.TemporaryDirectory() as workdir:
+            results = [run_once(module, directory, path, Path(workdir)) for _ in range(args.runs)]
+            # one more run for -X importtime, it slows the imports down so it isn't counted
+            importtime = run_once(module, directory, path, Path(workdir), importtime=True)["importtime"] if args.importtime else ""
+        statuses = {result["status"] for result in results}
+        if statuses != {200}:
+            print(f"{name}: first request answered with {sorted(statuses)}")
+        rows = [("first", results[0])]
+        if len(results) > 1:
+            rows.append(("median", {phase: statistics.median(result[phase] for result in results[1:]) for phase in PHASES}))
+        for label, result in rows:
+            total = sum(result[phase] for phase in PHASES)
+            print(f"{name:<8}{label:<8}" + "".join(f"{result[phase] * 1000:>12.1f}" for phase in PHASES) + f"{total * 1000:>12.1f}")
+        median_total = sum(rows[-1][1][phase] for phase in PHASES) * 1000
+        if median_total > args.budget_ms:
+            over_budget.append(f"{name} {median_total:.0f} ms")
+        if args.importtime:
+            for cumulative, imported in slowest_imports(importtime, module, args.importtime):
+                print(f"{'':<16}{cumulative / 1000:>8.1f} ms  {imported}")
+
+    if over_budget:
+        print(f"over the {args.budget_ms:.0f} ms budget: " + ", ".join(over_budget))
+        if args.fail_over_budget:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
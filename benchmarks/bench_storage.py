@@ -0,0 +1,133 @@
+"""
+Benchmark: the storage backends of storage.py, for the todo store of pydantic_learn.py.
+
+ writes:  time per DurableStore.execute("create", ...), i.e. per POST /todos/create without the HTTP part,
+          for every backend, with and without fsync
+ startup: time for open_store() to load a store of --todos todos, right after a snapshot and with the
+          longest journal a restart can find (snapshot_every - 1 changes to replay)
+ contended: the order store of main.py, --writers threads each adding orders for a user of their own while
+          --readers threads read other users' orders, for --seconds per backend (fsync on). Writes/s, and the
+          latency of reading() (catching up with the journal + the user's lock): a read shouldn't wait for an fsync.
+
+Each run uses a fresh temporary directory. Run it from the repository root:
+    python benchmarks/bench_storage.py --writes 2000 --todos 10000
+"""
+
+import argparse
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from order_store import OrderStore
+from pydantic_learn import TodoStore
+from storage import StorageSettings, open_store
+
+
+def new_todo(i: int) -> dict:
+    return {"todo_name": f"todo {i}", "todo_description": f"description of todo number {i}", "priority": i % 3 + 1}
+
+
+def bench_writes(backend: str, fsync: bool, writes: int) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        settings = StorageSettings(backend=backend, path=directory, fsync=fsync, snapshot_every=1000)
+        store = open_store("todos", TodoStore(), settings)
+        start = time.perf_counter()
+        for i in range(writes):
+            store.execute("create", todo=new_todo(i))
+        elapsed = time.perf_counter() - start
+        store.close()
+    return elapsed / writes * 1e6
+
+
+def bench_startup(backend: str, todos: int, snapshot_every: int) -> tuple:
+    with tempfile.TemporaryDirectory() as directory:
+        settings = StorageSettings(backend=backend, path=directory, fsync=False, snapshot_every=snapshot_every)
+        store = open_store("todos", TodoStore(), settings)
+        for i in range(todos):
+            store.execute("create", todo=new_todo(i))
+        store.close()
+        start = time.perf_counter()
+        open_store("todos", TodoStore(), settings).close()
+        after_snapshot = time.perf_counter() - start
+        # one change short of the next snapshot: the most a restart ever has to replay
+        store = open_store("todos", TodoStore(), settings)
+        for i in range(snapshot_every - 1):
+            store.execute("update", todo_id=i % todos + 1, changes={"priority": i % 3 + 1})
+        store.close()
+        start = time.perf_counter()
+        open_store("todos", TodoStore(), settings).close()
+        full_journal = time.perf_counter() - start
+    return after_snapshot * 1000, full_journal * 1000
+
+
+def bench_contended(backend: str, writers: int, readers: int, seconds: float) -> tuple:
+    with tempfile.TemporaryDirectory() as directory:
+        settings = StorageSettings(backend=backend, path=directory, fsync=True, snapshot_every=1000)
+        orders = OrderStore({user_id: [] for user_id in range(writers + readers)})
+        store = open_store("orders", orders, settings, lock_key=lambda args: args["user_id"])
+        stop = threading.Event()
+        writes = [0] * writers
+        latencies: list = []
+
+        def write(n: int) -> None:
+            while not stop.is_set():
+                store.execute("add", user_id=n, order={"order_id": writes[n], "item": "SSD", "quantity": 1,
+                                                       "price": 10.0})
+                writes[n] += 1
+
+        def read(user_id: int) -> None:
+            while not stop.is_set():
+                started = time.perf_counter()
+                with store.reading(user_id):
+                    orders[user_id].query(None, None, None, None)
+                latencies.append(time.perf_counter() - started)
+                time.sleep(0.0005)
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(writers)]
+        threads += [threading.Thread(target=read, args=(writers + n,)) for n in range(readers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        store.close()
+    latencies.sort()
+    return (sum(writes) / seconds, statistics.median(latencies) * 1e6,
+            latencies[int(len(latencies) * 0.99)] * 1e6, latencies[-1] * 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writes", type=int, default=2000, help="changes per backend for the write benchmark")
+    parser.add_argument("--todos", type=int, default=10000, help="size of the store for the startup benchmark")
+    parser.add_argument("--snapshot-every", type=int, default=1000, help="STORAGE_SNAPSHOT_EVERY for the startup benchmark")
+    parser.add_argument("--writers", type=int, default=4, help="writing threads of the contended benchmark")
+    parser.add_argument("--readers", type=int, default=4, help="reading threads of the contended benchmark")
+    parser.add_argument("--seconds", type=float, default=3, help="duration of the contended benchmark, per backend")
+    args = parser.parse_args()
+
+    print(f"{'backend':<8} {'fsync':>5}  {'us/write':>9}")
+    for backend in ("memory", "wal", "sqlite"):
+        for fsync in ((False,) if backend == "memory" else (True, False)):
+            print(f"{backend:<8} {str(fsync):>5}  {bench_writes(backend, fsync, args.writes):>9.1f}")
+
+    print(f"\nstartup with {args.todos} todos")
+    print(f"{'backend':<8}  {'snapshot ms':>11}  {'+ journal ms':>12}")
+    for backend in ("wal", "sqlite"):
+        after_snapshot, full_journal = bench_startup(backend, args.todos, args.snapshot_every)
+        print(f"{backend:<8}  {after_snapshot:>11.1f}  {full_journal:>12.1f}")
+
+    print(f"\n{args.writers} writers and {args.readers} readers on different users")
+    print(f"{'backend':<8}  {'writes/s':>8}  {'read p50 us':>11}  {'read p99 us':>11}  {'read max us':>11}")
+    for backend in ("wal", "sqlite"):
+        rate, p50, p99, worst = bench_contended(backend, args.writers, args.readers, args.seconds)
+        print(f"{backend:<8}  {rate:>8.0f}  {p50:>11.1f}  {p99:>11.1f}  {worst:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,559 @@
+"""
+Load test: concurrent workloads against the apps of this repo, results written to a JSON file and compared with a baseline.
+
+Targets (--targets):
+ main    main:app             orders API, the user's orders seeded with --seed-rows orders
+ todos   pydantic_learn:app   todo API, seeded with --seed-rows todos
+ sqlite  sqlmodel_learn:app   /items/ on a fresh SQLite file, seeded with --seed-rows items through /items/bulk
+ upload  file_upload:app      file-upload-app/backend, a few files are uploaded up front for the read workload
+
+Workloads (--workloads), every target skips the ones it doesn't have:
+ read    mostly GETs: filtered / paginated lists and single lookups, ~10% writes in between
+ write   mostly creates, updates and deletes, ~10% reads
+ upload  --upload-mb sized multipart uploads to /upload_stream, every file unique so deduplication doesn't kick in
+ replay  the requests of --replay (an .http file like test_main.http, or JSONL with one
+         {"method", "path", "headers", "json" | "body"} object per line), sent round-robin
+
+Servers (--server):
+ inprocess  the app is imported and driven through httpx's ASGI transport: no network, no worker processes,
+            the numbers only measure the app (and the RSS is the one of this process, including every target run so far)
+ uvicorn    the app runs under `python -m uvicorn` (--workers processes) on a local port, the RSS is the sum of the
+            server's processes. Closer to production, needs uvicorn installed.
+Every target runs in its own temporary working directory, so database.db / uploads/ start empty and nothing in the
+repository is touched. --env KEY=VALUE sets environment variables for the apps, e.g. --env CACHE_BACKEND=none.
+
+For every target/workload the results file gets the throughput, the latency percentiles (ms), status code counts
+and the RSS (MB) at the start, end and peak of the run. With --baseline the run is compared with an earlier results
+file: a throughput drop or p99 increase of more than --threshold percent is reported as a regression
+(and the exit code is 1 with --fail-on-regression).
+
+Run it from the repository root:
+    python benchmarks/loadtest.py --targets main todos sqlite --workloads read write --requests 2000 --concurrency 32
+    python benchmarks/loadtest.py --targets upload --workloads upload --upload-mb 20 --requests 20 --concurrency 4
+    python benchmarks/loadtest.py --output after.json --baseline before.json --fail-on-regression
+"""
+
+import argparse
+import asyncio
+import contextlib
+import importlib
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+UPLOAD_BACKEND = ROOT / "file-upload-app" / "backend"
+WORKLOAD_NAMES = ["read", "write", "upload", "replay"]
+
+
+# ------------------------------
+# Requests and workloads
+# ------------------------------
+@dataclass
+class RequestSpec:
+    method: str
+    url: str
+    kwargs: dict = field(default_factory=dict)
+    # called with the response, e.g. to remember the id of a created row for later updates
+    on_response: Optional[Callable[[httpx.Response], None]] = None
+
+
+Workload = Callable[[random.Random, dict], RequestSpec]
+
+
+def pick(rng: random.Random, choices: Dict[str, float]) -> str:
+    return rng.choices(list(choices), weights=list(choices.values()))[0]
+
+
+# main:app -------------------------------------------------------------------------------------------------------------
+MAIN_USER = 101
+ORDER_ITEMS = ["SSD", "Wireless Mouse", "Laptop Stand", "USB-C Hub", "Keyboard", "Monitor", "Webcam", "Headset"]
+
+def main_order(order_id: int, rng: random.Random) -> dict:
+    return {"order_id": order_id, "item": rng.choice(ORDER_ITEMS), "quantity": rng.randint(1, 5),
+            "price": round(rng.uniform(5, 500), 2)}
+
+async def main_setup(client: httpx.AsyncClient, rows: int, state: dict) -> None:
+    state["next_id"] = itertools.count(100000)
+    state["ids"] = []
+    for _ in range(rows):
+        order_id = next(state["next_id"])
+        (await client.post(f"/create_order/{MAIN_USER}", json=main_order(order_id, random.Random(order_id)))).raise_for_status()
+        state["ids"].append(order_id)
+
+def main_request(kind: str, rng: random.Random, state: dict) -> RequestSpec:
+    ids: List[int] = state["ids"]
+    if kind == "list":
+        params = rng.choice([{}, {"item": rng.choice(["mouse", "ss", "hub"])}, {"min_price": 100, "max_price": 200},
+                             {"quantity": rng.randint(1, 5)}])
+        return RequestSpec("GET", f"/users/{MAIN_USER}/", {"params": params})
+    if kind == "user":
+        return RequestSpec("GET", f"/get_user/{MAIN_USER}")
+    if kind == "update" and ids:
+        return RequestSpec("PUT", f"/update_order/{MAIN_USER}/{rng.choice(ids)}", {"json": {"price": round(rng.uniform(5, 500), 2)}})
+    if kind == "delete" and ids:
+        return RequestSpec("DELETE", f"/delete_order/{MAIN_USER}/{ids.pop(rng.randrange(len(ids)))}")
+    order_id = next(state["next_id"])
+    ids.append(order_id)
+    return RequestSpec("POST", f"/create_order/{MAIN_USER}", {"json": main_order(order_id, rng)})
+
+def main_read(rng: random.Random, state: dict) -> RequestSpec:
+    return main_request(pick(rng, {"list": 80, "user": 10, "create": 5, "update": 5}), rng, state)
+
+def main_write(rng: random.Random, state: dict) -> RequestSpec:
+    return main_request(pick(rng, {"create": 40, "update": 30, "delete": 20, "list": 10}), rng, state)
+
+
+# pydantic_learn:app ---------------------------------------------------------------------------------------------------
+def todo_body(rng: random.Random) -> dict:
+    return {"todo_name": f"todo {rng.randrange(10 ** 6)}", "todo_description": "a todo created by the load test",
+            "priority": rng.randint(1, 3)}
+
+async def todos_setup(client: httpx.AsyncClient, rows: int, state: dict) -> None:
+    state["ids"] = []
+    rng = random.Random(0)
+    for _ in range(rows):
+        response = await client.post("/todos/create", json=todo_body(rng))
+        response.raise_for_status()
+        state["ids"].append(response.json()["todo"]["todo_id"])
+
+def todos_request(kind: str, rng: random.Random, state: dict) -> RequestSpec:
+    ids: List[int] = state["ids"]
+    if kind == "list":
+        params = rng.choice([{"limit": 50}, {"limit": 50, "priority": rng.randint(1, 3)},
+                             {"limit": 50, "after_id": rng.choice(ids) if ids else 0}])
+        return RequestSpec("GET", "/todos", {"params": params})
+    if kind == "get" and ids:
+        todo_id = rng.choice(ids)
+        return RequestSpec("GET", f"/todos/{todo_id}", {"params": {"target_todo_id": todo_id}})
+    if kind == "update" and ids:
+        todo_id = rng.choice(ids)
+        return RequestSpec("PUT", f"/todos/update/{todo_id}", {"params": {"target_todo_id": todo_id},
+                                                              "json": {"priority": rng.randint(1, 3)}})
+    if kind == "delete" and ids:
+        todo_id = ids.pop(rng.randrange(len(ids)))
+        return RequestSpec("DELETE", f"/todos/delete/{todo_id}", {"params": {"target_todo_id": todo_id}})
+    return RequestSpec("POST", "/todos/create", {"json": todo_body(rng)},
+                       lambda response: ids.append(response.json()["todo"]["todo_id"]))
+
+def todos_read(rng: random.Random, state: dict) -> RequestSpec:
+    return todos_request(pick(rng, {"list": 60, "get": 30, "create": 5, "update": 5}), rng, state)
+
+def todos_write(rng: random.Random, state: dict) -> RequestSpec:
+    return todos_request(pick(rng, {"create": 40, "update": 30, "delete": 20, "list": 10}), rng, state)
+
+
+# sqlmodel_learn:app ---------------------------------------------------------------------------------------------------
+def item_body(rng: random.Random) -> dict:
+    return {"name": f"item {rng.randrange(10 ** 6)}", "price": round(rng.uniform(1, 1000), 2), "is_offered": rng.random() < 0.3}
+
+async def sqlite_setup(client: httpx.AsyncClient, rows: int, state: dict) -> None:
+    rng = random.Random(0)
+    for start in range(0, rows, 1000):
+        batch = [item_body(rng) for _ in range(min(1000, rows - start))]
+        (await client.post("/items/bulk", json=batch)).raise_for_status()
+    state["rows"] = rows
+
+def sqlite_request(kind: str, rng: random.Random, state: dict) -> RequestSpec:
+    if kind == "page":
+        return RequestSpec("GET", "/items/", {"params": {"limit": 50, "after_id": rng.randrange(max(1, state["rows"]))}})
+    if kind == "first":
+        return RequestSpec("GET", "/items/", {"params": {"limit": 50}})
+    if kind == "bulk":
+        return RequestSpec("POST", "/items/bulk", {"json": [item_body(rng) for _ in range(100)]})
+    return RequestSpec("POST", "/items/", {"json": item_body(rng)})
+
+def sqlite_read(rng: random.Random, state: dict) -> RequestSpec:
+    return sqlite_request(pick(rng, {"page": 60, "first": 30, "create": 10}), rng, state)
+
+def sqlite_write(rng: random.Random, state: dict) -> RequestSpec:
+    return sqlite_request(pick(rng, {"create": 70, "bulk": 20, "page": 10}), rng, state)
+
+
+# file_upload:app ------------------------------------------------------------------------------------------------------
+UPLOAD_BLOCK = os.urandom(1024 * 1024)
+UPLOAD_BOUNDARY = "loadtest-boundary-7d3f"
+
+async def multipart_body(filename: str, size: int) -> AsyncIterator[bytes]:
+    """
+    a multipart/form-data body with one file of `size` bytes, generated while it is sent.
+    The file starts with random bytes so every upload has its own hash.
+    """
+    yield (f"--{UPLOAD_BOUNDARY}\r\nContent-Disposition: form-data; name=\"file_uploads\"; filename=\"{filename}\"\r\n"
+           f"Content-Type: application/octet-stream\r\n\r\n").encode()
+    yield os.urandom(32)
+    remaining = size - 32
+    while remaining > 0:
+        chunk = UPLOAD_BLOCK[:remaining]
+        remaining -= len(chunk)
+        yield chunk
+    yield f"\r\n--{UPLOAD_BOUNDARY}--\r\n".encode()
+
+def upload_spec(name: str, size: int) -> RequestSpec:
+    return RequestSpec("POST", "/upload_stream", {
+        "content": multipart_body(name, size),
+        "headers": {"Content-Type": f"multipart/form-data; boundary={UPLOAD_BOUNDARY}"}})
+
+async def upload_setup(client: httpx.AsyncClient, rows: int, state: dict) -> None:
+    state["names"] = []
+    state["counter"] = itertools.count()
+    for i in range(min(rows, 8)):
+        spec = upload_spec(f"seed-{i}.bin", 256 * 1024)
+        (await client.request(spec.method, spec.url, **spec.kwargs)).raise_for_status()
+        state["names"].append(f"seed-{i}.bin")
+
+def upload_read(rng: random.Random, state: dict) -> RequestSpec:
+    name = rng.choice(state["names"])
+    if rng.random() < 0.5:
+        return RequestSpec("GET", f"/files/{name}", {"headers": {"Range": "bytes=0-65535"}})
+    return RequestSpec("GET", f"/files/{name}")
+
+def upload_large(rng: random.Random, state: dict) -> RequestSpec:
+    return upload_spec(f"upload-{next(state['counter'])}.bin", state["upload_bytes"])
+
+
+@dataclass
+class Target:
+    app: str            # module:attribute, as for uvicorn
+    directory: Path     # where the module lives
+    ready_path: str     # a cheap GET to tell the server is up
+    setup: Callable
+    workloads: Dict[str, Workload]
+
+
+TARGETS = {
+    "main": Target("main:app", ROOT, "/", main_setup, {"read": main_read, "write": main_write}),
+    "todos": Target("pydantic_learn:app", ROOT, "/", todos_setup, {"read": todos_read, "write": todos_write}),
+    "sqlite": Target("sqlmodel_learn:app", ROOT, "/items/?limit=1", sqlite_setup, {"read": sqlite_read, "write": sqlite_write}),
+    "upload": Target("file_upload:app", UPLOAD_BACKEND, "/", upload_setup, {"read": upload_read, "upload": upload_large}),
+}
+
+
+# ------------------------------
+# Replay
+# ------------------------------
+def load_replay(path: Path) -> List[RequestSpec]:
+    """
+    requests from an .http file (JetBrains/VS Code REST client format, blocks separated by ###) or from JSONL
+    """
+    specs = []
+    if path.suffix == ".jsonl":
+        for line in path.read_text().splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                kwargs = {"headers": entry.get("headers") or {}}
+                if "json" in entry:
+                    kwargs["json"] = entry["json"]
+                elif "body" in entry:
+                    kwargs["content"] = entry["body"].encode()
+                specs.append(RequestSpec(entry.get("method", "GET").upper(), entry["path"], kwargs))
+        return specs
+    for block in path.read_text().split("###"):
+        lines = [line for line in block.strip().splitlines() if not line.lstrip().startswith(("#", "//"))]
+        while lines and not lines[0].strip():
+            lines.pop(0)
+        if not lines:
+            continue
+        method, url = lines[0].split()[:2]
+        headers, body_lines, in_body = {}, [], False
+        for line in lines[1:]:
+            if in_body:
+                body_lines.append(line)
+            elif not line.strip():
+                in_body = True
+            elif ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip()] = value.strip()
+            else:
+                in_body, body_lines = True, [line]
+        parsed = httpx.URL(url)
+        path_and_query = parsed.raw_path.decode()
+        kwargs = {"headers": headers}
+        if body_lines:
+            kwargs["content"] = "\n".join(body_lines).strip().encode()
+        specs.append(RequestSpec(method.upper(), path_and_query, kwargs))
+    return specs
+
+def replay_workload(specs: List[RequestSpec]) -> Workload:
+    counter = itertools.count()
+    def next_request(rng: random.Random, state: dict) -> RequestSpec:
+        return specs[next(counter) % len(specs)]
+    return next_request
+
+
+# ------------------------------
+# Servers
+# ------------------------------
+def rss_mb(pid: int) -> Optional[float]:
+    """
+    resident memory of a process and its children (the uvicorn workers), from /proc. None where there is no /proc.
+    """
+    total = 0
+    try:
+        pids = [pid]
+        for task in Path(f"/proc/{pid}/task").iterdir():
+            pids.extend(int(child) for child in (task / "children").read_text().split())
+        for process in pids:
+            for line in Path(f"/proc/{process}/status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+    except OSError:
+        return None
+    return round(total / 1024, 1)
+
+
+def import_paths(target: Target) -> List[str]:
+    # the upload backend also imports the modules it shares with the apps at the root (metrics.py ...)
+    return list(dict.fromkeys([str(target.directory), str(ROOT)]))
+
+
+@contextlib.asynccontextmanager
+async def inprocess_server(target: Target, workdir: Path):
+    """
+    import the app inside this process, run its lifespan and talk to it through the ASGI transport
+    """
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    import_path = import_paths(target)
+    sys.path[:0] = import_path
+    try:
+        module_name, attribute = target.app.split(":")
+        app = getattr(importlib.import_module(module_name), attribute)
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+                yield client, os.getpid()
+    finally:
+        for path in import_path:
+            sys.path.remove(path)
+        os.chdir(previous_cwd)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.asynccontextmanager
+async def uvicorn_server(target: Target, workdir: Path, workers: int, concurrency: int):
+    port = free_port()
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(import_paths(target) + [os.environ.get("PYTHONPATH", "")])}
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", target.app, "--host", "127.0.0.1", "--port", str(port),
+                                "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+                               cwd=workdir, env=env)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None, limits=limits) as client:
+            deadline = time.monotonic() + 30
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f"uvicorn exited with {process.returncode} while starting {target.app}")
+                try:
+                    (await client.get(target.ready_path)).raise_for_status()
+                    break
+                except httpx.TransportError:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"{target.app} did not start within 30 seconds")
+                    await asyncio.sleep(0.1)
+            yield client, process.pid
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+# ------------------------------
+# Running a workload
+# ------------------------------
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def run_workload(client: httpx.AsyncClient, pid: int, workload: Workload, state: dict, requests: int,
+                       duration: Optional[float], concurrency: int, seed: int) -> dict:
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    failures = 0
+    counter = itertools.count()
+    rss = {"start": rss_mb(pid)}
+    peak = [rss["start"] or 0.0]
+    deadline = time.perf_counter() + duration if duration else None
+
+    async def worker(worker_id: int) -> None:
+        nonlocal failures
+        rng = random.Random(seed * 1000 + worker_id)
+        while next(counter) < requests and (deadline is None or time.perf_counter() < deadline):
+            spec = workload(rng, state)
+            started = time.perf_counter()
+            try:
+                response = await client.request(spec.method, spec.url, **spec.kwargs)
+            except httpx.HTTPError:
+                failures += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+            if spec.on_response is not None and response.is_success:
+                spec.on_response(response)
+
+    async def sample_rss() -> None:
+        while True:
+            await asyncio.sleep(0.1)
+            peak[0] = max(peak[0], rss_mb(pid) or 0.0)
+
+    sampler = asyncio.create_task(sample_rss())
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    rss["end"] = rss_mb(pid)
+    rss["peak"] = max(peak[0], rss["end"] or 0.0) if rss["end"] is not None else None
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "failures": failures,
+        "status": dict(sorted(statuses.items())),
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p90": round(percentile(latencies, 0.90) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+        "rss_mb": rss,
+    }
+
+
+async def run_target(name: str, args, replay: Optional[List[RequestSpec]]) -> List[dict]:
+    target = TARGETS[name]
+    workloads = dict(target.workloads)
+    if replay:
+        workloads["replay"] = replay_workload(replay)
+    selected = [workload for workload in args.workloads if workload in workloads]
+    results = []
+    with tempfile.TemporaryDirectory(prefix=f"loadtest-{name}-") as workdir:
+        if args.server == "uvicorn":
+            server = uvicorn_server(target, Path(workdir), args.workers, args.concurrency)
+        else:
+            server = inprocess_server(target, Path(workdir))
+        async with server as (client, pid):
+            state = {"upload_bytes": int(args.upload_mb * 1024 * 1024)}
+            await target.setup(client, args.seed_rows, state)
+            for workload in selected:
+                result = await run_workload(client, pid, workloads[workload], state, args.requests, args.duration,
+                                            args.concurrency, args.seed)
+                result.update(target=name, workload=workload)
+                results.append(result)
+                print(f"{name:<7} {workload:<7} {result['throughput_rps']:>9.1f} req/s   p50 {result['latency_ms']['p50']:>8.2f} ms"
+                      f"   p99 {result['latency_ms']['p99']:>8.2f} ms   rss {result['rss_mb']['peak']} MB   {result['status']}")
+    return results
+
+
+# ------------------------------
+# Baseline comparison
+# ------------------------------
+def compare(results: List[dict], baseline: List[dict], threshold: float) -> List[str]:
+    """
+    print the change of throughput and p99 per target/workload, return a description of every regression
+    """
+    previous = {(result["target"], result["workload"]): result for result in baseline}
+    regressions = []
+    print(f"\n{'target':<7} {'workload':<8} {'req/s':>18} {'change':>8}   {'p99 ms':>20} {'change':>8}")
+    for result in results:
+        before = previous.get((result["target"], result["workload"]))
+        if before is None:
+            continue
+        old_rps, new_rps = before["throughput_rps"], result["throughput_rps"]
+        old_p99, new_p99 = before["latency_ms"]["p99"], result["latency_ms"]["p99"]
+        rps_change = (new_rps - old_rps) / old_rps * 100 if old_rps else 0.0
+        p99_change = (new_p99 - old_p99) / old_p99 * 100 if old_p99 else 0.0
+        flags = []
+        if rps_change < -threshold:
+            flags.append(f"throughput {rps_change:+.1f}%")
+        if p99_change > threshold:
+            flags.append(f"p99 {p99_change:+.1f}%")
+        print(f"{result['target']:<7} {result['workload']:<8} {old_rps:>8.1f} -> {new_rps:<8.1f} {rps_change:>+7.1f}%"
+              f"   {old_p99:>8.2f} -> {new_p99:<9.2f} {p99_change:>+7.1f}%   {'REGRESSION' if flags else ''}")
+        if flags:
+            regressions.append(f"{result['target']}/{result['workload']}: " + ", ".join(flags))
+    return regressions
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> int:
+    for assignment in args.env:
+        key, _, value = assignment.partition("=")
+        os.environ[key] = value
+    replay = load_replay(Path(args.replay)) if args.replay else None
+    results = []
+    for name in args.targets:
+        results.extend(await run_target(name, args, replay))
+
+    output = {
+        "meta": {"revision": git_revision(), "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                 "args": {key: value for key, value in vars(args).items()}},
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(output, indent=2))
+    print(f"\nresults written to {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, json.loads(Path(args.baseline).read_text())["results"], args.threshold)
+        if regressions:
+            print("\nregressions (more than {:.0f}%):\n  ".format(args.threshold) + "\n  ".join(regressions))
+            if args.fail_on_regression:
+                return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", nargs="+", choices=list(TARGETS), default=["main", "todos", "sqlite", "upload"])
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOAD_NAMES, default=["read", "write", "upload"])
+    parser.add_argument("--server", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per target and workload")
+    parser.add_argument("--duration", type=float, default=None, help="stop a workload after this many seconds")
+    parser.add_argument("--concurrency", type=int, default=16, help="clients sending requests at the same time")
+    parser.add_argument("--seed-rows", type=int, default=1000, help="orders / todos / items created before the workloads")
+    parser.add_argument("--upload-mb", type=float, default=8, help="size of every file of the upload workload")
+    parser.add_argument("--replay", help="an .http or .jsonl file of requests for the replay workload, e.g. test_main.http")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="environment variable for the apps")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the workloads")
+    parser.add_argument("--output", default="loadtest-results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=10, help="percent change reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 when there is a regression")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Stress test: concurrent creates and read-modify-write updates against the todo (pydantic_learn.py) and order (main.py)
+endpoints, checking that no id is handed out twice and no write is lost (see concurrency.py).
+
+Every worker process runs --clients concurrent clients against the apps in process (httpx ASGITransport, the write
+endpoints run in the threadpool like under uvicorn). With --workers > 1 the processes share the journal of
+--backend (wal or sqlite, see storage.py) like uvicorn --workers would. Each client:
+ creates:    --creates todos, and as many orders with ids of its own for one user, plus the same order_id 1 for another
+             user that every client tries to create
+ increments: --increments times "read the counter todo, write back count + 1" with the ETag as If-Match, reading
+             again on a 412, and the same with the quantity of a counter order
+Then it checks: all todo ids distinct, every created todo and order stored, order_id 1 created exactly once, and both
+counters equal to the number of successful increments. Exits with 1 if a check fails.
+--no-if-match sends the updates without If-Match, to see the lost updates that versioning prevents.
+
+The response cache is off (CACHE_BACKEND=none), the clients have to see each other's writes.
+Run it from the repository root:  python benchmarks/stress_concurrency.py --backend wal --workers 4
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+COUNTER_USER = 502
+
+
+def configure(backend: str, path: str) -> None:
+    os.environ.update(STORAGE_BACKEND=backend, STORAGE_PATH=path, CACHE_BACKEND="none")
+    sys.path.insert(0, str(ROOT))
+
+
+async def increment_todo(client: httpx.AsyncClient, todo_id: int, if_match: bool) -> int:
+    """
+    one read-modify-write of the counter todo, returns how many 412s it took
+    """
+    conflicts = 0
+    while True:
+        response = await client.get(f"/todos/{todo_id}", params={"target_todo_id": todo_id})
+        count = int(response.json()["todo_description"].split()[-1])
+        headers = {"If-Match": response.headers["etag"]} if if_match else {}
+        response = await client.put(f"/todos/update/{todo_id}", params={"target_todo_id": todo_id}, headers=headers,
+                                    json={"todo_description": f"count {count + 1}"})
+        if response.status_code != 412:
+            response.raise_for_status()
+            return conflicts
+        conflicts += 1
+
+
+async def increment_order(client: httpx.AsyncClient, if_match: bool) -> int:
+    conflicts = 0
+    while True:
+        response = await client.get(f"/users/{COUNTER_USER}/")
+        order = response.json()["results"][0]
+        headers = {"If-Match": f'"{order["version"]}"'} if if_match else {}
+        response = await client.put(f"/update_order/{COUNTER_USER}/1", headers=headers,
+                                    json={"quantity": order["quantity"] + 1})
+        if response.status_code != 412:
+            response.raise_for_status()
+            return conflicts
+        conflicts += 1
+
+
+async def run_clients(worker: int, clients: int, creates: int, increments: int, counter_id: int, if_match: bool) -> dict:
+    import main
+    import pydantic_learn
+
+    async def client_run(number: int) -> dict:
+        todo_ids, conflicts, won_order = [], 0, False
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=pydantic_learn.app), base_url="http://todos") as todos, \
+                httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://main") as orders:
+            for i in range(creates):
+                response = await todos.post("/todos/create", json={"todo_name": f"w{worker} c{number} #{i}",
+                                                                   "todo_description": "stress test todo"})
+                todo_ids.append(response.json()["todo"]["todo_id"])
+                await orders.post("/create_order/500", json={"order_id": (worker * 1000 + number) * 100000 + i,
+                                                            "item": "Stress", "quantity": 1, "price": 1.0})
+            response = await orders.post("/create_order/501", json={"order_id": 1, "item": "Contended", "quantity": 1, "price": 1.0})
+            won_order = "error" not in response.json()
+            for _ in range(increments):
+                conflicts += await increment_todo(todos, counter_id, if_match)
+                conflicts += await increment_order(orders, if_match)
+        return {"todo_ids": todo_ids, "conflicts": conflicts, "won_order": won_order}
+
+    results = await asyncio.gather(*(client_run(number) for number in range(clients)))
+    return {"todo_ids": [todo_id for result in results for todo_id in result["todo_ids"]],
+            "conflicts": sum(result["conflicts"] for result in results),
+            "won_orders": sum(result["won_order"] for result in results)}
+
+
+def worker_main(worker: int, args: argparse.Namespace, path: str, counter_id: int, queue) -> None:
+    configure(args.backend, path)
+    queue.put(asyncio.run(run_clients(worker, args.clients, args.creates, args.increments, counter_id, not args.no_if_match)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["memory", "wal", "sqlite"], default="memory", help="STORAGE_BACKEND")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes sharing the journal, needs wal or sqlite")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients per worker")
+    parser.add_argument("--creates", type=int, default=50, help="todos and orders created per client")
+    parser.add_argument("--increments", type=int, default=10, help="counter increments per client")
+    parser.add_argument("--no-if-match", action="store_true", help="update without If-Match (expect lost updates)")
+    args = parser.parse_args()
+    if args.workers > 1 and args.backend == "memory":
+        parser.error("--workers > 1 needs a shared journal: --backend wal or sqlite")
+
+    with tempfile.TemporaryDirectory() as path:
+        configure(args.backend, path)
+        import pydantic_learn
+        import main as orders_app
+        todo_storage, order_storage = pydantic_learn.app.state.todo_storage, orders_app.app.state.order_storage
+        # the counters exist before the clients start, with several workers they find them in the journal
+        counter = todo_storage.execute("create", todo={"todo_name": "counter", "todo_description": "count 0"})
+        order_storage.execute("add", user_id=COUNTER_USER, order={"order_id": 1, "item": "Counter", "quantity": 0, "price": 1.0})
+        started = time.perf_counter()
+        if args.workers == 1:
+            results = [asyncio.run(run_clients(0, args.clients, args.creates, args.increments, counter.todo_id, not args.no_if_match))]
+        else:
+            context = multiprocessing.get_context("spawn")
+            queue = context.Queue()
+            processes = [context.Process(target=worker_main, args=(worker, args, path, counter.todo_id, queue))
+                         for worker in range(args.workers)]
+            for process in processes:
+                process.start()
+            results = [queue.get() for _ in processes]
+            for process in processes:
+                process.join()
+        elapsed = time.perf_counter() - started
+
+        # catch up with what the workers wrote
+        todo_storage.sync()
+        order_storage.sync()
+        todo_ids = [todo_id for result in results for todo_id in result["todo_ids"]]
+        clients = args.workers * args.clients
+        expected_increments = clients * args.increments
+        stored_ids = {todo.todo_id for todo in todo_storage.store}
+        checks = {
+            "todo ids are unique": len(set(todo_ids)) == len(todo_ids),
+            "every created todo is stored": set(todo_ids) <= stored_ids,
+            "every created order is stored": len(order_storage.store[500]) == clients * args.creates,
+            "contended order created exactly once": sum(result["won_orders"] for result in results) == 1
+                                                    and len(order_storage.store[501]) == 1,
+            "no lost todo increment": todo_storage.store.get(counter.todo_id).todo_description == f"count {expected_increments}",
+            "no lost order increment": order_storage.store[COUNTER_USER].get(1)["quantity"] == expected_increments,
+        }
+
+    print(f"{args.backend}, {args.workers} worker(s) x {args.clients} clients, {elapsed:.1f} s: "
+          f"{len(todo_ids)} todos created, {expected_increments} increments of each counter, "
+          f"{sum(result['conflicts'] for result in results)} retried after a 412")
+    print(f"todo counter: {todo_storage.store.get(counter.todo_id).todo_description}, "
+          f"order counter: {order_storage.store[COUNTER_USER].get(1)['quantity']}")
+    for name, passed in checks.items():
+        print(f"  {'ok  ' if passed else 'FAIL'} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
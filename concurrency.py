@@ -0,0 +1,93 @@
+"""
+Concurrency control for the todo and order stores (pydantic_learn.py, main.py, see storage.py for the journal).
+
+Since the write endpoints are plain def they run in the threadpool, several at a time, next to the reads. What keeps
+them from stepping on each other:
+ - Every change runs inside DurableStore.execute(), under the store's lock and the journal's cross-process lock.
+   The check and the change of a command happen together there: a new todo_id comes from TodoStore.next_id() and the
+   duplicate order_id check of create_order is made on the latest data, in this process and across workers.
+ - Readers take a KeyedLocks lock for what they read, DurableStore.apply() takes the same one: one lock per user for
+   the orders, so a read of user 101's orders only waits for changes to user 101, one lock for the whole todo table,
+   because GET /todos reads all of it.
+ - Changes are copy-on-write: an update stores a new Todo / order dict instead of changing the one a reader may still
+   be serialising.
+ - Optimistic versioning: every todo and order has a version, bumped by each update, sent as the ETag. A PUT or DELETE
+   with If-Match only goes through if the version is still the one the client has seen, otherwise it gets a
+   412 Precondition Failed and has to read again, instead of silently overwriting what another client wrote.
+   The version check is part of the command, so it is decided under the same locks as the change.
+"""
+
+import threading
+from contextlib import contextmanager
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional
+
+from fastapi import HTTPException
+
+
+class KeyedLocks:
+    """
+    One lock per key, created when it is first needed and dropped again when nobody holds or waits for it,
+    so a lock per user doesn't keep one lock per user ever seen.
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks: Dict[Hashable, list] = {}  # key -> [lock, holders + waiters]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @contextmanager
+    def hold(self, key: Hashable) -> Iterator[None]:
+        with self._guard:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+class VersionConflict(Exception):
+    """
+    The version a change was conditioned on (If-Match) is not the current one.
+    """
+
+    def __init__(self, current: Optional[int]):
+        super().__init__(f"current version is {current}")
+        self.current = current
+
+
+def format_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def parse_if_match(if_match: Optional[str]) -> Optional[List[int]]:
+    """
+    the versions an If-Match header accepts, None when it doesn't restrict anything (no header, or *).
+    Weak ETags (W/"...") never match, If-Match uses the strong comparison.
+    """
+    if if_match is None or if_match.strip() == "*":
+        return None
+    versions = []
+    for tag in if_match.split(","):
+        tag = tag.strip()
+        if tag.startswith('"') and tag.endswith('"') and tag[1:-1].isdigit():
+            versions.append(int(tag[1:-1]))
+    return versions
+
+
+def check_version(current: int, expected: Optional[Iterable[int]]) -> None:
+    if expected is not None and current not in expected:
+        raise VersionConflict(current)
+
+
+def precondition_failed(conflict: VersionConflict) -> HTTPException:
+    headers = {"ETag": format_etag(conflict.current)} if conflict.current is not None else None
+    return HTTPException(status_code=412, detail="The resource was changed since it was read (If-Match)", headers=headers)
@@ -0,0 +1,386 @@
+"""
+Engine factory for the SQLModel apps (sqlmodel_learn.py and superbase_learn.py).
+
+- DatabaseSettings: every engine/pool knob in one place, read from DB_* environment variables.
+- create_engines(): builds the sync engine and (when the driver is installed) the async engine from the settings.
+- warm_up() / dispose(): the startup and shutdown halves of the apps' lifespan.
+- Database: an app's engines, created on first use, and its startup work (schema check, warm-up) run in the background.
+- ensure_schema(): creates the schema only when the version stored in the database doesn't match the code's.
+- pool metrics: checkout wait time and pool usage of every engine created here, exported on GET /metrics.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Iterable, Optional, Tuple, List
+from pydantic import BaseModel, Field
+from sqlalchemy import Column, MetaData, String, Table, delete, insert, select
+from sqlalchemy.engine import Dialect, Engine, make_url
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlmodel import create_engine
+
+from instrumentation import instrument_engine
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseSettings(BaseModel):
+    """
+    Engine and connection pool settings. Every field can be overridden with an environment variable named
+    DB_<FIELD NAME>, e.g. DB_POOL_SIZE=20 or DB_ECHO=true.
+    """
+    url: str = Field(..., description="sync SQLAlchemy database url, the async url is derived from it")
+    echo: bool = Field(default=False, description="log every SQL statement, only for debugging")
+    use_async: bool = Field(default=True, description="also create the async engine (aiosqlite/asyncpg) if the driver is installed")
+    pool_size: int = Field(default=5, ge=1, description="connections kept open in the pool")
+    max_overflow: int = Field(default=10, ge=0, description="extra connections allowed above pool_size under load")
+    pool_timeout: float = Field(default=30, gt=0, description="seconds to wait for a free connection before giving up")
+    pool_pre_ping: bool = Field(default=True, description="test connections on checkout, drops the ones the server closed")
+    pool_recycle: int = Field(default=1800, description="seconds after which a connection is replaced, -1 to never recycle")
+    statement_timeout_ms: Optional[int] = Field(default=None, gt=0, description="abort statements running longer than this")
+    warm_connections: int = Field(default=1, ge=0, description="connections opened at startup so the first requests don't pay for it")
+    prepared_statement_cache_size: int = Field(default=100, ge=0, description="Postgres: statements kept prepared on the server "
+                                               "per connection (asyncpg / psycopg 3), 0 behind pgbouncer in transaction mode")
+
+    @classmethod
+    def from_env(cls, url: str, prefix: str = "DB_", **overrides) -> "DatabaseSettings":
+        values = {}
+        for name in cls.model_fields:
+            env_value = os.getenv(prefix + name.upper())
+            if env_value is not None:
+                values[name] = env_value
+        values.setdefault("url", url)
+        values.update(overrides)
+        return cls(**values)
+
+
+# ------------------------------
+# Pool metrics
+# ------------------------------
+# SQLAlchemy has no event for "started waiting for a connection", so the pools below time Pool.connect() themselves.
+# The label is the pool's logging name, which SQLAlchemy carries over when dispose() recreates the pool.
+# The usage gauges are read straight from the pools at scrape time.
+# ------------------------------
+POOL_CHECKOUT_WAIT = REGISTRY.histogram(
+    "db_pool_checkout_wait_seconds", "Time spent waiting for a connection from the pool", ["pool"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+POOL_CHECKOUT_TIMEOUTS = REGISTRY.counter(
+    "db_pool_checkout_timeouts_total", "Checkouts that gave up after pool_timeout seconds", ["pool"])
+
+_engines: List[Tuple[str, Engine]] = []
+
+def _pool_stats(stat: str):
+    def collect():
+        for name, engine in list(_engines):
+            pool = engine.pool
+            if isinstance(pool, QueuePool):
+                yield (name,), getattr(pool, stat)()
+    return collect
+
+REGISTRY.gauge("db_pool_checked_out", "Connections currently in use", ["pool"], callback=_pool_stats("checkedout"))
+REGISTRY.gauge("db_pool_checked_in", "Idle connections in the pool", ["pool"], callback=_pool_stats("checkedin"))
+REGISTRY.gauge("db_pool_overflow", "Connections open above pool_size (negative: pool not full yet)", ["pool"], callback=_pool_stats("overflow"))
+REGISTRY.gauge("db_pool_size", "Configured pool size", ["pool"], callback=_pool_stats("size"))
+
+
+class _TimedPoolMixin:
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            POOL_CHECKOUT_TIMEOUTS.inc(pool=self.logging_name)
+            raise
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started, pool=self.logging_name)
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+class TimedAsyncAdaptedQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+# ------------------------------
+# Engine factory
+# ------------------------------
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+def async_url(url: str) -> str:
+    """
+    turn a sync database url into the same url with the async driver, e.g. sqlite:///database.db -> sqlite+aiosqlite:///database.db
+    """
+    parsed = make_url(url)
+    return parsed.set(drivername=ASYNC_DRIVERS[parsed.get_backend_name()]).render_as_string(hide_password=False)
+
+
+def _connect_args(backend: str, driver: str, driver_async: bool, settings: DatabaseSettings) -> dict:
+    """
+    driver specific connect arguments for the statement timeout and server side prepared statements
+    """
+    args = {}
+    if backend == "postgresql":
+        # Postgres parses and plans a prepared statement once per connection, the statement cache of item_service.py
+        # sends the same SQL for every request of a shape. Supabase's pooler (port 6543) runs pgbouncer in transaction
+        # mode, which can't keep statements prepared: set DB_PREPARED_STATEMENT_CACHE_SIZE=0 there.
+        if driver_async:  # asyncpg
+            args["prepared_statement_cache_size"] = settings.prepared_statement_cache_size
+            if not settings.prepared_statement_cache_size:
+                args["statement_cache_size"] = 0
+        elif driver == "psycopg":  # psycopg 3 prepares a statement after it has run prepare_threshold times
+            args["prepare_threshold"] = 5 if settings.prepared_statement_cache_size else None
+        # psycopg2 has no server side prepared statements
+    if settings.statement_timeout_ms is None:
+        return args
+    if backend == "postgresql":
+        if driver_async:  # asyncpg
+            args["server_settings"] = {"statement_timeout": str(settings.statement_timeout_ms)}
+        else:  # psycopg2 / psycopg 3
+            args["options"] = f"-c statement_timeout={settings.statement_timeout_ms}"
+    elif backend == "sqlite":
+        # SQLite can't limit how long a statement runs, the closest thing is how long it waits for a locked database
+        args["timeout"] = settings.statement_timeout_ms / 1000
+    return args
+
+
+def _engine_kwargs(url: str, driver_async: bool, settings: DatabaseSettings, pool_name: str) -> dict:
+    parsed = make_url(url)
+    kwargs = {"echo": settings.echo,
+              "connect_args": _connect_args(parsed.get_backend_name(), parsed.get_driver_name(), driver_async, settings)}
+    # an in-memory SQLite database lives in a single connection, there is nothing to pool
+    if parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:"):
+        return kwargs
+    kwargs.update(
+        poolclass=TimedAsyncAdaptedQueuePool if driver_async else TimedQueuePool,
+        pool_size=settings.pool_size,
+        max_overflow=settings.max_overflow,
+        pool_timeout=settings.pool_timeout,
+        pool_pre_ping=settings.pool_pre_ping,
+        pool_recycle=settings.pool_recycle,
+        pool_logging_name=pool_name,
+    )
+    return kwargs
+
+
+def create_async_engine_or_none(url: str, **kwargs) -> Optional[AsyncEngine]:
+    """
+    create the async engine for a sync database url, or return None (= use the sync fallback) if the async driver is missing
+    """
+    try:
+        return create_async_engine(async_url(url), **kwargs)
+    except (ImportError, KeyError) as error:
+        logger.warning("async database driver not available for %s (%s), using the sync engine in the threadpool", url, error)
+        return None
+
+
+def create_engines(settings: DatabaseSettings, name: str = "db") -> Tuple[Engine, Optional[AsyncEngine]]:
+    """
+    build the sync engine and, if settings.use_async and the driver is installed, the async engine.
+    :param name: label of the pools in the metrics, the async pool is reported as <name>_async
+    """
+    engine = create_engine(settings.url, **_engine_kwargs(settings.url, False, settings, name))
+    _engines.append((name, engine))
+    # DB time per request, see instrumentation.py
+    instrument_engine(engine)
+    async_engine = None
+    if settings.use_async:
+        async_engine = create_async_engine_or_none(settings.url, **_engine_kwargs(settings.url, True, settings, f"{name}_async"))
+        if async_engine is not None:
+            _engines.append((f"{name}_async", async_engine.sync_engine))
+            instrument_engine(async_engine.sync_engine)
+    return engine, async_engine
+
+
+async def warm_up(engine: Engine, async_engine: Optional[AsyncEngine], connections: int) -> None:
+    """
+    open `connections` connections up front and put them back in the pool, so the first requests after a (re)start
+    don't have to pay for the TCP + TLS + auth handshake. Only the engine the endpoints actually use is warmed.
+    """
+    if connections <= 0:
+        return
+    if async_engine is not None:
+        opened = await asyncio.gather(*(async_engine.connect() for _ in range(connections)))
+        for connection in opened:
+            await connection.close()
+    else:
+        def warm_sync():
+            opened = [engine.connect() for _ in range(connections)]
+            for connection in opened:
+                connection.close()
+        await asyncio.to_thread(warm_sync)
+
+
+async def dispose(engine: Engine, async_engine: Optional[AsyncEngine]) -> None:
+    """
+    close every pooled connection, called when the app shuts down
+    """
+    if async_engine is not None:
+        await async_engine.dispose()
+    engine.dispose()
+
+
+# ------------------------------
+# Lazy engines and startup
+# ------------------------------
+# Creating the engines imports the database drivers (asyncpg, psycopg, aiosqlite), and the startup work talks to the
+# database: checking the schema and opening the warm connections are round trips to Supabase, with a TLS handshake
+# each. None of it has to happen before the app can start: the app is up as soon as its lifespan has scheduled the
+# startup work, and only the requests that use the database wait for it (GET /metrics, health checks don't).
+# ------------------------------
+class Database:
+    """
+    The engines of one app, created on first use from `settings`, and the work to do once before the first query.
+    :param prepare: run once in a worker thread with the sync engine before the first query, e.g. creating the schema
+    """
+
+    def __init__(self, settings: Optional[DatabaseSettings], name: str = "db",
+                 prepare: Optional[Callable[[Engine], Any]] = None):
+        self.settings = settings
+        self.name = name
+        self.prepare = prepare
+        self.is_ready = False
+        self._engines: Optional[Tuple[Engine, Optional[AsyncEngine]]] = None
+        self._lock = threading.Lock()
+        self._startup: Optional[asyncio.Future] = None
+
+    @classmethod
+    def from_engines(cls, engine: Engine, async_engine: Optional[AsyncEngine] = None, name: str = "db") -> "Database":
+        """
+        wrap engines created elsewhere (benchmarks with their own engines), there is nothing to prepare
+        """
+        database = cls(None, name)
+        database._engines = (engine, async_engine)
+        return database
+
+    @property
+    def engines(self) -> Tuple[Engine, Optional[AsyncEngine]]:
+        if self._engines is None:
+            # the sync endpoints run in the threadpool, two of them may come here at the same time
+            with self._lock:
+                if self._engines is None:
+                    self._engines = create_engines(self.settings, self.name)
+        return self._engines
+
+    @property
+    def engine(self) -> Engine:
+        return self.engines[0]
+
+    @property
+    def async_engine(self) -> Optional[AsyncEngine]:
+        return self.engines[1]
+
+    def start(self) -> None:
+        """
+        schedule the startup work (engines, prepare, warm-up) on the running event loop, called by the app's lifespan
+        """
+        if self._startup is None:
+            self._startup = asyncio.ensure_future(self._start())
+
+    async def _start(self) -> None:
+        started = time.perf_counter()
+        engine, async_engine = await asyncio.to_thread(lambda: self.engines)
+        if self.prepare is not None:
+            await asyncio.to_thread(self.prepare, engine)
+        self.is_ready = True
+        if self.settings is not None:
+            try:
+                await warm_up(engine, async_engine, min(self.settings.warm_connections, self.settings.pool_size))
+            except (SQLAlchemyError, OSError) as error:
+                # not fatal: the pool opens its connections on demand
+                logger.warning("warming up the %s pool failed: %s", self.name, error)
+        logger.info("%s database ready in %.0f ms", self.name, (time.perf_counter() - started) * 1000)
+
+    async def ready(self) -> None:
+        """
+        wait until the database can be queried: the startup work has finished, or is started now if it hasn't been.
+        If it failed (the database was unreachable), it is tried again for the next request.
+        """
+        if self.is_ready:
+            return
+        if self._startup is not None and self._startup.done() and (self._startup.cancelled() or self._startup.exception()):
+            self._startup = None
+        self.start()
+        # shielded: a request whose client goes away doesn't cancel the startup the other requests wait for
+        await asyncio.shield(self._startup)
+
+    async def dispose(self) -> None:
+        """
+        stop the startup work if it is still running and close every pooled connection, called when the app shuts down
+        """
+        if self._startup is not None and not self._startup.done():
+            self._startup.cancel()
+        if self._engines is not None:
+            await dispose(*self._engines)
+
+
+# ------------------------------
+# Schema version
+# ------------------------------
+# create_all() asks the database about every table before creating it, create_search_indexes() about every index.
+# Over the network that is a round trip each, on every start of every worker, to find out that nothing has changed.
+# Instead, the schema's version (a hash of its DDL on the database's dialect) is stored in the schema_version table
+# once the schema has been created, and the next starts only read that one row. A table dropped by hand is not noticed:
+# call forget_schema() (or delete the row) along with it, the next start then creates the schema again.
+# ------------------------------
+SCHEMA_VERSION_TABLE = Table(
+    "schema_version", MetaData(),
+    Column("name", String(64), primary_key=True),
+    Column("version", String(64), nullable=False),
+    Column("state", String(64), nullable=True),  # what create() reported, e.g. which optional structures exist
+)
+
+
+def schema_version(tables: Iterable[Table], dialect: Dialect, revision: str = "") -> str:
+    """
+    hash of the CREATE TABLE / CREATE INDEX statements of `tables` on `dialect`.
+    :param revision: bumped by hand for the schema objects created with raw SQL, which the DDL doesn't show
+    """
+    digest = hashlib.sha256(revision.encode())
+    for table in tables:
+        digest.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name or ""):
+            digest.update(str(CreateIndex(index).compile(dialect=dialect)).encode())
+    return digest.hexdigest()[:32]
+
+
+def ensure_schema(engine: Engine, name: str, version: str, create: Callable[[Engine], Optional[str]]) -> Optional[str]:
+    """
+    run create(engine) unless `version` is the version stored for `name`, then store it. Returns the state create()
+    returned, now or when it last ran. Blocking.
+    """
+    try:
+        with engine.connect() as connection:
+            row = connection.execute(select(SCHEMA_VERSION_TABLE.c.version, SCHEMA_VERSION_TABLE.c.state)
+                                     .where(SCHEMA_VERSION_TABLE.c.name == name)).first()
+    except SQLAlchemyError:
+        row = None  # no schema_version table yet
+    if row is not None and row.version == version:
+        logger.debug("schema %s is at version %s, nothing to create", name, version)
+        return row.state
+    state = create(engine)
+    try:
+        with engine.begin() as connection:
+            SCHEMA_VERSION_TABLE.create(connection, checkfirst=True)
+            connection.execute(delete(SCHEMA_VERSION_TABLE).where(SCHEMA_VERSION_TABLE.c.name == name))
+            connection.execute(insert(SCHEMA_VERSION_TABLE).values(name=name, version=version, state=state))
+    except IntegrityError:
+        # another worker starting at the same time has just stored it
+        return state
+    logger.info("schema %s created or updated to version %s", name, version)
+    return state
+
+
+def forget_schema(engine: Engine, name: str) -> None:
+    """
+    delete the stored version of `name`, so the next ensure_schema() runs create() again. Blocking.
+    """
+    with engine.begin() as connection:
+        SCHEMA_VERSION_TABLE.create(connection, checkfirst=True)
+        connection.execute(delete(SCHEMA_VERSION_TABLE).where(SCHEMA_VERSION_TABLE.c.name == name))
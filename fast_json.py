@@ -0,0 +1,103 @@
+"""
+Opt-in fast JSON responses.
+
+What FastAPI normally does with the return value of an endpoint:
+ 1. validate it against the response_model (or the return annotation): every model is checked field by field again,
+    a `Todo | dict` union is tried member by member
+ 2. jsonable_encoder() turns the validated result into plain dicts/lists, one Python object per value
+ 3. json.dumps() turns that into text, JSONResponse encodes it to bytes
+For data the handler just read from our own store or database the first two steps re-check what is already known
+to be valid, and they cost more CPU than the serialisation itself.
+
+@fast_json makes the endpoint return a Response with the bytes serialised in one go by pydantic-core:
+a TypeAdapter for the endpoint's return annotation (built once, when the endpoint is decorated), whose dump_json()
+writes the models straight to JSON. FastAPI sees a Response and sends it as is, no validation, no jsonable_encoder.
+Plain dicts/lists without a useful annotation (e.g. the order endpoints of main.py) go through orjson when it is
+installed. The response_model stays on the route, so /docs doesn't change.
+
+    @app.get("/todos")
+    @fast_json
+    def get_todos(...) -> List[Todo]: ...
+
+Only use it on endpoints that return their declared type: nothing checks the value on the way out anymore.
+A Response returned by the endpoint (e.g. a StreamingResponse) is passed through untouched, and headers or a status
+code set on the injected `response: Response` parameter are copied onto the fast response.
+"""
+
+import functools
+import inspect
+from typing import Any, Callable, Optional
+
+from fastapi import Response
+from pydantic import TypeAdapter
+
+try:
+    import orjson
+except ImportError:  # optional, pydantic-core serialises plain data too, just a little slower
+    orjson = None
+
+_any_adapter = TypeAdapter(Any)
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+
+def dumps(content: Any, adapter: Optional[TypeAdapter] = None) -> bytes:
+    """
+    serialise `content` to JSON bytes, with `adapter` if given (pydantic types), else orjson / pydantic-core
+    """
+    if adapter is not None:
+        return adapter.dump_json(content)
+    if orjson is not None:
+        try:
+            return orjson.dumps(content)
+        except TypeError:
+            # models, enums in dict keys, ... : let pydantic-core handle whatever orjson doesn't know
+            pass
+    return _any_adapter.dump_json(content)
+
+
+def _adapter_for(endpoint: Callable) -> Optional[TypeAdapter]:
+    annotation = inspect.signature(endpoint).return_annotation
+    if annotation in (inspect.Signature.empty, None, dict, list, Any):
+        return None
+    try:
+        return TypeAdapter(annotation)
+    except Exception:
+        # not something pydantic can describe (e.g. `-> Response`), fall back to orjson for this endpoint
+        return None
+
+
+def _to_response(content: Any, adapter: Optional[TypeAdapter], kwargs: dict) -> Response:
+    if isinstance(content, Response):
+        return content
+    response = FastJSONResponse(dumps(content, adapter))
+    # FastAPI merges the injected `response: Response` into responses it builds, but not into one we return
+    for value in kwargs.values():
+        if isinstance(value, Response):
+            for name, header in value.headers.items():
+                if name != "content-length":
+                    response.headers[name] = header
+            if value.status_code is not None:
+                response.status_code = value.status_code
+    return response
+
+
+def fast_json(endpoint: Callable) -> Callable:
+    """
+    serialise the endpoint's return value straight to JSON bytes, skipping response validation and jsonable_encoder.
+    Put it below the @app.get(...) decorator.
+    """
+    adapter = _adapter_for(endpoint)
+
+    # keep the endpoint sync or async as it was: FastAPI runs sync endpoints in the threadpool
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            return _to_response(await endpoint(*args, **kwargs), adapter, kwargs)
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            return _to_response(endpoint(*args, **kwargs), adapter, kwargs)
+    return wrapper
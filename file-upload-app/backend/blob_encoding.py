@@ -0,0 +1,126 @@
+"""
+Compressed storage of the uploaded files: BLOB_COMPRESSION=auto (or gzip / zstd) stores compressible uploads
+compressed in the BlobStore, BLOB_COMPRESSION=off (the default) stores every file as it is.
+
+ - The decision is made per file, on its first chunk, before anything is written: the content type is sniffed from
+   the magic bytes (content_types.py) and formats that are compressed already (images, archives, audio / video, PDF)
+   are stored raw. Content nobody recognises (application/octet-stream) is compressed only if a fast trial compression
+   of the first SAMPLE_BYTES saves at least 10%. Files under min_size are not worth it either.
+ - The file is compressed while it streams to disk (upload_storage.TempUpload), chunk by chunk: memory stays at one
+   chunk, and the hashing / compression run in the same worker thread pass. A resumable upload (resumable_upload.py)
+   arrives raw, in pieces, and goes through a TempUpload when it is finalized.
+ - A compressed blob is stored next to where the raw one would be, with the suffix of its encoding
+   (.blobs/ab/cd/abcd1234....gz / .zst): the file says how to read it, old raw blobs stay readable, and the SHA-256 is
+   still the one of the original content, so deduplication and ETags don't change.
+ - Reading back is transparent: open_blob() decompresses on the fly. GET /files/{name} sends the stored bytes as they
+   are, with Content-Encoding, to a client that accepts the encoding (file_download.py), and decompresses for others.
+zstd needs the optional zstandard package (see response_compression.py), auto means zstd when it is installed and
+gzip otherwise. Stored vs original bytes are exported on GET /metrics (blob_compression_bytes_total).
+"""
+
+import gzip
+import logging
+import os
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+from content_types import COMPRESSED_TYPES, SNIFF_BYTES, sniff_content_type
+from metrics import REGISTRY
+from response_compression import ENCODINGS, zstandard
+
+logger = logging.getLogger(__name__)
+
+ENCODING_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+SAMPLE_BYTES = 64 * 1024
+MAX_SAMPLE_RATIO = 0.9
+
+BLOB_COMPRESSION_BYTES = REGISTRY.counter(
+    "blob_compression_bytes_total", "Uploads stored compressed: bytes received (original) and written (stored)",
+    ["encoding", "stage"])
+
+
+class BlobCompressionSettings(BaseModel):
+    """
+    Every field can be overridden with an environment variable named BLOB_<FIELD NAME>, e.g. BLOB_COMPRESSION=auto.
+    """
+    compression: Literal["off", "auto", "gzip", "zstd"] = Field(default="off", description="how compressible uploads are stored")
+    level: Optional[int] = Field(default=None, ge=1, le=22, description="compression level, the encoding's default when not set")
+    min_size: int = Field(default=4096, ge=0, description="smaller files are stored raw")
+
+    @classmethod
+    def from_env(cls, prefix: str = "BLOB_", **overrides) -> "BlobCompressionSettings":
+        values = {}
+        for name in cls.model_fields:
+            env_value = os.getenv(prefix + name.upper())
+            if env_value is not None:
+                values[name] = env_value
+        values.update(overrides)
+        return cls(**values)
+
+    @property
+    def encoding(self) -> Optional[str]:
+        if self.compression == "off":
+            return None
+        if self.compression == "auto":
+            return ENCODINGS[0]
+        if self.compression not in ENCODINGS:
+            logger.warning("BLOB_COMPRESSION=%s needs the zstandard package, storing gzip instead", self.compression)
+            return "gzip"
+        return self.compression
+
+
+def choose_encoding(head: bytes, size: int, settings: BlobCompressionSettings) -> Optional[str]:
+    """
+    the encoding to store a file in from its first bytes (at least `size` bytes long), None to store it raw
+    """
+    encoding = settings.encoding
+    if encoding is None or size < settings.min_size:
+        return None
+    # the sniffer looks at a sample of SNIFF_BYTES, as it does for the sniff job: a longer one would be taken for the
+    # whole file
+    content_type = sniff_content_type(head[:SNIFF_BYTES])
+    if content_type in COMPRESSED_TYPES:
+        return None
+    if content_type == "application/octet-stream":
+        sample = head[:SAMPLE_BYTES]
+        if len(zlib.compress(sample, 1)) > len(sample) * MAX_SAMPLE_RATIO:
+            return None
+    return encoding
+
+
+def encoding_of(path: Path) -> Optional[str]:
+    for encoding, suffix in ENCODING_SUFFIXES.items():
+        if path.name.endswith(suffix):
+            return encoding
+    return None
+
+
+def open_blob(path: Path) -> BinaryIO:
+    """
+    open a stored blob for reading its original content, whatever it is stored as. Blocking.
+    gzip blobs can seek (forward seeks decompress up to the position), zstd ones only read.
+    """
+    encoding = encoding_of(Path(path))
+    if encoding == "gzip":
+        return gzip.open(path, "rb")
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError(f"{path} is stored with zstd, install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+
+def original_size(path: Path) -> int:
+    """
+    the size of a blob's original content. For a compressed blob that means decompressing all of it. Blocking.
+    """
+    if encoding_of(Path(path)) is None:
+        return os.path.getsize(path)
+    size = 0
+    with open_blob(path) as file:
+        while data := file.read(1024 * 1024):
+            size += len(data)
+    return size
@@ -0,0 +1,171 @@
+"""
+Content-addressed storage for the uploaded files.
+
+Instead of writing every upload to UPLOAD_DIR/<filename>, the bytes are stored once per distinct content:
+
+    UPLOAD_DIR/.blobs/ab/cd/abcd1234...   the file content, named after its SHA-256 (two prefix levels keep directories small)
+    UPLOAD_DIR/.index.sqlite3              logical file name -> sha256, size, content type
+
+Uploading the same bytes again (under any name) doesn't write a second copy, the temp file is dropped and only the
+index changes. With BLOB_COMPRESSION set a blob can also be stored compressed, as <sha256>.gz / <sha256>.zst (see
+blob_encoding.py): find_blob() returns where it is and how it is encoded. Two uploads with the same name no longer overwrite each other's bytes on disk either: the name is
+re-pointed to the new blob, and a blob is deleted once no name refers to it anymore.
+
+All methods are blocking (file system + sqlite3), the async endpoints call them through anyio.to_thread.
+The index is a SQLite database in WAL mode, so several uvicorn workers can share it.
+"""
+
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from blob_encoding import ENCODING_SUFFIXES, BlobCompressionSettings, original_size
+
+BLOBS_DIR_NAME = ".blobs"
+INDEX_FILE_NAME = ".index.sqlite3"
+
+
+@dataclass
+class FileRecord:
+    name: str
+    sha256: str
+    size: int
+    content_type: Optional[str]
+    updated_at: float
+
+
+@dataclass
+class PutResult:
+    record: FileRecord
+    deduplicated: bool  # True when the content was already stored and nothing new was written
+
+
+class BlobStore:
+    def __init__(self, root: Path, compression: Optional[BlobCompressionSettings] = None):
+        self.root = root
+        # how new uploads are stored (BLOB_* environment variables when not given), the store reads every encoding
+        self.compression = compression or BlobCompressionSettings.from_env()
+        self.blobs = root / BLOBS_DIR_NAME
+        self.index_path = root / INDEX_FILE_NAME
+        self._initialised = False
+
+    def blob_path(self, sha256: str, encoding: Optional[str] = None) -> Path:
+        path = self.blobs / sha256[:2] / sha256[2:4] / sha256
+        return path.with_name(sha256 + ENCODING_SUFFIXES[encoding]) if encoding else path
+
+    def find_blob(self, sha256: str) -> Optional[Tuple[Path, Optional[str]]]:
+        """
+        (path, encoding) of the stored content, encoding None for a raw blob. None if the content isn't stored.
+        """
+        for encoding in (None, *ENCODING_SUFFIXES):
+            path = self.blob_path(sha256, encoding)
+            if path.exists():
+                return path, encoding
+        return None
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        if not self._initialised:
+            self.root.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+        try:
+            if not self._initialised:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                    name TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL,
+                    content_type TEXT, updated_at REAL NOT NULL)""")
+                connection.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+                self._initialised = True
+            yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def _write_transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        BEGIN IMMEDIATE takes the write lock up front: moving a blob into place and deleting an unreferenced one
+        happen while it is held, so one upload can't delete a blob another upload is just linking to.
+        """
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def _link(self, connection: sqlite3.Connection, name: str, sha256: str, size: int,
+              content_type: Optional[str]) -> FileRecord:
+        previous = connection.execute("SELECT sha256 FROM files WHERE name = ?", (name,)).fetchone()
+        record = FileRecord(name, sha256, size, content_type, time.time())
+        connection.execute("INSERT OR REPLACE INTO files (name, sha256, size, content_type, updated_at) VALUES (?, ?, ?, ?, ?)",
+                           (record.name, record.sha256, record.size, record.content_type, record.updated_at))
+        if previous and previous[0] != sha256:
+            self._drop_if_unreferenced(connection, previous[0])
+        return record
+
+    def _drop_if_unreferenced(self, connection: sqlite3.Connection, sha256: str) -> None:
+        if connection.execute("SELECT 1 FROM files WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone() is None:
+            for encoding in (None, *ENCODING_SUFFIXES):
+                self.blob_path(sha256, encoding).unlink(missing_ok=True)
+
+    def put(self, temp_path: Path, sha256: str, name: str, size: int, content_type: Optional[str],
+            encoding: Optional[str] = None) -> PutResult:
+        """
+        store a finished (fsync'ed) temp file under its hash and point `name` at it.
+        If the blob already exists (in any encoding) the temp file is just deleted.
+        :param size: size of the original content
+        :param encoding: the temp file holds the content compressed with this encoding, see blob_encoding.py
+        """
+        blob = self.blob_path(sha256, encoding)
+        with self._write_transaction() as connection:
+            deduplicated = self.find_blob(sha256) is not None
+            if deduplicated:
+                temp_path.unlink(missing_ok=True)
+            else:
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(temp_path, blob)
+            return PutResult(self._link(connection, name, sha256, size, content_type), deduplicated)
+
+    def link_existing(self, name: str, sha256: str, content_type: Optional[str]) -> Optional[FileRecord]:
+        """
+        point `name` at content that is already stored, without uploading it again. None if the hash is unknown.
+        """
+        with self._write_transaction() as connection:
+            found = self.find_blob(sha256)
+            if found is None:
+                return None
+            path, encoding = found
+            # the file on disk may be compressed, the original size is in the index. A blob without a name left
+            # (a crash between moving it into place and the commit) has no row: its content is read to count it
+            row = connection.execute("SELECT size FROM files WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone()
+            size = row[0] if row is not None else original_size(path)
+            return self._link(connection, name, sha256, size, content_type)
+
+    def has_blob(self, sha256: str) -> bool:
+        return self.find_blob(sha256) is not None
+
+    def lookup(self, name: str) -> Optional[FileRecord]:
+        with self._connect() as connection:
+            row = connection.execute("SELECT name, sha256, size, content_type, updated_at FROM files WHERE name = ?",
+                                     (name,)).fetchone()
+        return FileRecord(*row) if row else None
+
+    def list(self) -> List[FileRecord]:
+        with self._connect() as connection:
+            rows = connection.execute("SELECT name, sha256, size, content_type, updated_at FROM files ORDER BY name").fetchall()
+        return [FileRecord(*row) for row in rows]
+
+    def delete(self, name: str) -> bool:
+        with self._write_transaction() as connection:
+            row = connection.execute("SELECT sha256 FROM files WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return False
+            connection.execute("DELETE FROM files WHERE name = ?", (name,))
+            self._drop_if_unreferenced(connection, row[0])
+            return True
@@ -0,0 +1,78 @@
+"""
+Content type sniffing: what a file is, from its first bytes rather than from its name or what the client claims.
+
+Used by the post-upload jobs (upload_jobs.py, the sniff step) and by the compressed storage (blob_encoding.py), which
+only compresses content that isn't compressed already.
+"""
+
+import codecs
+
+MAGIC_NUMBERS = (
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"BM", "image/bmp"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"PK\x03\x04", "application/zip"),
+    (0, b"PK\x05\x06", "application/zip"),
+    (0, b"\x1f\x8b", "application/gzip"),
+    (0, b"BZh", "application/x-bzip2"),
+    (0, b"\xfd7zXZ\x00", "application/x-xz"),
+    (0, b"(\xb5/\xfd", "application/zstd"),
+    (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (0, b"Rar!\x1a\x07", "application/vnd.rar"),
+    (257, b"ustar", "application/x-tar"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"fLaC", "audio/flac"),
+    (0, b"ID3", "audio/mpeg"),
+    (0, b"\x1aE\xdf\xa3", "video/webm"),
+    (0, b"\x00asm", "application/wasm"),
+    (0, b"\x7fELF", "application/x-elf"),
+    (0, b"SQLite format 3\x00", "application/vnd.sqlite3"),
+)
+# containers that need more than a prefix: RIFF (WebP, WAV, AVI) and ISO base media (MP4, MOV, HEIC ...)
+RIFF_TYPES = {b"WEBP": "image/webp", b"WAVE": "audio/wav", b"AVI ": "video/x-msvideo"}
+ISO_BRANDS = {b"qt  ": "video/quicktime", b"heic": "image/heic", b"heix": "image/heic", b"avif": "image/avif",
+              b"M4A ": "audio/mp4"}
+SNIFF_BYTES = 4096
+
+
+def sniff_content_type(head: bytes) -> str:
+    """
+    the content type of a file from its first SNIFF_BYTES bytes, application/octet-stream if nothing matches
+    """
+    for offset, magic, content_type in MAGIC_NUMBERS:
+        if head[offset:offset + len(magic)] == magic:
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] in RIFF_TYPES:
+        return RIFF_TYPES[head[8:12]]
+    if head[4:8] == b"ftyp":
+        return ISO_BRANDS.get(head[8:12], "video/mp4")
+    if b"\x00" not in head:
+        try:
+            # a multi-byte character may be cut at the end of the sample: the incremental decoder keeps an incomplete
+            # one back instead of failing, unless the sample is the whole file
+            text = codecs.getincrementaldecoder("utf-8")().decode(head, final=len(head) < SNIFF_BYTES)
+        except UnicodeDecodeError:
+            return "application/octet-stream"
+        stripped = text.lstrip().lower()
+        if stripped.startswith(("<!doctype html", "<html")):
+            return "text/html"
+        if stripped.startswith("<?xml"):
+            return "application/xml"
+        if stripped.startswith(("{", "[")):
+            return "application/json"
+        return "text/plain"
+    return "application/octet-stream"
+
+# formats that are compressed already: compressing them again costs CPU and saves next to nothing
+COMPRESSED_TYPES = frozenset({
+    "image/png", "image/jpeg", "image/gif", "image/webp", "image/heic", "image/avif",
+    "application/zip", "application/gzip", "application/x-bzip2", "application/x-xz", "application/zstd",
+    "application/x-7z-compressed", "application/vnd.rar",
+    "audio/ogg", "audio/flac", "audio/mpeg", "audio/mp4", "video/webm", "video/mp4", "video/quicktime", "video/x-msvideo",
+    "application/pdf",
+})
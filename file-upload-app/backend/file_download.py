@@ -0,0 +1,256 @@
+"""
+Reading the uploaded files back: GET /files lists them, GET /files/{name} serves one.
+
+- Range requests (206 Partial Content, also several ranges at once) for video/audio seeking, previews of the start
+  of a big file and parallel downloads. If-Range makes sure the ranges still belong to the same content.
+- ETag (the SHA-256 of the content, so it is a strong validator) and Last-Modified: a repeat fetch with
+  If-None-Match / If-Modified-Since gets an empty 304 instead of the file.
+- Zero-copy: the bytes are never read into Python if the ASGI server offers it. With the
+  "http.response.zerocopysend" extension the server sendfile()s straight from the file descriptor,
+  with "http.response.pathsend" it opens the path itself. Other servers (e.g. uvicorn) fall back to
+  starlette's FileResponse, which streams the file in chunk_size pieces without reading it whole.
+- Files stored compressed (BLOB_COMPRESSION, see blob_encoding.py) are sent as they are on disk, with Content-Encoding,
+  to clients that accept the encoding: no decompression and fewer bytes on the wire, still zero-copy. Other clients
+  get them decompressed while they are sent, see decoded_response(). Both get Vary: Accept-Encoding and their own ETag.
+"""
+
+import mimetypes
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.datastructures import Headers
+from starlette.types import Receive, Scope, Send
+
+from blob_encoding import open_blob
+from blob_store import BlobStore, FileRecord
+from response_compression import compressed, negotiate
+from upload_storage import CHUNK_SIZE, UploadError, safe_filename
+
+ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+PATHSEND_EXTENSION = "http.response.pathsend"
+
+
+class ZeroCopyFileResponse(FileResponse):
+    """
+    FileResponse that hands the file to the server when the server supports it, instead of pushing it through Python.
+    """
+    chunk_size = 256 * 1024
+
+    async def _handle_simple(self, send: Send, send_header_only: bool) -> None:
+        extensions = self._scope.get("extensions") or {}
+        if send_header_only or not (ZEROCOPY_EXTENSION in extensions or PATHSEND_EXTENSION in extensions):
+            return await super()._handle_simple(send, send_header_only)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if PATHSEND_EXTENSION in extensions:
+            await send({"type": PATHSEND_EXTENSION, "path": str(self.path)})
+        else:
+            await self._zerocopy(send, 0, None)
+
+    async def _handle_single_range(self, send: Send, start: int, end: int, file_size: int, send_header_only: bool) -> None:
+        extensions = self._scope.get("extensions") or {}
+        if send_header_only or ZEROCOPY_EXTENSION not in extensions:
+            return await super()._handle_single_range(send, start, end, file_size, send_header_only)
+        self.headers["content-range"] = f"bytes {start}-{end - 1}/{file_size}"
+        self.headers["content-length"] = str(end - start)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        await self._zerocopy(send, start, end - start)
+
+    async def _zerocopy(self, send: Send, offset: int, count: Optional[int]) -> None:
+        file = await anyio.to_thread.run_sync(open, self.path, "rb")
+        try:
+            message = {"type": ZEROCOPY_EXTENSION, "file": file, "offset": offset, "more_body": False}
+            if count is not None:
+                message["count"] = count
+            await send(message)
+        finally:
+            file.close()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # the handlers above need the scope to know which extensions the server has
+        self._scope = scope
+        await super().__call__(scope, receive, send)
+
+
+def etag_for(record: FileRecord, encoding: Optional[str] = None) -> str:
+    # the encoded bytes are another representation, with a validator of their own
+    return f'"{record.sha256}-{encoding}"' if encoding else f'"{record.sha256}"'
+
+
+def not_modified(request_headers: Headers, etag: str, last_modified: float) -> bool:
+    """
+    RFC 9110 conditional GET: If-None-Match wins, If-Modified-Since is only looked at when there is no If-None-Match
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def legacy_record(store: BlobStore, name: str) -> Optional[FileRecord]:
+    """
+    files saved directly in UPLOAD_DIR before the content-addressed store existed are still served,
+    with an ETag made from their size and mtime since their hash is unknown
+    """
+    path = store.root / name
+    try:
+        stat_result = path.stat()
+    except OSError:
+        return None
+    if not path.is_file():
+        return None
+    return FileRecord(name, f"{int(stat_result.st_mtime_ns):x}-{stat_result.st_size:x}", stat_result.st_size,
+                      None, stat_result.st_mtime)
+
+
+# ------------------------------
+# Files stored compressed, for a client that doesn't accept their encoding
+# ------------------------------
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_single_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    (start, end exclusive) of a single "bytes=" range. None to send the whole file: no Range, several ranges or one
+    that can't be parsed (RFC 9110 lets a server ignore those). RangeNotSatisfiable if it starts past the end.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    first, separator, last = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if not separator:
+            return None
+        if first == "":
+            # a suffix range, the last N bytes
+            if int(last) <= 0:
+                raise RangeNotSatisfiable()
+            return max(size - int(last), 0), size
+        start, end = int(first), (int(last) + 1 if last else size)
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return (start, min(end, size)) if end > start else None
+
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    return f"inline; filename*=utf-8''{quoted}" if quoted != filename else f'inline; filename="{filename}"'
+
+
+async def decoded_response(request: Request, path: Path, record: FileRecord, headers: dict) -> Response:
+    """
+    the original bytes of a compressed blob, decompressed chunk by chunk while they are sent.
+    One range is served by decompressing up to its start (there is no index into the compressed stream),
+    several ranges get the whole file.
+    """
+    byte_range = None
+    if request.headers.get("if-range", headers["ETag"]) == headers["ETag"]:
+        try:
+            byte_range = parse_single_range(request.headers.get("range"), record.size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{record.size}"})
+    start, end = byte_range or (0, record.size)
+    headers = {**headers, "Accept-Ranges": "bytes", "Content-Length": str(end - start),
+               "Content-Disposition": content_disposition(record.name)}
+    if byte_range is not None:
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{record.size}"
+    status_code = 206 if byte_range is not None else 200
+    media_type = record.content_type or mimetypes.guess_type(record.name)[0] or "text/plain"
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+
+    try:
+        file = await anyio.to_thread.run_sync(open_blob, path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    async def chunks():
+        try:
+            if start:
+                # forward seeks decompress up to the position
+                await anyio.to_thread.run_sync(file.seek, start)
+            remaining = end - start
+            while remaining > 0:
+                data = await anyio.to_thread.run_sync(file.read, min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        finally:
+            await anyio.to_thread.run_sync(file.close)
+    return StreamingResponse(chunks(), status_code=status_code, headers=headers, media_type=media_type)
+
+
+router = APIRouter(prefix="/files", tags=["downloads"])
+
+
+@router.get("")
+@compressed()
+async def list_files(request: Request) -> List[dict]:
+    """
+    all stored files, e.g. for the frontend to show what can be previewed
+    """
+    store: BlobStore = request.app.state.file_store
+    records = await anyio.to_thread.run_sync(store.list)
+    return [{"filename": r.name, "size": r.size, "content_type": r.content_type, "sha256": r.sha256} for r in records]
+
+
+@router.api_route("/{name}", methods=["GET", "HEAD"])
+async def download_file(name: str, request: Request) -> Response:
+    """
+    serve a stored file, with Range and conditional request support
+    """
+    store: BlobStore = request.app.state.file_store
+    try:
+        name = safe_filename(name)
+    except UploadError:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    def find():
+        record = store.lookup(name)
+        if record is not None:
+            path, encoding = store.find_blob(record.sha256) or (store.blob_path(record.sha256), None)
+            return record, path, encoding
+        return legacy_record(store, name), store.root / name, None
+    record, path, encoding = await anyio.to_thread.run_sync(find)
+    if record is None:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # a compressed blob goes out as it is stored if the client accepts its encoding
+    sent_encoding = negotiate(request.headers.get("accept-encoding"), (encoding,)) if encoding else None
+    headers = {
+        "ETag": etag_for(record, sent_encoding),
+        "Last-Modified": formatdate(record.updated_at, usegmt=True),
+        # a name can be re-pointed to new content, so caches have to revalidate (cheap, thanks to the ETag / 304)
+        "Cache-Control": "no-cache",
+    }
+    if encoding is not None:
+        headers["Vary"] = "Accept-Encoding"
+    if sent_encoding is not None:
+        headers["Content-Encoding"] = sent_encoding
+    if not_modified(request.headers, headers["ETag"], record.updated_at):
+        return Response(status_code=304, headers=headers)
+    if encoding is not None and sent_encoding is None:
+        return await decoded_response(request, path, record, headers)
+
+    try:
+        stat_result = await anyio.to_thread.run_sync(os.stat, path)
+    except FileNotFoundError:
+        # the name was re-pointed and the old blob deleted between the lookup and now
+        raise HTTPException(status_code=404, detail="File not found")
+    return ZeroCopyFileResponse(path, headers=headers, media_type=record.content_type, filename=record.name,
+                                stat_result=stat_result, content_disposition_type="inline")
@@ -1,27 +1,139 @@
-from fastapi import FastAPI, UploadFile
+from fastapi import APIRouter, Depends, FastAPI, UploadFile, Request, HTTPException
 # this CORS middleware is used to allow cross-origin requests, which is useful when your frontend and backend are hosted on different domains or ports.
 from fastapi.middleware.cors import CORSMiddleware
 # Here is the way to change the default file upload limit in FastAPI
 from starlette.formparsers import MultiPartParser
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List
+from typing import List, Optional
+
+import logging
+import os
+
+import anyio
+from pydantic import BaseModel, Field
+
+from upload_storage import UploadError, safe_filename, save_stream, iter_upload_file, save_upload_files, save_multipart_stream
+from resumable_upload import ResumableUploadStore, router as resumable_router
+from blob_store import BlobStore
+from file_download import router as download_router
+from upload_jobs import UploadJobs, enqueue_saved, router as jobs_router
+from instrumentation import instrument_app
+from response_compression import setup_compression
+from admission import Limit, admitted, setup_admission
+import metrics
+
+logger = logging.getLogger(__name__)
 
 MultiPartParser.max_part_size = 1024 * 1024 * 10  # Set to 10 MB, or whatever limit you prefer
 
 
-# define the directory when received files from the frontend uploaded to be stored
-UPLOAD_DIR = Path("uploads")
+class UploadSettings(BaseModel):
+    """
+    Every field can be overridden with an environment variable named UPLOAD_<FIELD NAME>, e.g. UPLOAD_DIR=/data/uploads.
+    """
+    dir: Path = Field(default=Path("uploads"), description="where the uploaded files are stored")
+    max_parallel_files: int = Field(default=4, ge=1, description="how many files of one request are written to disk at the same time")
+    max_concurrent_uploads: int = Field(default=8, ge=1, description="upload requests received at the same time, "
+                                        "the next ones wait in a queue (see admission.py)")
+
+    @classmethod
+    def from_env(cls, prefix: str = "UPLOAD_", **overrides) -> "UploadSettings":
+        values = {}
+        for name in cls.model_fields:
+            env_value = os.getenv(prefix + name.upper())
+            if env_value is not None:
+                values[name] = env_value
+        values.update(overrides)
+        return cls(**values)
+
+
+def create_app(settings: Optional[UploadSettings] = None) -> FastAPI:
+    """
+    Build the app (settings from UPLOAD_* environment variables by default). Nothing here touches the disk or starts
+    a process: the file store opens its index on the first upload, the job pool starts with the first job.
+    The Docker image runs it with:  uvicorn file_upload:create_app --factory
+    """
+    settings = settings or UploadSettings.from_env()
+
+    # uploads are stored content-addressed inside settings.dir: identical files are kept once, see blob_store.py.
+    # BLOB_COMPRESSION=auto stores compressible files compressed and decompresses them when read, see blob_encoding.py
+    file_store = BlobStore(settings.dir)
+
+    # checksums, content type sniffing, archive listing and thumbnails of the stored files run in worker processes after
+    # the upload has returned, see upload_jobs.py (JOBS_* environment variables)
+    upload_jobs = UploadJobs(file_store)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        yield
+        await anyio.to_thread.run_sync(upload_jobs.shutdown)
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.settings = settings
+
+    # uploads are admitted max_concurrent_uploads at a time, within a byte budget for all bodies in flight and as long as
+    # the disk of the upload directory keeps some headroom; the others wait, or get a 429 / 503 with Retry-After
+    # (ADMISSION_* settings). Added before the CORS middleware, so the rejections get the CORS headers too and the
+    # frontend can read them
+    setup_admission(app, name="upload", limits={"uploads": Limit(concurrency=settings.max_concurrent_uploads, charge_body=True)},
+                    disk_path=settings.dir)
 
-app = FastAPI()
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins = ["*"],  # Allows all origins, you can specify a list of allowed origins
+        allow_credentials = True,
+        allow_methods = ["*"],  # Allows all methods, you can specify a list of allowed methods
+        allow_headers = ["*"],  # Allows all headers, you can specify a list of allowed headers
+        # the browser only lets the frontend read response headers listed here, the resumable uploads report progress in Upload-Offset
+        # and the downloads need the range / caching headers, Retry-After says when to retry an upload that was turned away
+        expose_headers = ["Upload-Offset", "Location", "ETag", "Last-Modified", "Accept-Ranges", "Content-Range", "Content-Length",
+                          "Retry-After"],
+    )
 
+    app.state.file_store = file_store
+    # GET /files and GET /files/{name}: read the stored files back, with Range and ETag support, see file_download.py
+    app.include_router(download_router)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins = ["*"],  # Allows all origins, you can specify a list of allowed origins
-    allow_credentials = True,
-    allow_methods = ["*"],  # Allows all methods, you can specify a list of allowed methods
-    allow_headers = ["*"],  # Allows all headers, you can specify a list of allowed headers
-)
+    # resumable uploads for big files over flaky connections: /uploads, see resumable_upload.py for the protocol
+    app.state.resumable_uploads = ResumableUploadStore(file_store)
+    app.include_router(resumable_router)
+
+    # GET /jobs/{job_id}: progress and results of the post-upload processing of a file, the job id is its SHA-256
+    app.state.upload_jobs = upload_jobs
+    app.include_router(jobs_router)
+
+    # the GET /files listing is gzip / zstd encoded for clients that accept it (COMPRESSION_* settings, see response_compression.py)
+    setup_compression(app, name="upload")
+
+    # GET /metrics: per-route latency, in-flight requests and request/response bytes (upload / download volume).
+    # PROFILER_ENABLED=true dumps the stacks of slow requests, see instrumentation.py
+    app.include_router(metrics.router)
+    instrument_app(app, name="upload")
+
+    # the upload endpoints below
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name: str):
+    # `app` is built on first access (uvicorn file_upload:app), so importing the module or using create_app()
+    # doesn't build a second app
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+async def get_file_store(request: Request) -> BlobStore:
+    return request.app.state.file_store
+
+async def get_upload_jobs(request: Request) -> UploadJobs:
+    return request.app.state.upload_jobs
+
+
+router = APIRouter()
 
 
 """
@@ -31,50 +143,106 @@ file upload in FastAPI
 - Best Practices
 """
 
-@app.get("/")
+@router.get("/")
 def index_page() -> dict:
     return {"Welcome": "You have entered the file-upload backend home page!"}
 
 
-@app.post("/upload")
+@router.post("/upload")
+@admitted("uploads")
 async def endpoint(upload_file: UploadFile) -> None:
     """
     Example endpoint to handle file upload. Use this way to upload small files, not for large files. As this method reads the entire file into memory.
     :param upload_file:
     :return: None
     """
-    print(upload_file.file)
+    logger.debug("upload %s: %r", upload_file.filename, upload_file.file)
     # this is checking if the uploaded file is in memory or not, if the uploaded file is greater than default limit, it will be stored in disk, otherwise it will be stored on memory.
-    print(upload_file._in_memory)
+    logger.debug("upload %s kept in memory: %s", upload_file.filename, upload_file._in_memory)
     content = await upload_file.read()
-    print(content)
+    # log the size, not the content: printing a whole file on every request costs more than receiving it
+    logger.debug("upload %s: %d bytes", upload_file.filename, len(content))
 
-@app.post("/upload2")
-async def endpoint2(upload_file: UploadFile) -> None:
+@router.post("/upload2")
+@admitted("uploads")
+async def endpoint2(upload_file: UploadFile, file_store: BlobStore = Depends(get_file_store),
+                    upload_jobs: UploadJobs = Depends(get_upload_jobs)) -> dict:
     """
     Example endpoint to handle file upload. Use this way to upload large files, as this method streams the file in chunks.
+    Every chunk goes to a temp file (written in a worker thread, so the event loop is not blocked) and the finished file
+    is moved into the file store.
     :param upload_file:
-    :return:
+    :return: the stored file name, its size and content hash, and the id of its post-upload job
     """
-    with open(upload_file.filename, "wb") as f:
-        while True:
-            chunk = await upload_file.read(1024 * 1024)
-            if not chunk:
-                break
-            print(chunk)
-
-@app.post("/upload_file")
-async def create_upload_file(file_uploads: List[UploadFile]) -> dict:
+    try:
+        saved = await save_stream(iter_upload_file(upload_file), file_store, upload_file.filename, upload_file.content_type)
+    except UploadError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    return {"filename": saved.filename, "size": saved.size, "sha256": saved.sha256, "deduplicated": saved.deduplicated,
+            "job_id": enqueue_saved(upload_jobs, saved.sha256, saved.filename, saved.content_type)}
+
+@router.post("/upload_file")
+@admitted("uploads")
+async def create_upload_file(file_uploads: List[UploadFile], request: Request, file_store: BlobStore = Depends(get_file_store),
+                             upload_jobs: UploadJobs = Depends(get_upload_jobs)) -> dict:
     """
     This is the api endpoint to receive multiple files from the frontend.
+    The files are copied to the file store chunk by chunk (never read whole into memory), UPLOAD_MAX_PARALLEL_FILES at a time.
+    The response is sent once the files are durable, their processing (upload_jobs.py) is only enqueued: poll
+    GET /jobs/{job_id} for it.
     :param file_uploads:
     :return: dict
     """
-    for file_upload in file_uploads:
-        content = await file_upload.read()
-        with open(UPLOAD_DIR/file_upload.filename, "wb") as f:
-            f.write(content)
+    try:
+        saved_files = await save_upload_files(file_uploads, file_store, request.app.state.settings.max_parallel_files)
+    except UploadError as error:
+        raise HTTPException(status_code=400, detail=str(error))
 
-    return {"filename": [f.filename for f in file_uploads], "content_type": [f.content_type for f in file_uploads]}
+    return {"filename": [f.filename for f in file_uploads], "content_type": [f.content_type for f in file_uploads],
+            "job_id": [enqueue_saved(upload_jobs, f.sha256, f.filename, f.content_type) for f in saved_files]}
 
 
+@router.post("/upload_stream")
+@admitted("uploads")
+async def upload_stream(request: Request, file_store: BlobStore = Depends(get_file_store),
+                        upload_jobs: UploadJobs = Depends(get_upload_jobs)) -> dict:
+    """
+    Same multipart/form-data body as /upload_file, but parsed by hand while it streams in: each file is written straight
+    to its temp file as the bytes arrive, so there is no spooling, no second copy and no size limit from
+    MultiPartParser, and memory stays around one chunk per upload whatever the file size.
+    :return: dict with the stored file names, content types, sizes and post-upload job ids
+    """
+    try:
+        saved_files = await save_multipart_stream(request, file_store)
+    except UploadError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    return {"filename": [f.filename for f in saved_files], "content_type": [f.content_type for f in saved_files],
+            "size": [f.size for f in saved_files], "sha256": [f.sha256 for f in saved_files],
+            "job_id": [enqueue_saved(upload_jobs, f.sha256, f.filename, f.content_type) for f in saved_files]}
+
+
+# ------------------------------
+# Deduplicated uploads without sending the bytes
+# ------------------------------
+# A client that already knows the SHA-256 of a file can ask to store it by hash first. If the content is already
+# on the server the name is simply linked to it (nothing is uploaded or written), otherwise the answer is a 404
+# and the client uploads the file normally.
+# ------------------------------
+class LinkByHash(BaseModel):
+    filename: str
+    sha256: str = Field(..., pattern="^[0-9a-f]{64}$")
+    content_type: Optional[str] = None
+
+@router.post("/files/by-hash")
+async def link_file_by_hash(body: LinkByHash, file_store: BlobStore = Depends(get_file_store),
+                            upload_jobs: UploadJobs = Depends(get_upload_jobs)) -> dict:
+    try:
+        filename = safe_filename(body.filename)
+    except UploadError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    record = await anyio.to_thread.run_sync(file_store.link_existing, filename, body.sha256, body.content_type)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Unknown content, upload the file instead")
+    # the content was processed when it was first uploaded: this is the same job (or a new one if that job is gone)
+    return {"filename": record.name, "size": record.size, "sha256": record.sha256, "deduplicated": True,
+            "job_id": enqueue_saved(upload_jobs, record.sha256, record.name, record.content_type)}
@@ -0,0 +1,378 @@
+"""
+Resumable uploads: send a big file in as many pieces (and over as many connections) as needed.
+
+The protocol, inspired by tus.io but kept minimal so any client that can slice a file can use it:
+
+ 1. POST   /uploads                  {"filename": "...", "size": 123, "content_type": "..."}
+                                     -> 201 {"upload_id": "...", "offset": 0, "size": 123}
+ 2. PATCH  /uploads/{upload_id}      headers: Upload-Offset: <bytes already on the server>, body: the raw bytes
+                                     -> {"offset": <new offset>}. The bytes are appended to the partial file in place.
+ 3. GET    /uploads/{upload_id}      -> {"offset": ..., "size": ...}, where to resume after a dropped connection
+                                     (also sent as the Upload-Offset header, HEAD works too)
+ 4. POST   /uploads/{upload_id}/finalize
+                                     -> the complete file is moved into the content-addressed file store, or
+                                     compressed into it when BLOB_COMPRESSION applies to it (see blob_encoding.py)
+    DELETE /uploads/{upload_id}      -> give up and delete the partial file
+
+The Upload-Offset of a PATCH must match what the server has (409 otherwise, with the right offset in the header),
+so a retried or duplicated chunk can never corrupt the file. The partial file and a small JSON file describing the
+session live in UPLOAD_DIR/.incoming, the offset is simply the size of the partial file, so sessions survive a
+restart of the server. Sessions nobody touched for SESSION_TTL are removed.
+
+The SHA-256 the file store needs is computed while the PATCHes arrive (kept in memory per session). Only if that
+state is lost, e.g. after a restart, finalize has to read the partial file once more to hash it.
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import anyio
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response, status
+from pydantic import BaseModel, Field
+
+from admission import admitted
+from blob_encoding import SAMPLE_BYTES, choose_encoding
+from blob_store import BlobStore
+from upload_jobs import enqueue_saved
+from upload_storage import CHUNK_SIZE, INCOMING_DIR_NAME, SavedFile, UploadError, safe_filename, save_stream
+
+OFFSET_HEADER = "Upload-Offset"
+SESSION_TTL = 24 * 60 * 60  # seconds
+
+
+class UploadSessionCreate(BaseModel):
+    filename: str = Field(..., min_length=1, description="name the file gets in the file store once finalized")
+    size: int = Field(..., ge=0, description="total size of the file in bytes")
+    content_type: Optional[str] = None
+
+
+class UploadSession(UploadSessionCreate):
+    upload_id: str
+    offset: int = 0
+    created_at: float
+    updated_at: float
+
+
+class UploadConflict(Exception):
+    """
+    the client's idea of the offset doesn't match the server's, or another request is writing to the same session
+    """
+    def __init__(self, message: str, offset: int):
+        super().__init__(message)
+        self.offset = offset
+
+
+class ResumableUploadStore:
+    """
+    Keeps the resumable upload sessions in UPLOAD_DIR/.incoming: <upload_id>.part (the bytes received so far)
+    and <upload_id>.json (the session metadata).
+    """
+
+    def __init__(self, store: BlobStore):
+        self.store = store
+        self.incoming = store.root / INCOMING_DIR_NAME
+        # one lock per existing session, a second PATCH on the same session while one is running is rejected
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # running SHA-256 per session, together with the offset it has hashed up to
+        self._hashers: Dict[str, Tuple["hashlib._Hash", int]] = {}
+
+    def _part_path(self, upload_id: str) -> Path:
+        return self.incoming / f"{upload_id}.part"
+
+    def _meta_path(self, upload_id: str) -> Path:
+        return self.incoming / f"{upload_id}.json"
+
+    @staticmethod
+    def _is_valid_id(upload_id: str) -> bool:
+        # upload ids are uuid4 hex strings, anything else can't be ours (and must not reach the file system)
+        return len(upload_id) == 32 and all(c in "0123456789abcdef" for c in upload_id)
+
+    @asynccontextmanager
+    async def _locked(self, upload_id: str, wait: bool = True) -> AsyncIterator[UploadSession]:
+        """
+        hold the session's lock and yield the session, KeyError if there is no such session. A lock is only created
+        for a session that exists, so requests for made up ids don't leave one behind, and a session that went away
+        while we waited for its lock takes its lock with it.
+        wait=False raises UploadConflict instead of waiting when another request holds the lock.
+        """
+        lock = self._locks.get(upload_id)
+        if lock is None:
+            if await self.get(upload_id) is None:
+                raise KeyError(upload_id)
+            lock = self._locks.setdefault(upload_id, asyncio.Lock())
+        if not wait and lock.locked():
+            session = await self.get(upload_id)
+            raise UploadConflict("Another request is already writing to this upload", session.offset if session else 0)
+        async with lock:
+            session = await self.get(upload_id)
+            if session is None:
+                self._forget(upload_id)
+                raise KeyError(upload_id)
+            yield session
+
+    def _save_meta(self, session: UploadSession) -> None:
+        temp = self._meta_path(session.upload_id).with_suffix(".json.tmp")
+        temp.write_text(session.model_dump_json())
+        os.replace(temp, self._meta_path(session.upload_id))
+
+    def _load(self, upload_id: str) -> Optional[UploadSession]:
+        if not self._is_valid_id(upload_id):
+            return None
+        try:
+            session = UploadSession.model_validate_json(self._meta_path(upload_id).read_bytes())
+        except FileNotFoundError:
+            return None
+        # the partial file is the source of truth for the offset
+        session.offset = self._part_path(upload_id).stat().st_size
+        return session
+
+    async def create(self, request: UploadSessionCreate) -> UploadSession:
+        now = time.time()
+        session = UploadSession(upload_id=uuid.uuid4().hex, filename=safe_filename(request.filename), size=request.size,
+                                content_type=request.content_type, created_at=now, updated_at=now)
+        def create_files():
+            self.incoming.mkdir(parents=True, exist_ok=True)
+            self._part_path(session.upload_id).touch()
+            self._save_meta(session)
+        await anyio.to_thread.run_sync(create_files)
+        self._hashers[session.upload_id] = (hashlib.sha256(), 0)
+        await self._remove_expired(now)
+        return session
+
+    async def get(self, upload_id: str) -> Optional[UploadSession]:
+        return await anyio.to_thread.run_sync(self._load, upload_id)
+
+    async def append(self, upload_id: str, offset: int, chunks) -> UploadSession:
+        """
+        append the request body at `offset`, which must be exactly the number of bytes already received
+        """
+        async with self._locked(upload_id, wait=False) as session:
+            if offset != session.offset:
+                raise UploadConflict(f"Upload-Offset {offset} does not match the server offset {session.offset}", session.offset)
+
+            hasher, hashed = self._hashers.get(upload_id, (None, -1))
+            if hashed != session.offset:
+                # the in-memory hash is missing or out of step with the file, finalize will rehash the file instead
+                hasher = None
+            file = await anyio.to_thread.run_sync(open, self._part_path(upload_id), "ab", 0)
+            buffer = bytearray()
+
+            def write(data: bytes) -> None:
+                if hasher is not None:
+                    hasher.update(data)
+                file.write(data)
+
+            try:
+                async for data in chunks:
+                    if session.offset + len(buffer) + len(data) > session.size:
+                        raise UploadError(f"Upload would exceed its declared size of {session.size} bytes")
+                    buffer += data
+                    if len(buffer) >= CHUNK_SIZE:
+                        await anyio.to_thread.run_sync(write, bytes(buffer))
+                        session.offset += len(buffer)
+                        buffer = bytearray()
+            finally:
+                # whatever arrived before a dropped connection is kept, so the client can resume right after it
+                def close():
+                    if buffer:
+                        write(bytes(buffer))
+                    os.fsync(file.fileno())
+                    file.close()
+                with anyio.CancelScope(shield=True):
+                    await anyio.to_thread.run_sync(close)
+                    session.offset += len(buffer)
+                    session.updated_at = time.time()
+                    if hasher is not None:
+                        self._hashers[upload_id] = (hasher, session.offset)
+                    await anyio.to_thread.run_sync(self._save_meta, session)
+        return session
+
+    def _file_sha256(self, upload_id: str) -> str:
+        hasher = hashlib.sha256()
+        with open(self._part_path(upload_id), "rb") as file:
+            while data := file.read(CHUNK_SIZE):
+                hasher.update(data)
+        return hasher.hexdigest()
+
+    def _encoding(self, upload_id: str, size: int, sha256: Optional[str]) -> Optional[str]:
+        """
+        the encoding to store the finished upload in, decided on its first bytes like a streamed upload's,
+        None to store it raw. Content that is stored already is only linked, there is nothing to compress.
+        """
+        if self.store.compression.encoding is None or (sha256 is not None and self.store.has_blob(sha256)):
+            return None
+        with open(self._part_path(upload_id), "rb") as file:
+            head = file.read(SAMPLE_BYTES)
+        return choose_encoding(head, size, self.store.compression)
+
+    async def _read_part(self, upload_id: str) -> AsyncIterator[bytes]:
+        file = await anyio.to_thread.run_sync(open, self._part_path(upload_id), "rb")
+        try:
+            while data := await anyio.to_thread.run_sync(file.read, CHUNK_SIZE):
+                yield data
+        finally:
+            await anyio.to_thread.run_sync(file.close)
+
+    async def finalize(self, upload_id: str) -> SavedFile:
+        async with self._locked(upload_id) as session:
+            if session.offset != session.size:
+                raise UploadConflict(f"Upload is incomplete, {session.offset} of {session.size} bytes received", session.offset)
+            hasher, hashed = self._hashers.get(upload_id, (None, -1))
+            sha256 = hasher.hexdigest() if hashed == session.size else None
+            if await anyio.to_thread.run_sync(self._encoding, upload_id, session.size, sha256) is not None:
+                # the partial file is raw: it goes through a TempUpload, compressed (and hashed) on the way like a
+                # streamed upload, then the session's files are deleted
+                saved = await save_stream(self._read_part(upload_id), self.store, session.filename, session.content_type)
+                await anyio.to_thread.run_sync(self._delete_files, upload_id)
+            else:
+                def store():
+                    result = self.store.put(self._part_path(upload_id), sha256 or self._file_sha256(upload_id),
+                                            session.filename, session.size, session.content_type)
+                    self._meta_path(upload_id).unlink(missing_ok=True)
+                    return result
+                result = await anyio.to_thread.run_sync(store)
+                saved = SavedFile(session.filename, session.content_type, session.size, result.record.sha256,
+                                  result.deduplicated)
+        self._forget(upload_id)
+        return saved
+
+    def _forget(self, upload_id: str) -> None:
+        self._locks.pop(upload_id, None)
+        self._hashers.pop(upload_id, None)
+
+    async def delete(self, upload_id: str) -> bool:
+        try:
+            async with self._locked(upload_id):
+                await anyio.to_thread.run_sync(self._delete_files, upload_id)
+        except KeyError:
+            return False
+        self._forget(upload_id)
+        return True
+
+    def _delete_files(self, upload_id: str) -> None:
+        self._part_path(upload_id).unlink(missing_ok=True)
+        self._meta_path(upload_id).unlink(missing_ok=True)
+
+    def _is_expired(self, upload_id: str, now: float) -> bool:
+        try:
+            return now - self._meta_path(upload_id).stat().st_mtime > SESSION_TTL
+        except FileNotFoundError:  # finalized or deleted meanwhile
+            return False
+
+    def _expired_ids(self, now: float) -> List[str]:
+        return [meta.stem for meta in self.incoming.glob("*.json")
+                if self._is_valid_id(meta.stem) and self._is_expired(meta.stem, now)]
+
+    def _delete_if_expired(self, upload_id: str, now: float) -> bool:
+        if not self._is_expired(upload_id, now):
+            return False
+        self._delete_files(upload_id)
+        return True
+
+    async def _remove_expired(self, now: float) -> None:
+        """
+        delete the sessions nobody touched for SESSION_TTL. _locks and _hashers are only ever changed on the event
+        loop, the threads just look at and delete the files. A session is deleted under its lock, after checking
+        again that it is still expired: a PATCH that got in first has saved a new updated_at by then.
+        """
+        for upload_id in await anyio.to_thread.run_sync(self._expired_ids, now):
+            lock = self._locks.setdefault(upload_id, asyncio.Lock())
+            if lock.locked():
+                continue
+            async with lock:
+                removed = await anyio.to_thread.run_sync(self._delete_if_expired, upload_id, now)
+            if removed:
+                self._forget(upload_id)
+
+
+# ------------------------------
+# Endpoints
+# ------------------------------
+router = APIRouter(prefix="/uploads", tags=["resumable uploads"])
+
+def get_store(request: Request) -> ResumableUploadStore:
+    return request.app.state.resumable_uploads
+
+async def get_session(upload_id: str, store: ResumableUploadStore = Depends(get_store)) -> UploadSession:
+    session = await store.get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return session
+
+def progress(session: UploadSession, response: Response) -> dict:
+    response.headers[OFFSET_HEADER] = str(session.offset)
+    return {"upload_id": session.upload_id, "filename": session.filename, "offset": session.offset, "size": session.size}
+
+
+@router.post("", status_code=status.HTTP_201_CREATED)
+async def create_upload(body: UploadSessionCreate, response: Response,
+                        store: ResumableUploadStore = Depends(get_store)) -> dict:
+    """
+    start a resumable upload, the returned upload_id is used by all the other calls
+    """
+    try:
+        session = await store.create(body)
+    except UploadError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    response.headers["Location"] = f"{router.prefix}/{session.upload_id}"
+    return progress(session, response)
+
+
+@router.api_route("/{upload_id}", methods=["GET", "HEAD"])
+async def upload_progress(response: Response, session: UploadSession = Depends(get_session)) -> dict:
+    """
+    how many bytes the server has, i.e. the Upload-Offset to resume from
+    """
+    return progress(session, response)
+
+
+@router.patch("/{upload_id}")
+@admitted("uploads")
+async def append_chunk(upload_id: str, request: Request, response: Response,
+                       upload_offset: int = Header(..., alias=OFFSET_HEADER, ge=0),
+                       store: ResumableUploadStore = Depends(get_store)) -> dict:
+    """
+    append the raw request body to the upload, starting at Upload-Offset. The body is streamed to disk as it arrives.
+    """
+    try:
+        session = await store.append(upload_id, upload_offset, request.stream())
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    except UploadConflict as error:
+        raise HTTPException(status_code=409, detail=str(error), headers={OFFSET_HEADER: str(error.offset)})
+    except UploadError as error:
+        raise HTTPException(status_code=413, detail=str(error))
+    return progress(session, response)
+
+
+@router.post("/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, request: Request, store: ResumableUploadStore = Depends(get_store)) -> dict:
+    """
+    all bytes are there: move the file into the file store, and enqueue its post-upload job if the app has a pipeline
+    (app.state.upload_jobs, see upload_jobs.py)
+    """
+    try:
+        saved = await store.finalize(upload_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    except UploadConflict as error:
+        raise HTTPException(status_code=409, detail=str(error), headers={OFFSET_HEADER: str(error.offset)})
+    return {"filename": saved.filename, "content_type": saved.content_type, "size": saved.size,
+            "sha256": saved.sha256, "deduplicated": saved.deduplicated,
+            "job_id": enqueue_saved(getattr(request.app.state, "upload_jobs", None), saved.sha256, saved.filename,
+                                    saved.content_type)}
+
+
+@router.delete("/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def cancel_upload(upload_id: str, store: ResumableUploadStore = Depends(get_store)) -> None:
+    """
+    abort the upload and delete what was received
+    """
+    if not await store.delete(upload_id):
+        raise HTTPException(status_code=404, detail="Upload not found")
@@ -0,0 +1,435 @@
+"""
+Post-upload processing: the CPU heavy work on a stored file runs in a pool of worker processes, after the upload
+request has already returned.
+
+An upload endpoint answers as soon as the bytes are durable (fsync'ed and in the BlobStore) and only enqueues a job for
+the content. A job is a few independent steps, each one a task on a concurrent.futures.ProcessPoolExecutor, so the
+hashing / parsing / image decoding runs on every core and never holds the GIL of the process serving requests:
+ checksum    md5, crc32 and a re-check of the SHA-256 the file is stored under (catches a corrupted blob)
+ sniff       the content type from the magic bytes at the start of the file (the job also has the declared one)
+ archive     zip / tar (also .tar.gz ...): entry count, uncompressed size, compression ratio, suspicious entry names
+ thumbnail   a small WebP of an image in UPLOAD_DIR/.thumbnails, only when Pillow is installed
+GET /jobs/{job_id} reports the status and progress of a job and the results of its finished steps.
+
+ - Idempotent: the job id is the SHA-256 of the content and the steps only read the (immutable) blob, so uploading the
+   same bytes again, under any name, returns the job that already exists instead of doing the work twice. The thumbnail
+   is written to a temp file and renamed into place, a step that runs twice just writes the same file again.
+ - Retried: a step that raises is resubmitted after retry_backoff_s, doubling every time, up to max_attempts. A worker
+   process that dies (e.g. killed for memory on a huge image) breaks the whole pool: it is replaced and the steps that
+   were running on it are retried like any other failure. A blob that was deleted in the meantime is not retried.
+ - Bounded: at most `workers` steps are handed to the pool at a time (the pool's own queue has no limit) and at most
+   max_queued jobs wait for it. When the queue is full a new job is rejected, the upload itself still succeeds.
+   A bounded number of finished jobs (max_finished) is kept for GET /jobs.
+ - The queue depth, running steps, step durations and outcomes are exported on GET /metrics (see metrics.py).
+
+The scheduling is plain threading: enqueue() only updates a few dicts under a lock, so the async endpoints can call it
+directly, and the pool's done callbacks (on its management thread) hand out the next steps.
+Jobs live in memory: after a restart a job is created again the next time its content is uploaded.
+"""
+
+import hashlib
+import io
+import importlib.util
+import logging
+import multiprocessing
+import os
+import stat
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Callable, Deque, Dict, List, Literal, Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from pydantic import BaseModel, Field
+
+from blob_encoding import encoding_of, open_blob
+from blob_store import BlobStore
+from content_types import SNIFF_BYTES, sniff_content_type
+from metrics import REGISTRY
+from upload_storage import CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+THUMBNAILS_DIR_NAME = ".thumbnails"
+THUMBNAIL_SIZE = (256, 256)
+
+# Pillow is optional: without it there is no thumbnail step
+HAS_PILLOW = importlib.util.find_spec("PIL") is not None
+
+JOB_STEP_DURATION = REGISTRY.histogram(
+    "upload_job_step_duration_seconds", "Time a post-upload step took in a worker process", ["step"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0))
+JOB_STEPS = REGISTRY.counter(
+    "upload_job_steps_total", "Post-upload steps by outcome (ok, retried, failed)", ["step", "outcome"])
+JOBS_REJECTED = REGISTRY.counter("upload_jobs_rejected_total", "Post-upload jobs not enqueued because the queue was full")
+
+# the queue gauges are read from the live pipelines at scrape time
+_pipelines: List["UploadJobs"] = []
+
+def _queue_depth():
+    yield (), sum(pipeline._queued_jobs for pipeline in list(_pipelines))
+
+def _steps_by_state():
+    pipelines = list(_pipelines)
+    yield ("queued",), sum(len(pipeline._queue) for pipeline in pipelines)
+    yield ("running",), sum(pipeline._running for pipeline in pipelines)
+
+REGISTRY.gauge("upload_jobs_queue_depth", "Post-upload jobs waiting for a worker process", callback=_queue_depth)
+REGISTRY.gauge("upload_job_steps", "Post-upload steps waiting for (queued) or running in (running) a worker process",
+               ["state"], callback=_steps_by_state)
+
+
+class JobSettings(BaseModel):
+    """
+    Every field can be overridden with an environment variable named JOBS_<FIELD NAME>, e.g. JOBS_WORKERS=2.
+    """
+    workers: int = Field(default_factory=lambda: os.cpu_count() or 1, ge=1, description="worker processes")
+    max_queued: int = Field(default=1000, ge=1, description="jobs waiting for a worker, further jobs are rejected")
+    max_finished: int = Field(default=10000, ge=0, description="finished jobs kept for GET /jobs/{job_id}")
+    max_attempts: int = Field(default=3, ge=1, description="tries per step before the step (and the job) fails")
+    retry_backoff_s: float = Field(default=0.5, ge=0, description="wait before the first retry, doubled for each retry")
+    start_method: Optional[Literal["fork", "forkserver", "spawn"]] = Field(
+        default=None, description="how worker processes are started, forkserver where available, spawn otherwise")
+
+    @classmethod
+    def from_env(cls, prefix: str = "JOBS_", **overrides) -> "JobSettings":
+        values = {}
+        for name in cls.model_fields:
+            env_value = os.getenv(prefix + name.upper())
+            if env_value is not None:
+                values[name] = env_value
+        values.update(overrides)
+        return cls(**values)
+
+
+# ------------------------------
+# Steps, run in the worker processes
+# ------------------------------
+# Every step is a module level function (it is pickled by name) taking the blob path, its SHA-256 and the UPLOAD_DIR,
+# and returns a JSON-able dict, or None when it doesn't apply to the file.
+# ------------------------------
+def checksum_step(path: str, sha256: str, root: str) -> dict:
+    hashes = {"md5": hashlib.md5(), "sha256": hashlib.sha256()}
+    crc = 0
+    size = 0
+    with open_blob(path) as file:
+        while data := file.read(CHUNK_SIZE):
+            for hasher in hashes.values():
+                hasher.update(data)
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+    digest = hashes["sha256"].hexdigest()
+    # a mismatch is reported, not raised: a retry would read the same wrong bytes
+    return {"size": size, "md5": hashes["md5"].hexdigest(), "crc32": f"{crc:08x}", "sha256": digest,
+            "intact": digest == sha256}
+
+
+def sniff_step(path: str, sha256: str, root: str) -> dict:
+    with open_blob(path) as file:
+        head = file.read(SNIFF_BYTES)
+    return {"content_type": sniff_content_type(head)}
+
+
+MAX_LISTED_ENTRIES = 100
+SUSPICIOUS_RATIO = 100  # uncompressed / compressed size above which an archive looks like a zip bomb
+
+
+def _suspicious_name(name: str) -> bool:
+    parts = name.replace("\\", "/").split("/")
+    return name.startswith(("/", "\\")) or ".." in parts or (len(name) > 1 and name[1] == ":")
+
+
+def archive_step(path: str, sha256: str, root: str) -> Optional[dict]:
+    # a blob stored compressed (blob_encoding.py) is never a zip, those are stored raw
+    stored_raw = encoding_of(Path(path)) is None
+    compressed = os.path.getsize(path)
+    if stored_raw and zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            entries = [(info.filename, info.file_size, info.is_dir()) for info in archive.infolist()]
+        kind = "zip"
+    else:
+        try:
+            # "*" also opens compressed tarballs, reading the members is the only way to know what is in them.
+            # A compressed blob can only be read forward: stream mode ("r|*") on the decompressed content
+            with open_blob(path) as file, tarfile.open(fileobj=file, mode="r:*" if stored_raw else "r|*") as archive:
+                entries = []
+                links = 0
+                for member in archive:
+                    entries.append((member.name, member.size, member.isdir()))
+                    links += member.issym() or member.islnk()
+                if not stored_raw:
+                    compressed = file.tell()
+        except (tarfile.TarError, EOFError, OSError, zlib.error):
+            return None
+        kind = "tar"
+    size = sum(entry_size for _, entry_size, _ in entries)
+    ratio = size / compressed if compressed else 0.0
+    result = {
+        "format": kind,
+        "entries": len(entries),
+        "files": sum(not is_dir for _, _, is_dir in entries),
+        "uncompressed_size": size,
+        "ratio": round(ratio, 2),
+        "names": [name for name, _, _ in entries[:MAX_LISTED_ENTRIES]],
+        "unsafe_names": [name for name, _, _ in entries if _suspicious_name(name)][:MAX_LISTED_ENTRIES],
+        "suspicious_ratio": ratio > SUSPICIOUS_RATIO,
+    }
+    if kind == "tar":
+        result["links"] = links
+    return result
+
+
+def thumbnail_step(path: str, sha256: str, root: str) -> Optional[dict]:
+    from PIL import Image, UnidentifiedImageError
+
+    with open_blob(path) as file:
+        if not file.seekable():
+            # Pillow seeks around in the file, a zstd blob is read into memory first
+            file = io.BytesIO(file.read())
+        try:
+            with Image.open(file) as image:
+                width, height = image.size
+                image.thumbnail(THUMBNAIL_SIZE)
+                thumbnail = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        except UnidentifiedImageError:
+            return None
+    target = Path(root) / THUMBNAILS_DIR_NAME / f"{sha256}.webp"
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=target.parent, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            thumbnail.save(file, format="WEBP")
+        os.replace(temp_name, target)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+    return {"width": width, "height": height, "thumbnail": f"{THUMBNAILS_DIR_NAME}/{target.name}",
+            "thumbnail_width": thumbnail.width, "thumbnail_height": thumbnail.height}
+
+
+STEPS: Dict[str, Callable[[str, str, str], Optional[dict]]] = {
+    "checksum": checksum_step,
+    "sniff": sniff_step,
+    "archive": archive_step,
+}
+if HAS_PILLOW:
+    STEPS["thumbnail"] = thumbnail_step
+
+
+def run_step(step: str, path: str, sha256: str, root: str) -> tuple:
+    """
+    the task handed to the pool: (result, seconds it took in the worker)
+    """
+    started = time.perf_counter()
+    if not stat.S_ISREG(os.stat(path).st_mode):
+        raise FileNotFoundError(path)
+    result = STEPS[step](path, sha256, root)
+    return result, time.perf_counter() - started
+
+
+# ------------------------------
+# Jobs, in the server process
+# ------------------------------
+class StepStatus(BaseModel):
+    status: Literal["queued", "running", "done", "failed"] = "queued"
+    attempts: int = 0
+    result: Optional[dict] = None
+    error: Optional[str] = None
+
+
+class Job(BaseModel):
+    job_id: str  # the SHA-256 of the content
+    filename: str  # the name it was first uploaded under
+    content_type: Optional[str] = None
+    status: Literal["queued", "running", "done", "failed"] = "queued"
+    progress: float = 0.0  # finished steps / steps
+    steps: Dict[str, StepStatus]
+    created_at: float
+    finished_at: Optional[float] = None
+
+
+class JobQueueFull(Exception):
+    """
+    max_queued jobs are already waiting, the caller should carry on without a job
+    """
+
+
+class UploadJobs:
+    def __init__(self, store: BlobStore, settings: Optional[JobSettings] = None):
+        self.store = store
+        self.settings = settings or JobSettings.from_env()
+        self._jobs: Dict[str, Job] = {}
+        self._finished: "OrderedDict[str, None]" = OrderedDict()  # ids of the finished jobs, oldest first
+        self._queue: Deque[tuple] = deque()  # (job_id, step) waiting for a worker
+        self._queued_jobs = 0  # jobs with at least one step in _queue and none handed out yet
+        self._running = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._closed = False
+        self._lock = threading.RLock()
+        _pipelines.append(self)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # created on first use, so importing the app doesn't start any process
+        if self._pool is None:
+            method = self.settings.start_method or (
+                "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+            context = multiprocessing.get_context(method)
+            if method == "forkserver":
+                # workers are forked from a server that has imported this module once, not started from scratch
+                context.set_forkserver_preload([__name__])
+            self._pool = ProcessPoolExecutor(self.settings.workers, mp_context=context)
+        return self._pool
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else job.model_copy(deep=True)
+
+    def enqueue(self, sha256: str, filename: str, content_type: Optional[str] = None) -> Job:
+        """
+        the job for this content: the existing one unless it failed, otherwise a new one.
+        Raises JobQueueFull when max_queued jobs are already waiting.
+        """
+        with self._lock:
+            job = self._jobs.get(sha256)
+            if job is not None and job.status != "failed":
+                return job.model_copy(deep=True)
+            if self._closed or self._queued_jobs >= self.settings.max_queued:
+                JOBS_REJECTED.inc()
+                raise JobQueueFull(f"{self._queued_jobs} post-upload jobs are already waiting")
+            job = Job(job_id=sha256, filename=filename, content_type=content_type,
+                      steps={step: StepStatus() for step in STEPS}, created_at=time.time())
+            self._finished.pop(sha256, None)
+            self._jobs[sha256] = job
+            self._queued_jobs += 1
+            self._queue.extend((sha256, step) for step in STEPS)
+            self._dispatch()
+            return job.model_copy(deep=True)
+
+    def _dispatch(self) -> None:
+        """
+        hand queued steps to the pool while fewer than `workers` are running (called with the lock held)
+        """
+        while self._queue and self._running < self.settings.workers and not self._closed:
+            job_id, step = self._queue.popleft()
+            job = self._jobs[job_id]
+            if job.status == "queued":
+                job.status = "running"
+                self._queued_jobs -= 1
+            status = job.steps[step]
+            status.status = "running"
+            status.attempts += 1
+            self._running += 1
+            try:
+                path, _ = self.store.find_blob(job_id) or (self.store.blob_path(job_id), None)
+                future = self._get_pool().submit(run_step, step, str(path), job_id, str(self.store.root))
+            except BrokenProcessPool as error:
+                future = Future()
+                future.set_exception(error)
+            future.add_done_callback(lambda future, job_id=job_id, step=step: self._step_done(job_id, step, future))
+
+    def _step_done(self, job_id: str, step: str, future: Future) -> None:
+        with self._lock:
+            self._running -= 1
+            job = self._jobs.get(job_id)
+            if job is None or self._closed:
+                return
+            status = job.steps[step]
+            error = future.exception() if not future.cancelled() else RuntimeError("cancelled")
+            if error is None:
+                status.result, seconds = future.result()
+                status.status = "done"
+                status.error = None
+                JOB_STEP_DURATION.observe(seconds, step=step)
+                JOB_STEPS.inc(step=step, outcome="ok")
+            else:
+                if isinstance(error, BrokenProcessPool):
+                    self._replace_pool()
+                retry = not isinstance(error, FileNotFoundError) and status.attempts < self.settings.max_attempts
+                status.error = f"{type(error).__name__}: {error}"
+                if retry:
+                    status.status = "queued"
+                    JOB_STEPS.inc(step=step, outcome="retried")
+                    delay = self.settings.retry_backoff_s * 2 ** (status.attempts - 1)
+                    logger.info("post-upload step %s of %s failed (%s), retry in %.1fs", step, job_id, status.error, delay)
+                    timer = threading.Timer(delay, self._requeue, (job_id, step))
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    status.status = "failed"
+                    JOB_STEPS.inc(step=step, outcome="failed")
+                    logger.warning("post-upload step %s of %s failed: %s", step, job_id, status.error)
+            self._update(job)
+            self._dispatch()
+
+    def _requeue(self, job_id: str, step: str) -> None:
+        with self._lock:
+            if job_id in self._jobs and not self._closed:
+                self._queue.append((job_id, step))
+                self._dispatch()
+
+    def _replace_pool(self) -> None:
+        # every future of a broken pool fails, the next submit starts a fresh one
+        if self._pool is not None and getattr(self._pool, "_broken", False):
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _update(self, job: Job) -> None:
+        finished = [status for status in job.steps.values() if status.status in ("done", "failed")]
+        job.progress = round(len(finished) / len(job.steps), 3)
+        if len(finished) == len(job.steps):
+            job.status = "failed" if any(status.status == "failed" for status in finished) else "done"
+            job.finished_at = time.time()
+            self._finished[job.job_id] = None
+            while len(self._finished) > self.settings.max_finished:
+                oldest, _ = self._finished.popitem(last=False)
+                del self._jobs[oldest]
+
+    def shutdown(self) -> None:
+        """
+        stop handing out steps and stop the workers, what is queued is dropped
+        """
+        with self._lock:
+            self._closed = True
+            self._queue.clear()
+            pool, self._pool = self._pool, None
+        if self in _pipelines:
+            _pipelines.remove(self)
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def enqueue_saved(jobs: Optional[UploadJobs], sha256: str, filename: str, content_type: Optional[str]) -> Optional[str]:
+    """
+    enqueue the job for a stored file from an upload endpoint: its id, or None when there is no pipeline or it is full
+    """
+    if jobs is None:
+        return None
+    try:
+        return jobs.enqueue(sha256, filename, content_type).job_id
+    except JobQueueFull as error:
+        logger.warning("no post-upload job for %s: %s", filename, error)
+        return None
+
+
+# ------------------------------
+# Endpoints
+# ------------------------------
+router = APIRouter(prefix="/jobs", tags=["post-upload jobs"])
+
+@router.get("/{job_id}")
+def job_status(job_id: str, request: Request) -> Job:
+    """
+    status, progress and the results so far of the post-upload job of a file (its id is the file's SHA-256)
+    """
+    job = request.app.state.upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
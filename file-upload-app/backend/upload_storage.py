@@ -0,0 +1,280 @@
+"""
+Streaming file storage for the upload endpoints in file_upload.py.
+
+The idea: never hold a whole file in memory and never block the event loop on disk I/O.
+- Bytes are written CHUNK_SIZE at a time into a temporary file under UPLOAD_DIR/.incoming, the actual write()
+  calls run in a worker thread (anyio.to_thread) so the event loop keeps serving other requests.
+  The SHA-256 of the content is computed in the same pass, chunk by chunk, while writing.
+- With BLOB_COMPRESSION set, compressible content is compressed in the same pass (see blob_encoding.py), the hash is
+  still the one of the original bytes.
+- When the upload is complete the temp file is fsync'ed and handed to the BlobStore (blob_store.py), which renames it
+  into place under its hash atomically, or just deletes it when the same content is already stored.
+- If anything fails half way, the temp file is deleted.
+"""
+
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, List, Optional
+
+import anyio
+from fastapi import Request, UploadFile
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from blob_encoding import BLOB_COMPRESSION_BYTES, choose_encoding
+from blob_store import BlobStore
+from response_compression import Compressor, compressor
+
+# how much is buffered in memory before it is handed to the disk, this is also the memory used per upload
+CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+# name of the folder inside UPLOAD_DIR where uploads are written until they are complete
+INCOMING_DIR_NAME = ".incoming"
+
+
+class UploadError(ValueError):
+    """
+    The upload itself is invalid (bad multipart body, missing file name, ...), the endpoints turn it into a 400.
+    """
+
+
+@dataclass
+class SavedFile:
+    filename: str
+    content_type: Optional[str]
+    size: int
+    sha256: str
+    deduplicated: bool = False  # the content was already stored, this upload only added a name for it
+
+
+def safe_filename(filename: Optional[str]) -> str:
+    """
+    strip any directory part from a client supplied file name, so "../../etc/passwd" can't escape UPLOAD_DIR
+    """
+    name = Path((filename or "").replace("\\", "/")).name
+    if name in ("", ".", "..") or name.startswith("."):
+        raise UploadError(f"Invalid file name: {filename!r}")
+    return name
+
+
+class TempUpload:
+    """
+    A file being received: buffers up to CHUNK_SIZE bytes, writes and hashes them off the event loop,
+    and on commit() stores the finished file in the BlobStore.
+    """
+
+    def __init__(self, store: BlobStore, filename: str, content_type: Optional[str] = None):
+        self.store = store
+        self.filename = safe_filename(filename)
+        self.content_type = content_type
+        self.size = 0
+        self._buffer = bytearray()
+        self._file = None
+        self._temp_path: Optional[Path] = None
+        self._hasher = hashlib.sha256()
+        self._decided = False
+        self._encoder: Optional[Compressor] = None  # set when the file is stored compressed
+
+    def _choose_encoding(self, head: bytes) -> None:
+        encoding = choose_encoding(head, self.size, self.store.compression)
+        if encoding is not None:
+            self._encoder = compressor(encoding, self.store.compression.level)
+        self._decided = True
+
+    async def open(self) -> "TempUpload":
+        incoming = self.store.root / INCOMING_DIR_NAME
+        def create():
+            incoming.mkdir(parents=True, exist_ok=True)
+            fd, name = tempfile.mkstemp(dir=incoming, prefix="upload-", suffix=".part")
+            return os.fdopen(fd, "wb", buffering=0), Path(name)
+        self._file, self._temp_path = await anyio.to_thread.run_sync(create)
+        return self
+
+    async def write(self, data: bytes) -> None:
+        self._buffer += data
+        self.size += len(data)
+        if len(self._buffer) >= CHUNK_SIZE:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        if self._buffer:
+            data, self._buffer = bytes(self._buffer), bytearray()
+            def write_and_hash():
+                if not self._decided:
+                    # on the first chunk: whether to store the file compressed, from what it starts with
+                    self._choose_encoding(data)
+                # hashlib and zlib release the GIL on big buffers, so hashing in the worker thread is truly off the event loop
+                self._hasher.update(data)
+                self._file.write(self._encoder.compress(data) if self._encoder is not None else data)
+            await anyio.to_thread.run_sync(write_and_hash)
+
+    async def commit(self) -> SavedFile:
+        """
+        flush what is left, make the bytes durable, then move the temp file into the content-addressed store
+        """
+        await self._flush()
+        sha256 = self._hasher.hexdigest()
+        encoding = None if self._encoder is None else self._encoder.encoding
+        def finish():
+            if self._encoder is not None:
+                self._file.write(self._encoder.finish())
+            stored = self._file.tell()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            result = self.store.put(self._temp_path, sha256, self.filename, self.size, self.content_type, encoding)
+            if encoding is not None and not result.deduplicated:
+                BLOB_COMPRESSION_BYTES.inc(self.size, encoding=encoding, stage="original")
+                BLOB_COMPRESSION_BYTES.inc(stored, encoding=encoding, stage="stored")
+            return result
+        result = await anyio.to_thread.run_sync(finish)
+        return SavedFile(self.filename, self.content_type, self.size, sha256, result.deduplicated)
+
+    async def abort(self) -> None:
+        """
+        throw the partial upload away
+        """
+        self._buffer = bytearray()
+        def cleanup():
+            if self._file is not None:
+                self._file.close()
+            if self._temp_path is not None:
+                self._temp_path.unlink(missing_ok=True)
+        await anyio.to_thread.run_sync(cleanup)
+
+
+async def save_stream(chunks: AsyncIterator[bytes], store: BlobStore, filename: str,
+                      content_type: Optional[str] = None) -> SavedFile:
+    """
+    store an async stream of bytes as `filename`, O(CHUNK_SIZE) memory whatever the size of the stream
+    """
+    upload = await TempUpload(store, filename, content_type).open()
+    try:
+        async for chunk in chunks:
+            await upload.write(chunk)
+        return await upload.commit()
+    except BaseException:
+        with anyio.CancelScope(shield=True):
+            await upload.abort()
+        raise
+
+
+async def iter_upload_file(upload_file: UploadFile, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    read an UploadFile (already spooled by starlette) chunk by chunk
+    """
+    while chunk := await upload_file.read(chunk_size):
+        yield chunk
+
+
+async def save_upload_files(upload_files: List[UploadFile], store: BlobStore, max_parallel: int) -> List[SavedFile]:
+    """
+    save several UploadFile's at the same time, with at most max_parallel of them copying at once
+    """
+    # reject bad file names before anything is written, instead of failing half way through the batch
+    for upload_file in upload_files:
+        safe_filename(upload_file.filename)
+    results: List[Optional[SavedFile]] = [None] * len(upload_files)
+    limiter = anyio.CapacityLimiter(max_parallel)
+
+    async def save(index: int, upload_file: UploadFile):
+        async with limiter:
+            results[index] = await save_stream(iter_upload_file(upload_file), store,
+                                               upload_file.filename, upload_file.content_type)
+
+    async with anyio.create_task_group() as tasks:
+        for index, upload_file in enumerate(upload_files):
+            tasks.start_soon(save, index, upload_file)
+    return results
+
+
+# ------------------------------
+# Streaming multipart parsing
+# ------------------------------
+# For List[UploadFile] parameters starlette first receives the whole multipart body into SpooledTemporaryFile's
+# (in memory up to 1MB, then on disk), and only then calls the endpoint, which copies the files once more.
+# save_multipart_stream() instead feeds the request body straight into python-multipart's parser and writes every
+# file part directly into its TempUpload while the body is still arriving: one pass over the bytes, no spooling,
+# and nothing of the file is held in memory beyond the current network chunk + CHUNK_SIZE.
+# ------------------------------
+class _PartCollector:
+    """
+    the parser callbacks are synchronous, they only record what happened. The async code in
+    save_multipart_stream() then acts on the recorded events after every network chunk.
+    """
+
+    def __init__(self):
+        self.events: list = []
+        self._header_name = b""
+        self._header_value = b""
+        self._headers: dict[bytes, bytes] = {}
+
+    def on_part_begin(self):
+        self._headers = {}
+
+    def on_header_field(self, data, start, end):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name, self._header_value = b"", b""
+
+    def on_headers_finished(self):
+        self.events.append(("headers", self._headers))
+
+    def on_part_data(self, data, start, end):
+        self.events.append(("data", data[start:end]))
+
+    def on_part_end(self):
+        self.events.append(("end", None))
+
+    def callbacks(self) -> dict:
+        return {name: getattr(self, name) for name in (
+            "on_part_begin", "on_header_field", "on_header_value", "on_header_end",
+            "on_headers_finished", "on_part_data", "on_part_end")}
+
+
+async def save_multipart_stream(request: Request, store: BlobStore) -> List[SavedFile]:
+    """
+    parse a multipart/form-data request body while it streams in, saving every file part into the store.
+    Non-file form fields are ignored.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError("Expected a multipart/form-data body with a boundary")
+
+    collector = _PartCollector()
+    parser = MultipartParser(params[b"boundary"], collector.callbacks())
+    saved: List[SavedFile] = []
+    current: Optional[TempUpload] = None
+    try:
+        async for chunk in request.stream():
+            try:
+                parser.write(chunk)
+            except Exception as error:
+                raise UploadError(f"Invalid multipart body: {error}")
+            events, collector.events = collector.events, []
+            for kind, value in events:
+                if kind == "headers":
+                    _, options = parse_options_header(value.get(b"content-disposition", b""))
+                    if b"filename" in options:
+                        current = await TempUpload(store, options[b"filename"].decode("utf-8", "replace"),
+                                                   value.get(b"content-type", b"").decode("latin-1") or None).open()
+                elif kind == "data" and current is not None:
+                    await current.write(value)
+                elif kind == "end" and current is not None:
+                    saved.append(await current.commit())
+                    current = None
+        parser.finalize()
+        if current is not None:
+            raise UploadError("Multipart body ended in the middle of a file")
+    except BaseException:
+        if current is not None:
+            with anyio.CancelScope(shield=True):
+                await current.abort()
+        raise
+    return saved
@@ -1,15 +1,36 @@
-import { useState } from "react"
+import { useEffect, useState } from "react"
 
 /*
 * This FileForm component is he practice of uploading files from a React frontend to fast api backend server.
 * Then once the file is selected and user click the upload button, the file will be sent to the backend server using fetch API via POSt request.
 * Then the backend server will handle the file upload and save it to the specified directory, in this exercise, the uploaded file will be send to /FastAPI_Learning/uploads directory.
 * The updates made in this FileForm component enables the user to select multiple files and upload all of them to the backend server.
+* The uploaded files are listed below the form, each one links to GET /files/{name} so the browser can preview it.
+* The backend serves those with Range support, so e.g. a large video starts playing without downloading the whole file first.
 */
 
+const BACKEND_URL = "http://localhost:8000";
+
+type StoredFile = { filename: string; size: number; content_type: string | null };
+
 export default function FileForm() {
     // State to hold the selected file
     const [files, setFiles] = useState <File[]> ([]);
+    // the files already stored on the backend, fetched from GET /files
+    const [storedFiles, setStoredFiles] = useState <StoredFile[]> ([]);
+
+    const loadStoredFiles = async () => {
+        try {
+            const response = await fetch(`${BACKEND_URL}/files`);
+            if (response.ok) {
+                setStoredFiles(await response.json());
+            }
+        } catch (error) {
+            console.error("Error loading the stored files:", error);
+        }
+    }
+    // load the list once when the component is first rendered
+    useEffect(() => { loadStoredFiles(); }, []);
     // this function handles the file selection event
     const handleFileUpload = (event: React.ChangeEvent<HTMLInputElement>) => {
         // this is just using ternary operator to check if the event target files is not null, then convert the FileList object to an array using Array.from() method.
@@ -38,7 +59,7 @@ export default function FileForm() {
         // Then using try catch block for the fetch request to upload the file to the backend server
         try {
             // point to the backend server api endpoint where the file will be uploaded
-            const endpoint = "http://localhost:8000/upload_file";
+            const endpoint = `${BACKEND_URL}/upload_file`;
             // use fetch API to send a POST request to the backend server with the FormData object
             const response = await fetch(endpoint, {
                 method: "POST",
@@ -46,6 +67,7 @@ export default function FileForm() {
             })
             if (response.ok) {
                 console.log("File uploaded successfully");
+                await loadStoredFiles();
             } else {
                 console.error("File upload failed:", response.statusText);
             }
@@ -63,6 +85,17 @@ export default function FileForm() {
             </form>
         {/* just checking the uploaded file name(for debug purpose}*/}
             {files && files.map((file) => (<p key={file.name}>{file.name}</p>))}
+            <h2>Uploaded files</h2>
+            <ul>
+                {storedFiles.map((file) => (
+                    <li key={file.filename}>
+                        {/* encodeURIComponent because file names can contain spaces, # or ? */}
+                        <a href={`${BACKEND_URL}/files/${encodeURIComponent(file.filename)}`} target="_blank" rel="noreferrer">
+                            {file.filename}
+                        </a> ({file.size} bytes)
+                    </li>
+                ))}
+            </ul>
         </div>
     )
 }
\ No newline at end of file
@@ -0,0 +1,286 @@
+"""
+Request instrumentation for the apps in this repo, exported on GET /metrics (see metrics.py).
+
+InstrumentationMiddleware records, per app and route template (/users/{user_id}/, not /users/101/):
+ http_request_duration_seconds   latency histogram, by method, route and status class (2xx, 4xx, ...)
+ http_requests_in_flight         requests currently being handled
+ http_request_bytes_total        request body bytes received
+ http_response_bytes_total       response body bytes sent
+ db_time_per_request_seconds     time spent in database statements during the request, and
+ db_statements_per_request       how many there were, for every engine passed to instrument_engine()
+
+The DB time is measured with SQLAlchemy's before/after_cursor_execute events and added to a per-request
+accumulator held in a contextvar. Context variables follow the request into the threadpool (run_in_threadpool)
+and into AsyncSession's greenlets, so statements run from sync and async endpoints are attributed alike.
+
+Everything above is a few dict updates per request and stays on. The sampling profiler is off unless PROFILER_ENABLED
+is set (PROFILER_* environment variables, see ProfilerSettings): a background thread then snapshots the stack of
+every thread each interval_ms into a ring buffer. When a request takes longer than slow_ms, the samples taken
+while it ran are written to output_dir as a collapsed-stack file ("frame;frame;frame <count>" per line), which
+flamegraph.pl, speedscope or inferno render directly. The samples cover the whole process, so under concurrency a
+dump also contains what the other requests were doing at that time.
+"""
+
+import contextvars
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, Field
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from metrics import REGISTRY
+
+if TYPE_CHECKING:
+    # only instrument_engine() needs SQLAlchemy, the apps without a database (the upload backend) don't pay for importing it
+    from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+REQUEST_DURATION = REGISTRY.histogram(
+    "http_request_duration_seconds", "Time from receiving the request to sending the last response byte",
+    ["app", "method", "route", "status"])
+REQUESTS_IN_FLIGHT = REGISTRY.gauge("http_requests_in_flight", "Requests currently being handled", ["app"])
+REQUEST_BYTES = REGISTRY.counter("http_request_bytes_total", "Request body bytes received", ["app", "route"])
+RESPONSE_BYTES = REGISTRY.counter("http_response_bytes_total", "Response body bytes sent", ["app", "route"])
+DB_TIME = REGISTRY.histogram(
+    "db_time_per_request_seconds", "Time spent executing database statements per request", ["app", "route"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+DB_STATEMENTS = REGISTRY.histogram(
+    "db_statements_per_request", "Database statements executed per request", ["app", "route"],
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100, 1000))
+
+UNMATCHED_ROUTE = "unmatched"
+
+
+# ------------------------------
+# DB time per request
+# ------------------------------
+class _DBTimer:
+    __slots__ = ("seconds", "statements")
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.statements = 0
+
+_current_db_timer: contextvars.ContextVar[Optional[_DBTimer]] = contextvars.ContextVar("db_timer", default=None)
+
+
+def instrument_engine(engine: "Engine") -> None:
+    """
+    add the statement timing hooks to a (sync) engine, for an AsyncEngine pass async_engine.sync_engine
+    """
+    from sqlalchemy import event
+
+    if getattr(engine, "_request_timing", False):
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        timer = _current_db_timer.get()
+        if timer is not None:
+            timer.seconds += time.perf_counter() - started
+            timer.statements += 1
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        # a failed statement never reaches after_cursor_execute
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_started"):
+            connection.info["query_started"].pop()
+
+    engine._request_timing = True
+
+
+# ------------------------------
+# Sampling profiler
+# ------------------------------
+class ProfilerSettings(BaseModel):
+    """
+    Every field can be overridden with an environment variable named PROFILER_<FIELD NAME>, e.g. PROFILER_ENABLED=true.
+    """
+    enabled: bool = Field(default=False, description="run the sampling thread and dump the stacks of slow requests")
+    slow_ms: float = Field(default=500, gt=0, description="requests slower than this get their stacks dumped")
+    interval_ms: float = Field(default=10, gt=0, description="time between two stack samples")
+    retention_s: float = Field(default=60, gt=0, description="how far back the ring buffer of samples goes")
+    min_dump_interval_s: float = Field(default=5, ge=0, description="at most one dump per this many seconds, so a slow period doesn't fill the disk")
+    output_dir: str = Field(default="profiles", description="where the .folded files are written")
+
+    @classmethod
+    def from_env(cls, prefix: str = "PROFILER_", **overrides) -> "ProfilerSettings":
+        values = {}
+        for name in cls.model_fields:
+            env_value = os.getenv(prefix + name.upper())
+            if env_value is not None:
+                values[name] = env_value
+        values.update(overrides)
+        return cls(**values)
+
+
+class SamplingProfiler:
+    def __init__(self, settings: ProfilerSettings):
+        self.settings = settings
+        self._samples: Deque[Tuple[float, Tuple[str, ...]]] = deque(
+            maxlen=int(settings.retention_s * 1000 / settings.interval_ms) * 8)
+        self._labels: Dict[object, str] = {}  # code object -> frame label, formatted once
+        self._pending: Deque[Tuple[float, float, str]] = deque()
+        self._last_dump = 0.0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def _sample(self) -> None:
+        now = time.perf_counter()
+        own_thread = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack: List[str] = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            with self._lock:
+                self._samples.append((now, tuple(stack)))
+
+    def _run(self) -> None:
+        interval = self.settings.interval_ms / 1000
+        while True:
+            self._sample()
+            while self._pending:
+                self._dump(*self._pending.popleft())
+            time.sleep(interval)
+
+    def request_finished(self, started: float, finished: float, name: str) -> None:
+        """
+        called for every request, queues a dump if it was slow (the sampler thread writes it, not the event loop)
+        """
+        if (finished - started) * 1000 < self.settings.slow_ms:
+            return
+        if finished - self._last_dump < self.settings.min_dump_interval_s:
+            return
+        self._last_dump = finished
+        self._pending.append((started, finished, name))
+
+    def _dump(self, started: float, finished: float, name: str) -> None:
+        with self._lock:
+            stacks = [stack for at, stack in self._samples if started <= at <= finished]
+        if not stacks:
+            return
+        counts: Dict[Tuple[str, ...], int] = {}
+        for stack in stacks:
+            counts[stack] = counts.get(stack, 0) + 1
+        output = Path(self.settings.output_dir)
+        path = output / f"{time.strftime('%Y%m%d-%H%M%S')}-{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')}-{int((finished - started) * 1000)}ms.folded"
+        try:
+            output.mkdir(parents=True, exist_ok=True)
+            path.write_text("".join(f"{';'.join(stack)} {count}\n" for stack, count in counts.items()))
+        except OSError as error:
+            logger.warning("could not write profile %s: %s", path, error)
+            return
+        logger.info("slow request %s (%.0f ms), stacks written to %s", name, (finished - started) * 1000, path)
+
+
+# ------------------------------
+# Middleware
+# ------------------------------
+def route_template(scope: Scope) -> str:
+    """
+    the path template of the route that handled the request: the router put the matched route into the scope.
+    A response that never reached the router (e.g. a response cache hit) is matched here instead.
+    """
+    route = scope.get("route")
+    if route is None and "app" in scope:
+        for candidate in scope["app"].router.routes:
+            match, child_scope = candidate.matches(scope)
+            if match == Match.FULL:
+                route = candidate
+                break
+    return getattr(route, "path", None) or UNMATCHED_ROUTE
+
+
+class InstrumentationMiddleware:
+    def __init__(self, app: ASGIApp, app_name: str, profiler: Optional[SamplingProfiler] = None):
+        self.app = app
+        self.app_name = app_name
+        self.profiler = profiler
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        timer = _DBTimer()
+        token = _current_db_timer.set(timer)
+        request_bytes = 0
+        response_bytes = 0
+        status = 500
+
+        async def counting_receive() -> Message:
+            nonlocal request_bytes
+            message = await receive()
+            request_bytes += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message: Message) -> None:
+            nonlocal response_bytes, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc(app=self.app_name)
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            finished = time.perf_counter()
+            _current_db_timer.reset(token)
+            REQUESTS_IN_FLIGHT.dec(app=self.app_name)
+            route_name = route_template(scope)
+            REQUEST_DURATION.observe(finished - started, app=self.app_name, method=scope["method"], route=route_name,
+                                     status=f"{status // 100}xx")
+            REQUEST_BYTES.inc(request_bytes, app=self.app_name, route=route_name)
+            RESPONSE_BYTES.inc(response_bytes, app=self.app_name, route=route_name)
+            if timer.statements:
+                DB_TIME.observe(timer.seconds, app=self.app_name, route=route_name)
+                DB_STATEMENTS.observe(timer.statements, app=self.app_name, route=route_name)
+            if self.profiler is not None:
+                self.profiler.request_finished(started, finished, f"{scope['method']} {route_name}")
+
+
+def instrument_app(app, name: str, profiler_settings: Optional[ProfilerSettings] = None) -> Optional[SamplingProfiler]:
+    """
+    add the InstrumentationMiddleware to `app` and start the profiler if PROFILER_ENABLED is set.
+    Call it after adding the other middleware, so the measured time includes them (e.g. the response cache).
+    """
+    settings = profiler_settings or ProfilerSettings.from_env()
+    profiler = None
+    if settings.enabled:
+        profiler = SamplingProfiler(settings)
+        profiler.start()
+    app.add_middleware(InstrumentationMiddleware, app_name=name, profiler=profiler)
+    return profiler
@@ -0,0 +1,539 @@
+"""
+The Item model and its /items/ endpoints, shared by sqlmodel_learn.py (SQLite) and superbase_learn.py (Supabase Postgres).
+Both apps expose exactly the same API, the only difference is the database engine they connect to, so the endpoints live
+here in an APIRouter and each app includes the router and puts its own engine(s) on app.state.
+"""
+
+import functools
+import json
+import logging
+from typing import Optional, List, Sequence, Tuple, Iterator, AsyncIterator, Callable, TypeVar, Any
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from sqlalchemy import Index, Integer, bindparam, column, insert, text
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import SQLModel, Field, Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from admission import admitted
+from database import Database, ensure_schema, schema_version
+from fast_json import FastJSONResponse, dumps, fast_json
+from response_cache import cached, invalidates
+from response_compression import compressed
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ItemBase(SQLModel):
+    """
+    The fields a client sends for an item, without the database generated id.
+    """
+    name: str
+    price: float
+    is_offered: bool = False
+
+class Item(ItemBase, table=True):
+    """
+    Represents an item in the database.
+    The indexes serve the filters of GET /items/, see create_search_indexes() for the name search ones.
+    """
+    __table_args__ = (
+        Index("ix_item_name", "name"),                           # name_prefix, sort=name
+        Index("ix_item_price", "price"),                         # min_price / max_price, sort=price
+        Index("ix_item_is_offered_price", "is_offered", "price"),  # is_offered, with or without a price range
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+
+
+# ------------------------------
+# Session dependency
+# ------------------------------
+# The endpoints are `async def`, so a plain Session would block the event loop on every query and commit,
+# one slow query then stalls every other request of the worker.
+# Each app stores its database on app.state.database (see database.Database): database.engine (sync, always there)
+# and database.async_engine (aiosqlite/asyncpg, None when running in sync mode), created on first use. The engine
+# dependencies wait for the app's startup work (prepare_item_schema(), warm-up) before the first query.
+# The dependency opens one session per request and closes it afterwards.
+# The database work itself is written once, as plain functions taking a Session, and ItemDB.run() decides how to call it:
+#  async mode: AsyncSession.run_sync(), the function runs on the event loop but every query is awaited under the hood.
+#  sync mode: the function runs in the threadpool with a normal Session, so the event loop is still free.
+# ------------------------------
+class ItemDB:
+    """
+    A per-request database handle, wraps either an AsyncSession or a sync Session.
+    """
+
+    def __init__(self, session: Session | AsyncSession):
+        self.session = session
+
+    @property
+    def is_async(self) -> bool:
+        return isinstance(self.session, AsyncSession)
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """
+        run a sync-style database function fn(session, *args) without blocking the event loop
+        """
+        if isinstance(self.session, AsyncSession):
+            return await self.session.run_sync(fn, *args)
+        return await run_in_threadpool(fn, self.session, *args)
+
+
+async def get_database(request: Request) -> Database:
+    database: Database = request.app.state.database
+    await database.ready()
+    return database
+
+async def get_engine(database: Database = Depends(get_database)) -> Engine:
+    return database.engine
+
+async def get_async_engine(database: Database = Depends(get_database)) -> Optional[AsyncEngine]:
+    return database.async_engine
+
+async def get_db(engine: Engine = Depends(get_engine),
+                 async_engine: Optional[AsyncEngine] = Depends(get_async_engine)) -> AsyncIterator[ItemDB]:
+    if async_engine is not None:
+        async with AsyncSession(async_engine) as session:
+            yield ItemDB(session)
+    else:
+        session = Session(engine)
+        try:
+            yield ItemDB(session)
+        finally:
+            await run_in_threadpool(session.close)
+
+
+router = APIRouter()
+
+# INSERT ... RETURNING sends the new row back with the insert, instead of a second SELECT to refresh the object
+INSERT_ITEM = insert(Item.__table__).returning(*Item.__table__.c)
+
+def insert_item(session: Session, item: Item) -> Item:
+    connection = session.connection()
+    if not connection.dialect.insert_returning:
+        session.add(item)
+        session.commit()
+        session.refresh(item)
+        return item
+    # the id is left out unless the client chose one, so the database generates it
+    row = connection.execute(INSERT_ITEM, item.model_dump(exclude={"id"} if item.id is None else None)).one()
+    session.commit()
+    return Item(**row._mapping)
+
+@router.post("/items/", response_model=Item)
+@admitted("db")
+@invalidates("items")
+@fast_json
+async def create_item(item: Item, db: ItemDB = Depends(get_db)) -> Item:
+    """
+    This path operation function creates a new item in the database.
+    :param item: The item to be created, should be an instance of the Item model.
+    :return: the created item.
+    """
+    return await db.run(insert_item, item)
+
+
+# ------------------------------
+# Filtering, sorting and column selection for GET /items/
+# ------------------------------
+# Clients used to download the whole table and filter it themselves. The filters below are compiled into the WHERE,
+# ORDER BY and column list of one parameterised SELECT, so the database answers from its indexes (see Item):
+#  min_price / max_price   inclusive price range               -> ix_item_price, or ix_item_is_offered_price
+#  is_offered              true / false                        -> ix_item_is_offered_price
+#  name_prefix             case-sensitive prefix of the name   -> range scan on ix_item_name (SQLite) / LIKE 'x%' (Postgres)
+#  name_contains           case-insensitive substring          -> FTS5 trigram table (SQLite) / pg_trgm GIN index (Postgres)
+#  sort                    id, name or price, -price for descending, ties are broken by id
+#  fields                  e.g. fields=name,price: only these columns are selected and sent (the id always is)
+# ------------------------------
+SORTABLE_COLUMNS = ("id", "name", "price")
+SELECTABLE_COLUMNS = ("id", "name", "price", "is_offered")
+ITEM_FTS_TABLE = "item_fts"
+# the FTS5 trigram tokenizer only indexes 3 character sequences, shorter searches fall back to LIKE
+FTS_MIN_LENGTH = 3
+
+class ItemFilter(BaseModel):
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    is_offered: Optional[bool] = None
+    name_prefix: Optional[str] = None
+    name_contains: Optional[str] = None
+    sort: str = "id"
+    fields: Optional[List[str]] = None
+
+def item_filter(min_price: Optional[float] = None, max_price: Optional[float] = None, is_offered: Optional[bool] = None,
+                name_prefix: Optional[str] = Query(None, min_length=1, max_length=100),
+                name_contains: Optional[str] = Query(None, min_length=1, max_length=100),
+                sort: str = Query("id", pattern=r"^-?(id|name|price)$", description="column to order by, prefix with - for descending"),
+                fields: Optional[str] = Query(None, description="comma separated columns to return, e.g. name,price")) -> ItemFilter:
+    """
+    dependency: the filter query parameters of GET /items/
+    """
+    columns = None
+    if fields is not None:
+        columns = [name.strip() for name in fields.split(",") if name.strip()]
+        unknown = [name for name in columns if name not in SELECTABLE_COLUMNS]
+        if unknown or not columns:
+            raise HTTPException(status_code=400, detail=f"fields must be a comma separated list of {', '.join(SELECTABLE_COLUMNS)}")
+        columns = ["id"] + [name for name in SELECTABLE_COLUMNS[1:] if name in columns]
+    return ItemFilter(min_price=min_price, max_price=max_price, is_offered=is_offered, name_prefix=name_prefix,
+                      name_contains=name_contains, sort=sort, fields=columns)
+
+def create_search_indexes(engine: Engine) -> bool:
+    """
+    Create the indexes of Item on an existing table (create_all only creates them with a new table) and the
+    name_contains search structure of the dialect. Returns True if the SQLite FTS5 table is available.
+     SQLite:   an external content FTS5 table with the trigram tokenizer (SQLite >= 3.34) over item.name,
+               kept in sync by triggers, so POST /items/ and the bulk insert don't have to know about it.
+     Postgres: the pg_trgm extension and a GIN trigram index on item.name, used by ILIKE '%x%' (and LIKE 'x%').
+    If either can't be created (old SQLite, no permission for the extension), name_contains still works, with a scan.
+    """
+    for index in Item.__table__.indexes:
+        index.create(engine, checkfirst=True)
+    dialect = engine.dialect.name
+    try:
+        with engine.begin() as connection:
+            if dialect == "sqlite":
+                exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                                            {"name": ITEM_FTS_TABLE}).first()
+                if exists:
+                    return True
+                connection.execute(text(f"CREATE VIRTUAL TABLE {ITEM_FTS_TABLE} USING fts5("
+                                        f"name, content='item', content_rowid='id', tokenize='trigram')"))
+                connection.execute(text(f"CREATE TRIGGER {ITEM_FTS_TABLE}_insert AFTER INSERT ON item BEGIN "
+                                        f"INSERT INTO {ITEM_FTS_TABLE}(rowid, name) VALUES (new.id, new.name); END"))
+                connection.execute(text(f"CREATE TRIGGER {ITEM_FTS_TABLE}_delete AFTER DELETE ON item BEGIN "
+                                        f"INSERT INTO {ITEM_FTS_TABLE}({ITEM_FTS_TABLE}, rowid, name) VALUES ('delete', old.id, old.name); END"))
+                connection.execute(text(f"CREATE TRIGGER {ITEM_FTS_TABLE}_update AFTER UPDATE OF name ON item BEGIN "
+                                        f"INSERT INTO {ITEM_FTS_TABLE}({ITEM_FTS_TABLE}, rowid, name) VALUES ('delete', old.id, old.name); "
+                                        f"INSERT INTO {ITEM_FTS_TABLE}(rowid, name) VALUES (new.id, new.name); END"))
+                # index the rows that are already there
+                connection.execute(text(f"INSERT INTO {ITEM_FTS_TABLE}({ITEM_FTS_TABLE}) VALUES ('rebuild')"))
+                return True
+            if dialect == "postgresql":
+                connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                connection.execute(text("CREATE INDEX IF NOT EXISTS ix_item_name_trgm ON item USING gin (name gin_trgm_ops)"))
+    except SQLAlchemyError as error:
+        logger.warning("name search index not available on %s, name_contains will scan the table: %s", dialect, error)
+    return False
+
+# bump when create_search_indexes() changes: its FTS5 table, triggers and trigram index are raw SQL, so the version
+# computed from the DDL of the Item table doesn't see them
+ITEM_SCHEMA_REVISION = "1"
+
+def prepare_item_schema(engine: Engine) -> bool:
+    """
+    Create the item table, its indexes and its name search structure, unless the schema version stored in the database
+    (see database.ensure_schema()) says they are already there. Returns create_search_indexes()'s result, stored
+    along with the version so a start with an up to date schema knows it without asking the database.
+    """
+    def create(engine: Engine) -> str:
+        SQLModel.metadata.create_all(engine, tables=[Item.__table__])
+        return "fts" if create_search_indexes(engine) else "scan"
+
+    version = schema_version([Item.__table__], engine.dialect, ITEM_SCHEMA_REVISION)
+    return ensure_schema(engine, "item", version, create) == "fts"
+
+def _like_pattern(value: str) -> str:
+    # LIKE wildcards in the value match themselves, / is the ESCAPE character of the statements below
+    return value.replace("/", "//").replace("%", "/%").replace("_", "/_")
+
+def _uses_fts(dialect: str, name_contains: Optional[str], fts: bool) -> bool:
+    return fts and dialect == "sqlite" and name_contains is not None and len(name_contains) >= FTS_MIN_LENGTH
+
+
+# ------------------------------
+# Statement cache
+# ------------------------------
+# Building a select() with a handful of where() clauses and letting SQLAlchemy derive its cache key costs more than
+# running the query on a warm SQLite connection. So every statement is built once per *shape* (which filters are
+# set, the sort, the columns, the dialect) with bind parameters in place of the values, and kept by _items_statement's
+# lru_cache. A request only fills in the parameters: SQLAlchemy's compiled cache finds the SQL string of the same
+# statement object straight away, and on Postgres asyncpg keeps that SQL prepared on the connection
+# (DB_PREPARED_STATEMENT_CACHE_SIZE, see database.py), so the server doesn't parse and plan it again either.
+# There are only a few hundred shapes, the cache stays small.
+# The statements are Core selects of the table's columns, executed on the session's connection: the rows come back
+# as plain tuples and are turned into the response's dicts directly, no ORM objects, identity map or Item validation.
+# ------------------------------
+ITEM_COLUMNS = Item.__table__.c
+
+@functools.lru_cache(maxsize=None)
+def _items_statement(dialect: str, fields: Tuple[str, ...], after_id: bool, limit: bool, min_price: bool,
+                     max_price: bool, is_offered: bool, name_prefix: bool, name_contains: bool, fts: bool, sort: str):
+    statement = select(*(ITEM_COLUMNS[name] for name in fields))
+    if after_id:
+        statement = statement.where(ITEM_COLUMNS.id > bindparam("after_id"))
+    if min_price:
+        statement = statement.where(ITEM_COLUMNS.price >= bindparam("min_price"))
+    if max_price:
+        statement = statement.where(ITEM_COLUMNS.price <= bindparam("max_price"))
+    if is_offered:
+        statement = statement.where(ITEM_COLUMNS.is_offered == bindparam("is_offered"))
+    if name_prefix:
+        if dialect == "sqlite":
+            # SQLite only uses an index for LIKE with case_sensitive_like on, a range on the (binary collated) name always does
+            statement = statement.where(ITEM_COLUMNS.name >= bindparam("name_prefix"),
+                                        ITEM_COLUMNS.name < bindparam("name_prefix_end"))
+        else:
+            statement = statement.where(ITEM_COLUMNS.name.like(bindparam("name_prefix_pattern"), escape="/"))
+    if name_contains:
+        if fts:
+            matches = text(f"SELECT rowid FROM {ITEM_FTS_TABLE} WHERE {ITEM_FTS_TABLE} MATCH :name_match")
+            statement = statement.where(ITEM_COLUMNS.id.in_(matches.columns(column("rowid", Integer))))
+        else:
+            statement = statement.where(ITEM_COLUMNS.name.ilike(bindparam("name_contains_pattern"), escape="/"))
+    sort_column = ITEM_COLUMNS[sort.lstrip("-")]
+    if sort.startswith("-"):
+        statement = statement.order_by(sort_column.desc(), ITEM_COLUMNS.id.desc())
+    else:
+        statement = statement.order_by(sort_column, ITEM_COLUMNS.id)
+    if limit:
+        statement = statement.limit(bindparam("limit", type_=Integer))
+    return statement
+
+def items_query(after_id: Optional[int] = None, limit: Optional[int] = None, filters: Optional[ItemFilter] = None,
+                dialect: str = "sqlite", fts: bool = False) -> Tuple[Any, dict]:
+    """
+    the statement for a page of items and the parameters to execute it with
+    """
+    filters = filters or ItemFilter()
+    fts = _uses_fts(dialect, filters.name_contains, fts)
+    statement = _items_statement(dialect, tuple(filters.fields or SELECTABLE_COLUMNS), after_id is not None,
+                                 limit is not None, filters.min_price is not None, filters.max_price is not None,
+                                 filters.is_offered is not None, bool(filters.name_prefix), bool(filters.name_contains),
+                                 fts, filters.sort)
+    params = {"after_id": after_id, "limit": limit, "min_price": filters.min_price, "max_price": filters.max_price,
+              "is_offered": filters.is_offered}
+    if filters.name_prefix:
+        params["name_prefix"] = filters.name_prefix
+        params["name_prefix_end"] = filters.name_prefix + "\U0010ffff"
+        params["name_prefix_pattern"] = _like_pattern(filters.name_prefix) + "%"
+    if filters.name_contains:
+        # one phrase, so the trigram tokenizer matches it as a substring; " is escaped by doubling it
+        params["name_match"] = '"' + filters.name_contains.replace('"', '""') + '"'
+        params["name_contains_pattern"] = "%" + _like_pattern(filters.name_contains) + "%"
+    # parameters the statement doesn't have are ignored
+    return statement, params
+
+
+# ------------------------------
+# Pagination and streaming for GET /items/
+# ------------------------------
+# Keyset (cursor) pagination: /items/?limit=100&after_id=200 runs `WHERE id > 200 ORDER BY id LIMIT 101`,
+# which is an index range scan on the primary key no matter how deep into the table the client is.
+# When there are more rows the response carries an X-Next-After-Id header, the cursor for the next page.
+# The cursor only works with the default sort=id.
+# With ?stream=true the rows are sent as NDJSON (one JSON object per line): they are fetched from the database
+# STREAM_BATCH_SIZE rows at a time with yield_per and written out batch by batch, so neither the rows nor the
+# serialised response are ever held in memory all at once. A stream has no X-Next-After-Id header (it is only known
+# at the end), the id on the last line is the cursor for the next request.
+# ------------------------------
+NEXT_CURSOR_HEADER = "X-Next-After-Id"
+STREAM_BATCH_SIZE = 500
+
+def _ndjson(keys: Sequence[str], batch) -> bytes:
+    return b"".join(dumps(dict(zip(keys, row))) + b"\n" for row in batch)
+
+def fetch_items(session: Session, after_id: Optional[int], limit: Optional[int], filters: Optional[ItemFilter] = None,
+                fts: bool = False) -> List[dict]:
+    """
+    one page of items as dicts with the selected columns
+    """
+    connection = session.connection()
+    statement, params = items_query(after_id, limit, filters, connection.dialect.name, fts)
+    result = connection.execute(statement, params)
+    keys = tuple(result.keys())
+    return [dict(zip(keys, row)) for row in result]
+
+def stream_items(engine: Engine, after_id: Optional[int], limit: Optional[int], filters: Optional[ItemFilter] = None,
+                 fts: bool = False) -> Iterator[bytes]:
+    """
+    Generator behind the NDJSON mode. It opens its own connection because the request's session dependency
+    is already closed by the time the StreamingResponse starts pulling from it.
+    StreamingResponse runs a plain (sync) generator in the threadpool, so the blocking fetches don't stall the event loop.
+    """
+    statement, params = items_query(after_id, limit, filters, engine.dialect.name, fts)
+    with engine.connect() as connection:
+        result = connection.execute(statement, params, execution_options={"yield_per": STREAM_BATCH_SIZE})
+        keys = tuple(result.keys())
+        for batch in result.partitions():
+            yield _ndjson(keys, batch)
+
+async def astream_items(async_engine: AsyncEngine, after_id: Optional[int], limit: Optional[int],
+                        filters: Optional[ItemFilter] = None, fts: bool = False) -> AsyncIterator[bytes]:
+    """
+    Same as stream_items() for the async engine: stream() keeps a server side cursor open
+    and each batch is awaited, so the stream never blocks the event loop.
+    """
+    statement, params = items_query(after_id, limit, filters, async_engine.dialect.name, fts)
+    async with async_engine.connect() as connection:
+        result = await connection.stream(statement, params, execution_options={"yield_per": STREAM_BATCH_SIZE})
+        keys = tuple(result.keys())
+        async for batch in result.partitions():
+            yield _ndjson(keys, batch)
+
+def get_name_fts(request: Request, database: Database = Depends(get_database)) -> bool:
+    # set by the app's startup from prepare_item_schema(), once the database is ready
+    return getattr(request.app.state, "item_name_fts", False)
+
+@router.get("/items/", response_model=List[Item])
+@admitted("db")
+@compressed()
+@cached("items")
+async def get_items(after_id: Optional[int] = None,
+                    limit: Optional[int] = Query(None, gt=0, le=1000), stream: bool = False,
+                    filters: ItemFilter = Depends(item_filter), fts: bool = Depends(get_name_fts),
+                    engine: Engine = Depends(get_engine), async_engine: Optional[AsyncEngine] = Depends(get_async_engine),
+                    db: ItemDB = Depends(get_db)) -> Response:
+    """
+    This path operation function retrieves the items from the database, ordered by id unless sort says otherwise.
+    The rows are sent as they come from the database, with the columns of Item (or of `fields`): the response_model
+    documents them, FastAPI doesn't validate them again.
+    :param after_id: cursor, only return items with an id greater than this (sort=id only)
+    :param limit: page size, leave it out to get every item after the cursor
+    :param stream: return the items as an NDJSON stream instead of a JSON list
+    :param filters: min_price, max_price, is_offered, name_prefix, name_contains, sort and fields, see item_filter()
+    :return:
+    """
+    if after_id is not None and filters.sort != "id":
+        raise HTTPException(status_code=400, detail="after_id can only be used with sort=id")
+    if stream:
+        if async_engine is not None:
+            rows = astream_items(async_engine, after_id, limit, filters, fts)
+        else:
+            rows = stream_items(engine, after_id, limit, filters, fts)
+        return StreamingResponse(rows, media_type="application/x-ndjson")
+
+    # ask for one extra row so we know whether another page exists
+    items = await db.run(fetch_items, after_id, None if limit is None else limit + 1, filters, fts)
+    headers = {}
+    if limit is not None and len(items) > limit:
+        items = items[:limit]
+        if filters.sort == "id":
+            headers[NEXT_CURSOR_HEADER] = str(items[-1]["id"])
+    return FastJSONResponse(dumps(items), headers=headers)
+
+
+# ------------------------------
+# Bulk insert: POST /items/bulk
+# ------------------------------
+# POST /items/ costs one transaction and one extra SELECT (the refresh) per item, far too slow to load a catalog feed.
+# The bulk endpoint accepts either
+#  a JSON array of items (Content-Type: application/json), or
+#  an NDJSON stream, one item per line (Content-Type: application/x-ndjson), read from the request as it arrives.
+# The rows are validated chunk_size at a time with a TypeAdapter and every valid chunk is written with a single
+# executemany INSERT in its own transaction. SQLAlchemy batches that into multi-row INSERT ... VALUES statements
+# and adds RETURNING id when the backend supports it (SQLite >= 3.35, Postgres), so the ids come back without a re-SELECT.
+# A chunk that fails validation or insertion is skipped and reported, the rest of the load carries on.
+# ------------------------------
+BULK_CHUNK_SIZE = 1000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+item_chunk_adapter = TypeAdapter(List[ItemBase])
+
+class BulkChunkError(BaseModel):
+    chunk: int
+    first_row: int
+    rows: int
+    errors: List[dict[str, Any]]
+
+class BulkInsertResult(BaseModel):
+    received: int
+    inserted: int
+    failed: int
+    errors: List[BulkChunkError] = []
+    ids: Optional[List[int]] = None
+
+def insert_items(session: Session, rows: List[dict]) -> List[int]:
+    """
+    insert one validated chunk with a single executemany, returns the new ids if the backend supports RETURNING
+    """
+    statement = insert(Item.__table__)
+    if session.get_bind().dialect.insert_executemany_returning:
+        ids = list(session.execute(statement.returning(Item.__table__.c.id), rows).scalars())
+    else:
+        session.execute(statement, rows)
+        ids = []
+    session.commit()
+    return ids
+
+async def json_array_chunks(request: Request, chunk_size: int) -> AsyncIterator[List[ItemBase]]:
+    """
+    a JSON array can only be parsed as a whole, after that it is validated chunk by chunk
+    """
+    try:
+        rows = json.loads(await request.body())
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON body: {error}")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of items")
+    for start in range(0, len(rows), chunk_size):
+        yield rows[start:start + chunk_size]
+
+async def ndjson_chunks(request: Request, chunk_size: int) -> AsyncIterator[List[bytes]]:
+    """
+    split the NDJSON body into lines while it is still arriving, and hand them out chunk_size lines at a time
+    """
+    pending = b""
+    lines: List[bytes] = []
+    async for data in request.stream():
+        pending += data
+        *complete, pending = pending.split(b"\n")
+        lines.extend(line for line in complete if line.strip())
+        while len(lines) >= chunk_size:
+            yield lines[:chunk_size]
+            lines = lines[chunk_size:]
+    if pending.strip():
+        lines.append(pending)
+    if lines:
+        yield lines
+
+def validate_chunk(chunk: List[Any], is_ndjson: bool) -> List[ItemBase]:
+    if is_ndjson:
+        # glue the lines into one JSON array, so pydantic-core parses and validates them in one pass without building dicts
+        return item_chunk_adapter.validate_json(b"[" + b",".join(chunk) + b"]")
+    return item_chunk_adapter.validate_python(chunk)
+
+@router.post("/items/bulk", response_model=BulkInsertResult)
+@admitted("db")
+@invalidates("items")
+async def create_items_bulk(request: Request, chunk_size: int = Query(BULK_CHUNK_SIZE, gt=0, le=10000),
+                            return_ids: bool = False, db: ItemDB = Depends(get_db)) -> BulkInsertResult:
+    """
+    Insert many items at once, from a JSON array or an NDJSON stream.
+    :param chunk_size: rows validated and inserted per transaction
+    :param return_ids: include the ids of the inserted rows in the response (only on backends with RETURNING)
+    :return: how many rows were received and inserted, and the errors of the chunks that were skipped
+    """
+    is_ndjson = request.headers.get("content-type", "").split(";")[0].strip() == NDJSON_MEDIA_TYPE
+    chunks = ndjson_chunks(request, chunk_size) if is_ndjson else json_array_chunks(request, chunk_size)
+    result = BulkInsertResult(received=0, inserted=0, failed=0, ids=[] if return_ids else None)
+
+    chunk_number = 0
+    async for chunk in chunks:
+        first_row = result.received
+        result.received += len(chunk)
+        try:
+            items = validate_chunk(chunk, is_ndjson)
+            ids = await db.run(insert_items, [item.model_dump() for item in items])
+        except ValidationError as error:
+            errors = error.errors(include_url=False, include_input=False)
+            result.errors.append(BulkChunkError(chunk=chunk_number, first_row=first_row, rows=len(chunk), errors=errors))
+            result.failed += len(chunk)
+        except SQLAlchemyError as error:
+            await db.run(lambda session: session.rollback())
+            result.errors.append(BulkChunkError(chunk=chunk_number, first_row=first_row, rows=len(chunk),
+                                                errors=[{"type": "database_error", "msg": str(error.__cause__ or error)}]))
+            result.failed += len(chunk)
+        else:
+            result.inserted += len(items)
+            if return_ids:
+                result.ids.extend(ids)
+        chunk_number += 1
+    return result
@@ -1,6 +1,19 @@
-from fastapi import FastAPI, Path, Header
-from typing import Optional
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, Depends, FastAPI, Path, Header, Query, Request, Response
+from typing import Annotated, List, Literal, Optional, Union
+from pydantic import BaseModel, Field, TypeAdapter
+from starlette.concurrency import run_in_threadpool
+from order_store import DuplicateOrderError
+from order_columns import create_order_store
+from order_stats import DEFAULT_PERCENTILES
+from storage import DurableStore, StorageSettings, open_store
+from concurrency import VersionConflict, format_etag, parse_if_match, precondition_failed
+from fast_json import fast_json
+from response_cache import cached, invalidates, setup_response_cache
+from response_compression import compressed, setup_compression
+from instrumentation import instrument_app
+from batch import MAX_BATCH_OPERATIONS, BatchResult, OperationResult, batch_result, parse_batch
+import metrics
 
 # dummy json data for practice
 dummy_data = {
@@ -36,26 +49,69 @@ dummy_data = {
 
 
 
-# To start the server, run this command in the terminal: uvicorn main:app --reload
-app = FastAPI()
+def create_app(settings: Optional[StorageSettings] = None) -> FastAPI:
+    """
+    Build the app. The order store is opened here (STORAGE_* environment variables when no settings are given, see
+    storage.py), so importing the module doesn't read or create a journal.
+    To start the server, run this command in the terminal: uvicorn main:app --reload   (or uvicorn main:create_app --factory)
+    """
+    # reads happen inside order_storage.reading(user_id): it applies the changes other workers made and holds that user's
+    # lock, so a read never sees a change half done (see concurrency.py). Writes go through order_storage.execute().
+    order_storage = open_store("orders", create_dummy_data_2(), settings, lock_key=lambda args: args["user_id"])
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        yield
+        order_storage.close()
+
+    app = FastAPI(lifespan=lifespan)
+    # the endpoints get the store from app.state.order_storage (get_order_storage), the store itself is order_storage.store
+    app.state.order_storage = order_storage
+    app.include_router(router)
+    # GET responses of the read endpoints marked @cached are served from a cache until a write marked @invalidates
+    # changes their data (see response_cache.py). Hit ratio and memory use are on GET /metrics.
+    setup_response_cache(app, name="main")
+    # the order lists marked @compressed are gzip / zstd encoded for clients that accept it (see response_compression.py)
+    setup_compression(app, name="main")
+    app.include_router(metrics.router)
+    # per-route latency, in-flight requests and byte counts on GET /metrics, PROFILER_ENABLED=true dumps the stacks of slow requests
+    instrument_app(app, name="main")
+    return app
+
+
+def __getattr__(name: str):
+    # `app` is built on first access (uvicorn main:app), so importing the module or using create_app()
+    # doesn't build a second app
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+async def get_order_storage(request: Request) -> DurableStore:
+    return request.app.state.order_storage
+
+
+router = APIRouter()
 
 # This is the home page
-@app.get("/")
+@router.get("/")
 async def root():
     return {"message": "Hello World"}
 
 # end-point parameter example, it used to allow users to pass data in the url
-@app.get("/hello/{name}")
+@router.get("/hello/{name}")
 async def say_hello(name: str):
     return {"message": f"Hello {name}"}
 
-@app.get("/add/{a}/{b}")
+@router.get("/add/{a}/{b}")
 async def add(a:int, b:float):
     return {"result": a + b}
 
 
 # Header parameters example. Header parameters are used to pass additional information in the HTTP headers.
-@app.get("/get_header")
+@router.get("/get_header")
 async def get_header(accept:str = Header(None), content_type: str = Header(None), user_agent=Header(None),
                      host:str = Header(None)) -> dict:
     request_headers = {}
@@ -69,7 +125,8 @@ async def get_header(accept:str = Header(None), content_type: str = Header(None)
 # This is a path parameter example. Path parameters are part of the URL path itself.
 # The Path() function is used to declare metadata and validation for path parameters.
 # Here, it specifies that user_id is required, provides a description, and can be further validated (e.g., gt, lt).
-@app.get ("/get_user/{user_id}")
+@router.get ("/get_user/{user_id}")
+@cached("users")
 async def get_user(user_id: int = Path(..., description="The id of the user you want to search"), gt=0, lt=200) -> dict:
     if user_id == dummy_data["user_id"]:
         return dummy_data
@@ -79,7 +136,7 @@ async def get_user(user_id: int = Path(..., description="The id of the user you
 
 # query parameters example. Query parameters are appended after a ? in the URL, often for filtering, searching, or optional settings.
 # Here, we use Optional to indicate that the parameter is not required and the default value is None.
-@app.get("/search_item_by_quantity/")
+@router.get("/search_item_by_quantity/")
 async def search_item_by_quantity(quantity: Optional[int] = None) -> list[dict] | dict:
     result_dict = []
     for order in dummy_data["orders"]:
@@ -107,49 +164,98 @@ async def search_item_by_quantity(quantity: Optional[int] = None) -> list[dict]
 
 # ------------------------------
 # In-memory dummy data to simulate a database.
-# Note: This data is not persistent and will reset when the server restarts.
+# Note: This data is not persistent and will reset when the server restarts, unless STORAGE_BACKEND=wal or sqlite is set:
+# then every change is journaled to disk, replayed on startup and shared by all the worker processes (see storage.py).
+# the store create_dummy_data_2() builds maps user_id -> that user's orders (an ordered mapping order_id -> order,
+# see order_store.py), so finding, adding, updating and deleting one order doesn't scan the user's orders.
+# ORDERS_LAYOUT=columnar keeps the orders in typed arrays instead (order_columns.py): a fraction of the memory per
+# order, for millions of orders, at the price of slower per-user filters.
+# ------------------------------
+def create_dummy_data_2():
+    # a new store starts with these orders, with STORAGE_BACKEND=wal or sqlite only a new journal does
+    return create_order_store({
+        101: [  # user_id = 101
+            {"order_id": 5001, "item": "SSD", "quantity": 1, "price": 120.5},
+            {"order_id": 5002, "item": "Wireless Mouse", "quantity": 2, "price": 45.0},
+            {"order_id": 5003, "item": "Laptop Stand", "quantity": 1, "price": 30.0},
+            {"order_id": 5004, "item": "Wireless Mouse", "quantity": 1, "price": 50.0}
+        ],
+        102: [  # user_id = 102
+            {"order_id": 6001, "item": "USB-C Hub", "quantity": 1, "price": 25.0}
+        ]
+    })
+
+# ------------------------------
+# Secondary indexes for the filters of GET /users/{user_id}/ (see order_index.py)
+# ------------------------------
+# Each user's orders carry an OrderIndex: orders sorted by price, a quantity -> orders map and a lowercased/trigram
+# item index. The create/update/delete endpoints below keep it in sync, so a filter query doesn't have to
+# scan the user's whole order list.
 # ------------------------------
-dummy_data_2 = {
-    101: [  # user_id = 101
-        {"order_id": 5001, "item": "SSD", "quantity": 1, "price": 120.5},
-        {"order_id": 5002, "item": "Wireless Mouse", "quantity": 2, "price": 45.0},
-        {"order_id": 5003, "item": "Laptop Stand", "quantity": 1, "price": 30.0},
-        {"order_id": 5004, "item": "Wireless Mouse", "quantity": 1, "price": 50.0}
-    ],
-    102: [  # user_id = 102
-        {"order_id": 6001, "item": "USB-C Hub", "quantity": 1, "price": 25.0}
-    ]
-}
 
 # To use multiple query parameters, this is the correct way doing it: http://127.0.0.1:8000/users/101/?param1=value1&param2=value2&param3=value3
 # e.g: http://127.0.0.1:8000/users/101/?min_price=95.0&quantity=1
-@app.get("/users/{user_id}/")
-async def get_user_orders(
+@router.get("/users/{user_id}/")
+@compressed()
+@cached("orders:{user_id}")
+@fast_json
+def get_user_orders(
     user_id: int,
     item: Optional[str] = None,
     min_price: Optional[float] = None,
     max_price: Optional[float] = None,
-    quantity: Optional[int] = None
+    quantity: Optional[int] = None,
+    order_storage: DurableStore = Depends(get_order_storage)
 ):
-    user_orders = dummy_data_2.get(user_id, [])
-    results = []
-
-    for order in user_orders:
-        if item and item.lower() not in order["item"].lower():
-            continue
-        if min_price is not None and order["price"] < min_price:
-            continue
-        if max_price is not None and order["price"] > max_price:
-            continue
-        if quantity is not None and order["quantity"] != quantity:
-            continue
-        results.append(order)
+    # plain def: reading() takes a lock and may replay the journal from disk, that runs in the threadpool,
+    # not on the event loop
+    with order_storage.reading(user_id):
+        if user_id in order_storage.store:
+            # the index applies the same rules as a loop would: item is a case-insensitive substring match,
+            # min_price / max_price are inclusive, quantity must match exactly. Results keep the order the orders were created in.
+            # Without any filter this is simply all of the user's orders.
+            results = order_storage.store[user_id].query(item, min_price, max_price, quantity)
+        else:
+            results = []
 
     return {"user_id": user_id, "filters_applied": {
         "item": item, "min_price": min_price, "max_price": max_price, "quantity": quantity
     }, "results": results}
 
 
+# ------------------------------
+# Aggregates: GET /orders/stats and GET /users/{user_id}/stats
+# ------------------------------
+# Order count, total quantity, spend (price * quantity), price min / max / mean / percentiles, a price histogram and
+# the top items by spend, over all orders or one user's. They are computed on whole columns at once (order_stats.py),
+# with NumPy (in requirements.txt, ORDERS_LAYOUT=columnar needs it): with the columnar layout that is a pass over
+# the store's arrays, without a Python loop per order. Plain def: on a large store the work runs in the
+# threadpool, not on the event loop.
+# e.g. http://127.0.0.1:8000/orders/stats?percentiles=50&percentiles=95&bins=20
+# ------------------------------
+Percentile = Annotated[float, Field(ge=0, le=100)]
+
+@router.get("/orders/stats")
+@cached("orders:stats")
+@fast_json
+def get_order_stats(percentiles: List[Percentile] = Query(list(DEFAULT_PERCENTILES)),
+                    bins: int = Query(10, ge=1, le=1000), top: int = Query(5, ge=0, le=100),
+                    order_storage: DurableStore = Depends(get_order_storage)) -> dict:
+    with order_storage.reading():
+        return order_storage.store.stats(None, percentiles, bins, top)
+
+@router.get("/users/{user_id}/stats")
+@cached("orders:{user_id}")
+@fast_json
+def get_user_order_stats(user_id: int, percentiles: List[Percentile] = Query(list(DEFAULT_PERCENTILES)),
+                         bins: int = Query(10, ge=1, le=1000), top: int = Query(5, ge=0, le=100),
+                         order_storage: DurableStore = Depends(get_order_storage)) -> dict:
+    with order_storage.reading(user_id):
+        if user_id not in order_storage.store:
+            return {"error": "User not found"}
+        return {"user_id": user_id, **order_storage.store.stats(user_id, percentiles, bins, top)}
+
+
 # Request Body and the POST method example.
 # ------------------------------
 # Why we use BaseModel:
@@ -174,27 +280,30 @@ class Order(BaseModel):
 # Method: POST
 # - Accepts user_id as a path parameter (int).
 # - Accepts an Order JSON payload in the request body, parsed & validated by Pydantic.
-# - Adds the order to the user's order list in dummy_data_2.
+# - Adds the order to the user's order list in the order store.
 # - Returns a confirmation message and the order data.
 # ------------------------------
-@app.post("/create_order/{user_id}")
+@router.post("/create_order/{user_id}")
+@invalidates("orders:{user_id}", "orders:stats")
 # so the user_id param is required as the path parameter, the order is actually a json body contains the order details.
-async def create_order(user_id: int, order: Order) -> dict:
-    # Check if the order_id already exists for this user to prevent duplicates
-    if any(existing_order["order_id"] == order.order_id for existing_order in dummy_data_2.get(user_id, [])):
+# The write endpoints are plain def: FastAPI runs them in the threadpool, so the journal's fsync doesn't block the event loop.
+def create_order(user_id: int, order: Order, response: Response,
+                 order_storage: DurableStore = Depends(get_order_storage)) -> dict:
+    # Add the order, creating the user entry if user_id is not found.
+    # An order_id that already exists for this user is rejected, to prevent duplicates (a dict lookup, not a scan).
+    try:
+        created_user = order_storage.execute("add", user_id=user_id, order=order.model_dump())  # .model_dump() converts Pydantic object to a dict
+    except DuplicateOrderError:
         return {"error": "Order ID already exists for this user"}
+    # a new order is version 1, the ETag to send as If-Match when updating or deleting it
+    response.headers["ETag"] = format_etag(1)
 
-    # If user_id is not found, create a new user entry and add the order
-    if user_id not in dummy_data_2:
-        dummy_data_2[user_id] = []
-        dummy_data_2[user_id].append(order.model_dump())  # .model_dump() converts Pydantic object to a dict
+    if created_user:
         return {
             "message": "User not found, created new user and added order",
             "order": order.model_dump()
         }
     else:
-        # If user exists, append the new order to their order list
-        dummy_data_2[user_id].append(order.model_dump())
         return {
             "message": "Order created successfully",
             "order": order.model_dump()
@@ -228,50 +337,124 @@ class UpdateOrder(BaseModel):
 # Uses user_id and order_id as path parameters to locate the target order.
 # Returns a success message with updated data or appropriate error messages.
 # ------------------------------
-@app.put("/update_order/{user_id}/{order_id}")
-async def update_order(user_id: int, order_id: int, updated_order: UpdateOrder) -> dict:
+@router.put("/update_order/{user_id}/{order_id}")
+@invalidates("orders:{user_id}", "orders:stats")
+def update_order(user_id: int, order_id: int, updated_order: UpdateOrder, response: Response,
+                 if_match: Optional[str] = Header(None), order_storage: DurableStore = Depends(get_order_storage)) -> dict:
     # Check if user exists
-    if user_id not in dummy_data_2:
+    order_storage.sync()
+    if user_id not in order_storage.store:
         return {"error": "User not found"}
 
-    # Get the user's order list
-    user_orders = dummy_data_2[user_id]
-    print(user_orders)  # For debugging: shows current orders before updating
-
-    # Search for the order to update within the user's orders
-    for order in user_orders:
-        if order['order_id'] == order_id:
-            # Perform partial updates:
-            # Only update the fields if they are provided in the request body.
-            if updated_order.order_id is not None:
-                order['order_id'] = updated_order.order_id
-            if updated_order.item is not None:
-                order['item'] = updated_order.item
-            if updated_order.quantity is not None:
-                order['quantity'] = updated_order.quantity
-            if updated_order.price is not None:
-                order['price'] = updated_order.price
-
-            # Return confirmation message and updated order data
-            return {
-                "message": f"Order: {order_id} updated successfully for user {user_id}",
-                "updated_order": updated_order.model_dump()
-            }
+    # Look the order up by its order_id and perform partial updates:
+    # only the fields provided in the request body are changed. The order keeps its position, even if its order_id changes.
+    # With an If-Match header the update only happens if the order is still at that version (its "version" / ETag),
+    # otherwise 412: somebody else changed it since the client read it.
+    try:
+        order = order_storage.execute("update", user_id=user_id, order_id=order_id, changes=updated_order.model_dump(),
+                                      if_match=parse_if_match(if_match))
+    except DuplicateOrderError:
+        return {"error": "Order ID already exists for this user"}
+    except VersionConflict as conflict:
+        raise precondition_failed(conflict)
 
     # If order_id is not found under the user
-    return {"error": "Order not found"}
+    if order is None:
+        return {"error": "Order not found"}
+    response.headers["ETag"] = format_etag(order["version"])
+
+    # Return confirmation message and updated order data
+    return {
+        "message": f"Order: {order_id} updated successfully for user {user_id}",
+        "updated_order": updated_order.model_dump()
+    }
 
 
 # DELETE method example for deleting an order from a user.
 # ------------------------------
 # Note that we cannnot directly send the delete request via url like this: http://127.0.0.1:8000/delete_order/101/5002, as this by default send a GET request.
-@app.delete("/delete_order/{user_id}/{order_id}")
-async def delete_order(user_id: int, order_id: int) -> dict:
-    if user_id not in dummy_data_2:
+@router.delete("/delete_order/{user_id}/{order_id}")
+@invalidates("orders:{user_id}", "orders:stats")
+def delete_order(user_id: int, order_id: int, if_match: Optional[str] = Header(None),
+                 order_storage: DurableStore = Depends(get_order_storage)) -> dict:
+    order_storage.sync()
+    if user_id not in order_storage.store:
         return {"error": "User not found"}
-    user_orders = dummy_data_2[user_id]
-    for order in user_orders:
-        if order["order_id"] == order_id:
-            user_orders.remove(order)
-            return {"message": f"{order_id} deleted successfully for user {user_id}, which is {order}"}
-    return {"error": "Order not found"}
\ No newline at end of file
+    try:
+        order = order_storage.execute("remove", user_id=user_id, order_id=order_id, if_match=parse_if_match(if_match))
+    except VersionConflict as conflict:
+        raise precondition_failed(conflict)
+    if order is None:
+        return {"error": "Order not found"}
+    return {"message": f"{order_id} deleted successfully for user {user_id}, which is {order}"}
+
+
+# ------------------------------
+# POST /batch: several order changes, for any users, in one request (see batch.py)
+# ------------------------------
+# e.g. {"operations": [
+#         {"op": "create", "user_id": 101, "order": {"order_id": 5005, "item": "Monitor", "quantity": 1, "price": 199.0}},
+#         {"op": "update", "user_id": 101, "order_id": 5002, "changes": {"quantity": 3}, "if_match": 1},
+#         {"op": "delete", "user_id": 102, "order_id": 6001}]}
+# ------------------------------
+class CreateOrderOperation(BaseModel):
+    op: Literal["create"]
+    user_id: int
+    order: Order
+
+class UpdateOrderOperation(BaseModel):
+    op: Literal["update"]
+    user_id: int
+    order_id: int
+    changes: UpdateOrder
+    if_match: Optional[int] = Field(None, description="only update if the order is still at this version")
+
+class DeleteOrderOperation(BaseModel):
+    op: Literal["delete"]
+    user_id: int
+    order_id: int
+    if_match: Optional[int] = Field(None, description="only delete if the order is still at this version")
+
+OrderOperation = Annotated[Union[CreateOrderOperation, UpdateOrderOperation, DeleteOrderOperation], Field(discriminator="op")]
+
+class OrderBatch(BaseModel):
+    atomic: bool = Field(False, description="all or nothing: the first failed operation undoes the whole batch")
+    operations: List[OrderOperation] = Field(..., max_length=MAX_BATCH_OPERATIONS)
+
+order_batch_adapter = TypeAdapter(OrderBatch)
+
+def _order_command(operation) -> tuple:
+    if operation.op == "create":
+        return "add", {"user_id": operation.user_id, "order": operation.order.model_dump()}
+    if_match = None if operation.if_match is None else [operation.if_match]
+    if operation.op == "update":
+        return "update", {"user_id": operation.user_id, "order_id": operation.order_id,
+                          "changes": operation.changes.model_dump(), "if_match": if_match}
+    return "remove", {"user_id": operation.user_id, "order_id": operation.order_id, "if_match": if_match}
+
+def _order_applied(operation, result) -> OperationResult:
+    if operation.op == "create":
+        # the store answers whether the user was created, the order is the one that was sent, at version 1
+        return OperationResult(status=201, etag=format_etag(1), result={**operation.order.model_dump(), "version": 1})
+    return OperationResult(status=200, etag=format_etag(result["version"]), result=result)
+
+@router.post("/batch", response_model=BatchResult)
+@invalidates("orders:stats")
+@fast_json
+async def batch_orders(request: Request, order_storage: DurableStore = Depends(get_order_storage)) -> BatchResult:
+    """
+    apply an ordered list of create / update / delete operations, see batch.py.
+    The body is an OrderBatch, read from the raw request so it is parsed and validated in one pass.
+    :return: committed (false when an atomic batch was undone) and one result per operation, in order
+    """
+    batch = await parse_batch(request, order_batch_adapter)
+    # the journal's fsync runs in the threadpool, like the single write endpoints
+    results, committed = await run_in_threadpool(order_storage.execute_batch,
+                                                  [_order_command(operation) for operation in batch.operations], batch.atomic)
+    response_cache = request.app.state.response_cache
+    if response_cache is not None:
+        # the cached GET /users/{user_id}/ responses of every user the batch touched
+        for user_id in {operation.user_id for operation in batch.operations}:
+            await response_cache.invalidate(f"orders:{user_id}")
+    return batch_result(batch.operations, results, committed, _order_applied, "User or order not found")
+
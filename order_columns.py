@@ -0,0 +1,304 @@
+"""
+A columnar alternative to order_store.OrderStore, for keeping millions of orders in memory.
+
+In OrderStore every order is a dict of boxed values (plus its OrderIndex entries): several hundred bytes per order.
+ColumnarOrderStore keeps one typed array per field instead (see the array module), so an order is a row number:
+ user_id, order_id, quantity, version  array("q"), 8 bytes each
+ price                                 array("d"), 8 bytes
+ item                                  array("I"), 4 bytes: a code into the list of distinct item names, every name is
+                                       stored once however many orders have it (names are never dropped)
+plus the user_id -> {order_id: row} map that finds a row: about 150 bytes per order all in all, against about 800
+for OrderStore (benchmarks/bench_order_columns.py measures both layouts).
+The aggregates of order_stats.py run straight on these arrays, without building a dict per order.
+
+The trade-offs:
+ - an order is built into a dict every time it is read: GET /users/{user_id}/ filters by scanning the user's rows
+   instead of using an OrderIndex, and returns new dicts
+ - rows are changed in place and a deleted row is filled with the last one (so the arrays stay dense), so readers and
+   writers take the store's lock instead of relying on copy-on-write. The results are the same as OrderStore's,
+   including the order the user's orders are returned in.
+It has the same interface as OrderStore (a mapping user_id -> the user's orders, apply / snapshot / restore for
+storage.py, the same snapshot format), ORDERS_LAYOUT=columnar selects it in main.py, see create_order_store().
+"""
+
+import os
+import threading
+from array import array
+from typing import Dict, Iterable, Iterator, List, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+from concurrency import check_version
+from order_index import Order
+from order_stats import DEFAULT_PERCENTILES, OrderColumns, summarize
+from order_store import DuplicateOrderError, OrderStore
+
+
+class OrderStoreSettings(BaseModel):
+    """
+    Every field can be overridden with an environment variable named ORDERS_<FIELD NAME>, e.g. ORDERS_LAYOUT=columnar.
+    """
+    layout: Literal["dict", "columnar"] = Field(default="dict", description="dict: OrderStore, one dict per order and "
+                                                "per-user indexes; columnar: ColumnarOrderStore, typed arrays")
+
+    @classmethod
+    def from_env(cls, prefix: str = "ORDERS_", **overrides) -> "OrderStoreSettings":
+        values = {}
+        for name in cls.model_fields:
+            env_value = os.getenv(prefix + name.upper())
+            if env_value is not None:
+                values[name] = env_value
+        values.update(overrides)
+        return cls(**values)
+
+
+class ColumnarUserOrders:
+    """
+    One user's orders in a ColumnarOrderStore, the same interface as order_store.UserOrders.
+    A view: it reads the store's columns, nothing is copied.
+    """
+
+    def __init__(self, store: "ColumnarOrderStore", user_id: int):
+        self._store = store
+        self._user_id = user_id
+
+    @property
+    def _rows(self) -> Dict[int, int]:
+        return self._store._rows.get(self._user_id, {})
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __iter__(self) -> Iterator[Order]:
+        return iter(self.to_list())
+
+    def __contains__(self, order_id: int) -> bool:
+        return order_id in self._rows
+
+    def get(self, order_id: int) -> Optional[Order]:
+        with self._store.lock:
+            row = self._rows.get(order_id)
+            return None if row is None else self._store._order(row)
+
+    def to_list(self) -> List[Order]:
+        with self._store.lock:
+            return [self._store._order(row) for row in self._rows.values()]
+
+    def query(self, item: Optional[str] = None, min_price: Optional[float] = None,
+              max_price: Optional[float] = None, quantity: Optional[int] = None) -> List[Order]:
+        """
+        the same filters as UserOrders.query(): item is a case insensitive substring match, the price bounds are inclusive
+        """
+        store = self._store
+        with store.lock:
+            rows: Iterable[int] = self._rows.values()
+            if item:
+                # match the needle against each distinct name once, then compare the rows' item codes
+                needle = item.lower()
+                codes = {code for code, name in enumerate(store._lower_names) if needle in name}
+                rows = [row for row in rows if store._items[row] in codes]
+            if quantity is not None:
+                rows = [row for row in rows if store._quantities[row] == quantity]
+            if min_price is not None:
+                rows = [row for row in rows if store._prices[row] >= min_price]
+            if max_price is not None:
+                rows = [row for row in rows if store._prices[row] <= max_price]
+            return [store._order(row) for row in rows]
+
+
+class ColumnarOrderStore:
+    """
+    user_id -> ColumnarUserOrders, over one set of column arrays for all users.
+    """
+
+    def __init__(self, data: Optional[Dict[int, Iterable[Order]]] = None):
+        self.lock = threading.RLock()
+        self._reset()
+        for user_id, orders in (data or {}).items():
+            self._rows.setdefault(user_id, {})
+            for order in orders:
+                self.add_order(user_id, order)
+
+    def _reset(self) -> None:
+        self._user_ids = array("q")
+        self._order_ids = array("q")
+        self._quantities = array("q")
+        self._prices = array("d")
+        self._items = array("I")
+        self._versions = array("q")
+        self._names: List[str] = []
+        self._lower_names: List[str] = []
+        self._codes: Dict[str, int] = {}
+        self._rows: Dict[int, Dict[int, int]] = {}  # user_id -> {order_id: row}, in the order the orders were created
+
+    # ------------------------------
+    # mapping interface, like OrderStore
+    # ------------------------------
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self._rows))
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._rows
+
+    def __getitem__(self, user_id: int) -> ColumnarUserOrders:
+        if user_id not in self._rows:
+            raise KeyError(user_id)
+        return ColumnarUserOrders(self, user_id)
+
+    def get(self, user_id: int, default=None) -> Optional[ColumnarUserOrders]:
+        return ColumnarUserOrders(self, user_id) if user_id in self._rows else default
+
+    def keys(self) -> List[int]:
+        return list(self._rows)
+
+    def items(self) -> List[tuple]:
+        return [(user_id, ColumnarUserOrders(self, user_id)) for user_id in list(self._rows)]
+
+    # ------------------------------
+    # rows
+    # ------------------------------
+    def _code(self, name: str) -> int:
+        code = self._codes.get(name)
+        if code is None:
+            code = self._codes[name] = len(self._names)
+            self._names.append(name)
+            self._lower_names.append(name.lower())
+        return code
+
+    def _order(self, row: int) -> Order:
+        return {"order_id": self._order_ids[row], "item": self._names[self._items[row]],
+                "quantity": self._quantities[row], "price": self._prices[row], "version": self._versions[row]}
+
+    def _columns(self) -> tuple:
+        return self._user_ids, self._order_ids, self._quantities, self._prices, self._items, self._versions
+
+    def _append(self, user_id: int, order: Order) -> int:
+        row = len(self._order_ids)
+        values = (user_id, order["order_id"], order["quantity"], order["price"], self._code(order["item"]),
+                  order.get("version", 1))
+        try:
+            for column, value in zip(self._columns(), values):
+                column.append(value)
+        except (OverflowError, TypeError):
+            # a value that doesn't fit its column (e.g. a quantity beyond 64 bits): undo the columns already appended
+            for column in self._columns():
+                del column[row:]
+            raise
+        return row
+
+    def _write(self, row: int, order: Order) -> None:
+        values = (order["order_id"], order["quantity"], order["price"], self._code(order["item"]), order["version"])
+        # check every value before changing anything, so a failed update leaves the row as it was
+        array("q", (values[0], values[1], values[4]))
+        array("d", (values[2],))
+        self._order_ids[row], self._quantities[row], self._prices[row], self._items[row], self._versions[row] = values
+
+    def _move(self, source: int, target: int) -> None:
+        for column in self._columns():
+            column[target] = column[source]
+        self._rows[self._user_ids[target]][self._order_ids[target]] = target
+
+    # ------------------------------
+    # changes, the same as OrderStore / UserOrders
+    # ------------------------------
+    def add_order(self, user_id: int, order: Order) -> bool:
+        """
+        add an order, creating the user if needed. Returns True if the user was created.
+        """
+        with self.lock:
+            created = user_id not in self._rows
+            rows = self._rows.setdefault(user_id, {})
+            if order["order_id"] in rows:
+                raise DuplicateOrderError(order["order_id"])
+            rows[order["order_id"]] = self._append(user_id, order)
+            return created
+
+    def update(self, user_id: int, order_id: int, changes: dict, if_match: Optional[List[int]] = None) -> Optional[Order]:
+        with self.lock:
+            rows = self._rows.get(user_id)
+            row = None if rows is None else rows.get(order_id)
+            if row is None:
+                return None
+            order = self._order(row)
+            check_version(order["version"], if_match)
+            new_order_id = changes.get("order_id")
+            if new_order_id is not None and new_order_id != order_id and new_order_id in rows:
+                raise DuplicateOrderError(new_order_id)
+            order = {**order, **{key: value for key, value in changes.items() if value is not None},
+                     "version": order["version"] + 1}
+            self._write(row, order)
+            if order["order_id"] != order_id:
+                # same position among the user's orders under the new order_id
+                self._rows[user_id] = {(order["order_id"] if key == order_id else key): value for key, value in rows.items()}
+            return order
+
+    def remove(self, user_id: int, order_id: int, if_match: Optional[List[int]] = None) -> Optional[Order]:
+        with self.lock:
+            rows = self._rows.get(user_id)
+            row = None if rows is None else rows.get(order_id)
+            if row is None:
+                return None
+            order = self._order(row)
+            check_version(order["version"], if_match)
+            del rows[order_id]
+            last = len(self._order_ids) - 1
+            if row != last:
+                self._move(last, row)
+            for column in self._columns():
+                del column[last]
+            return order
+
+    # a DurableStore (storage.py) makes every change through apply() and replays them from its journal
+    def apply(self, op: str, args: dict):
+        if op == "add":
+            return self.add_order(args["user_id"], args["order"])
+        if args["user_id"] not in self._rows:
+            return None
+        if op == "update":
+            return self.update(args["user_id"], args["order_id"], args["changes"], args.get("if_match"))
+        if op == "remove":
+            return self.remove(args["user_id"], args["order_id"], args.get("if_match"))
+        raise ValueError(f"Unknown order operation {op!r}")
+
+    def snapshot(self) -> list:
+        # the same [user_id, orders] pairs as OrderStore, a journal can be switched between the two layouts
+        with self.lock:
+            return [[user_id, [self._order(row) for row in rows.values()]] for user_id, rows in self._rows.items()]
+
+    def restore(self, state: list) -> None:
+        restored = ColumnarOrderStore({user_id: orders for user_id, orders in state})
+        with self.lock:
+            self.__dict__.update({name: value for name, value in restored.__dict__.items() if name != "lock"})
+
+    # ------------------------------
+    # aggregates, see order_stats.py
+    # ------------------------------
+    def stats(self, user_id: Optional[int] = None, percentiles=DEFAULT_PERCENTILES, bins: int = 10, top: int = 5) -> dict:
+        """
+        summarize() over every order, or over one user's orders
+        """
+        with self.lock:
+            if user_id is None:
+                columns = OrderColumns(self._quantities, self._prices, self._items, self._names, len(self._rows))
+            else:
+                rows = list(self._rows.get(user_id, {}).values())
+                users = 1 if user_id in self._rows else 0
+                columns = OrderColumns(array("q", map(self._quantities.__getitem__, rows)),
+                                       array("d", map(self._prices.__getitem__, rows)),
+                                       array("I", map(self._items.__getitem__, rows)), self._names, users)
+            # under the lock: the arrays must not change (or grow, with NumPy views on them) while they are summarized
+            return summarize(columns, percentiles, bins, top)
+
+
+def create_order_store(data: Optional[Dict[int, Iterable[Order]]] = None,
+                       settings: Optional[OrderStoreSettings] = None):
+    """
+    the order store of the layout in settings (ORDERS_* environment variables when not given)
+    """
+    settings = settings or OrderStoreSettings.from_env()
+    if settings.layout == "columnar":
+        return ColumnarOrderStore(data)
+    return OrderStore(data)
@@ -0,0 +1,226 @@
+"""
+Per-user secondary indexes for the orders in main.py, used by the GET /users/{user_id}/ filter endpoint.
+
+Filtering used to loop over every order of the user, lowercasing every item name on every request. An OrderIndex
+keeps, for one user:
+ - the orders sorted by price (in SortedBuckets) -> min_price / max_price become bisects instead of a scan
+ - a hash index quantity -> order ids -> quantity=N is a dict lookup
+ - the distinct item names, lowercased once when the order is stored, plus a trigram index over them
+   -> item=... substring search only looks at the names that contain all trigrams of the search text
+A query starts from the most selective filter and only checks the remaining filters on those candidates.
+The index is updated incrementally by create_order / update_order / delete_order, never rebuilt.
+"""
+
+import bisect
+import math
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set
+
+Order = dict  # {"order_id": int, "item": str, "quantity": int, "price": float}
+
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _discard(index: dict, key, value) -> bool:
+    """
+    remove value from the set index[key], dropping the key when its set becomes empty. True if the key was dropped.
+    """
+    values = index.get(key)
+    if values is None:
+        return False
+    values.discard(value)
+    if not values:
+        del index[key]
+        return True
+    return False
+
+
+class SortedBuckets:
+    """
+    A sorted list split into buckets of at most 2 * LOAD values. Inserting into / deleting from one big sorted list
+    moves everything after the position (bisect.insort is O(n)), here it only moves the rest of one small bucket,
+    so adding and removing an order costs about the same with 10 or 100k orders.
+    """
+    LOAD = 500
+
+    def __init__(self):
+        self._buckets: List[list] = []
+        self._maxes: list = []   # last (largest) value of every bucket, to bisect for the right bucket
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def add(self, value) -> None:
+        if not self._buckets:
+            self._buckets.append([value])
+            self._maxes.append(value)
+        else:
+            i = min(bisect.bisect_left(self._maxes, value), len(self._maxes) - 1)
+            bucket = self._buckets[i]
+            bisect.insort(bucket, value)
+            self._maxes[i] = bucket[-1]
+            if len(bucket) > 2 * self.LOAD:
+                self._buckets.insert(i + 1, bucket[self.LOAD:])
+                del bucket[self.LOAD:]
+                self._maxes.insert(i, bucket[-1])
+        self._len += 1
+
+    def remove(self, value) -> None:
+        i = bisect.bisect_left(self._maxes, value)
+        bucket = self._buckets[i]
+        del bucket[bisect.bisect_left(bucket, value)]
+        if bucket:
+            self._maxes[i] = bucket[-1]
+        else:
+            del self._buckets[i]
+            del self._maxes[i]
+        self._len -= 1
+
+    def _bounds(self, low, high):
+        """
+        (bucket, start, stop) slices covering the values v with low <= v <= high
+        """
+        first = bisect.bisect_left(self._maxes, low)
+        for i in range(first, len(self._buckets)):
+            bucket = self._buckets[i]
+            start = bisect.bisect_left(bucket, low) if i == first else 0
+            if self._maxes[i] <= high:
+                yield bucket, start, len(bucket)
+            else:
+                yield bucket, start, bisect.bisect_right(bucket, high)
+                return
+
+    def count(self, low, high) -> int:
+        return sum(stop - start for _, start, stop in self._bounds(low, high))
+
+    def irange(self, low, high) -> Iterator:
+        for bucket, start, stop in self._bounds(low, high):
+            yield from bucket[start:stop]
+
+
+class _Entry(NamedTuple):
+    """
+    the values an order was indexed under. reindex() gets the updated order as a new dict (updates are copy-on-write),
+    the old values kept here are what finds and removes the order's old index entries.
+    """
+    seq: int
+    price: float
+    quantity: int
+    item_key: str
+
+
+class OrderIndex:
+    """
+    Indexes of one user's orders. Every order gets a sequence number when it is added, results are returned in
+    that order, i.e. the order the user's orders were created in, same as iterating the user's order list.
+    """
+
+    def __init__(self, orders: Iterable[Order] = ()):
+        self._orders: Dict[int, Order] = {}      # order_id -> order (the same dict object that is stored for the user)
+        self._entries: Dict[int, _Entry] = {}    # order_id -> what the order is indexed under
+        self._next_seq = 0
+        self._by_price = SortedBuckets()         # sorted (price, seq, order_id)
+        self._by_quantity: Dict[int, Set[int]] = {}   # quantity -> order ids
+        self._by_item: Dict[str, Set[int]] = {}       # lowercased item name -> order ids
+        self._by_trigram: Dict[str, Set[str]] = {}    # trigram -> lowercased item names containing it
+        for order in orders:
+            self.add(order)
+
+    def __len__(self) -> int:
+        return len(self._orders)
+
+    def add(self, order: Order, seq: Optional[int] = None) -> int:
+        """
+        index an order, returns its sequence number. `seq` keeps the position of an order that is re-indexed after an update
+        """
+        order_id = order["order_id"]
+        if seq is None:
+            seq = self._next_seq
+            self._next_seq += 1
+        entry = _Entry(seq, order["price"], order["quantity"], order["item"].lower())
+        self._orders[order_id] = order
+        self._entries[order_id] = entry
+        self._by_price.add((entry.price, seq, order_id))
+        self._by_quantity.setdefault(entry.quantity, set()).add(order_id)
+        ids = self._by_item.setdefault(entry.item_key, set())
+        if not ids:
+            # first order with this item name, add the name to the trigram index
+            for trigram in trigrams(entry.item_key):
+                self._by_trigram.setdefault(trigram, set()).add(entry.item_key)
+        ids.add(order_id)
+        return seq
+
+    def get(self, order_id: int) -> Optional[Order]:
+        return self._orders.get(order_id)
+
+    def remove(self, order_id: int) -> Optional[int]:
+        """
+        drop an order from every index, returns its sequence number (None if it wasn't indexed)
+        """
+        entry = self._entries.pop(order_id, None)
+        if entry is None:
+            return None
+        del self._orders[order_id]
+        self._by_price.remove((entry.price, entry.seq, order_id))
+        _discard(self._by_quantity, entry.quantity, order_id)
+        if _discard(self._by_item, entry.item_key, order_id):
+            # that was the last order with this item name
+            for trigram in trigrams(entry.item_key):
+                _discard(self._by_trigram, trigram, entry.item_key)
+        return entry.seq
+
+    def reindex(self, old_order_id: int, order: Order) -> int:
+        """
+        replace the entries of an order with those of its updated version `order`, a new dict (possibly with a new order_id).
+        :param old_order_id: the order_id the order had before the change
+        """
+        return self.add(order, self.remove(old_order_id))
+
+    def _item_ids(self, item: str) -> Set[int]:
+        needle = item.lower()
+        grams = trigrams(needle)
+        if grams:
+            # only names containing every trigram of the needle can contain the needle itself
+            candidate_names = set.intersection(*(self._by_trigram.get(gram, set()) for gram in grams))
+        else:
+            # 1 or 2 characters, nothing to narrow down with: check each distinct name (not each order)
+            candidate_names = self._by_item.keys()
+        ids: Set[int] = set()
+        for name in candidate_names:
+            if needle in name:
+                ids |= self._by_item[name]
+        return ids
+
+    def query(self, item: Optional[str] = None, min_price: Optional[float] = None,
+              max_price: Optional[float] = None, quantity: Optional[int] = None) -> List[Order]:
+        """
+        same filters and same result order as looping over the user's orders:
+        item is a case insensitive substring match, the price bounds are inclusive.
+        """
+        candidates: List[Set[int]] = []
+        if quantity is not None:
+            candidates.append(self._by_quantity.get(quantity, set()))
+        if item:
+            candidates.append(self._item_ids(item))
+
+        price_filtered = min_price is not None or max_price is not None
+        if price_filtered:
+            low = (-math.inf,) if min_price is None else (min_price, -math.inf)
+            high = (math.inf,) if max_price is None else (max_price, math.inf)
+            # only materialise the price range when it is the narrowest filter, else check the prices directly
+            if not candidates or self._by_price.count(low, high) < min(len(ids) for ids in candidates):
+                candidates.append({order_id for _, _, order_id in self._by_price.irange(low, high)})
+                price_filtered = False
+
+        if not candidates:
+            ids = self._entries.keys()
+        else:
+            candidates.sort(key=len)
+            ids = candidates[0].intersection(*candidates[1:])
+        if price_filtered:
+            ids = [order_id for order_id in ids
+                   if (min_price is None or self._entries[order_id].price >= min_price)
+                   and (max_price is None or self._entries[order_id].price <= max_price)]
+        return [self._orders[order_id] for order_id in sorted(ids, key=lambda order_id: self._entries[order_id].seq)]
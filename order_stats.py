@@ -0,0 +1,143 @@
+"""
+Aggregates over orders for the /orders/stats and /users/{user_id}/stats endpoints of main.py.
+
+Both order stores hand their orders over as OrderColumns: one typed array per field (see the array module) and the
+item names as small integer codes into a list of distinct names. The columnar store (order_columns.py) keeps its
+orders like that already and passes its arrays as they are, the dict store (order_store.py) builds them first.
+summarize() then works on whole columns at once:
+ - with NumPy installed the arrays are wrapped without copying (numpy.frombuffer) and every aggregate is one
+   vectorised call: dot() for the spend, percentile(), histogram(), bincount() per item
+ - without it, sums and the spend run through sum() / map() over the arrays, still C loops over unboxed values,
+   percentiles and the histogram come from one sort plus a bisect per bin edge. Only the per-item totals need a
+   Python loop.
+The results are the same either way, percentiles are interpolated linearly between the closest ranks like NumPy does.
+
+NumPy is in requirements.txt, ORDERS_LAYOUT=columnar needs it to serve the stats of a large store (see README.md):
+the per-item loop of the fallback costs about half a microsecond per order, e.g. GET /orders/stats over 200k orders
+of the columnar store takes ~135 ms without NumPy and ~10 ms with it (benchmarks/bench_order_columns.py). Sorting the
+orders by item first and summing per run was measured slower than that loop. The fallback is there for the small
+demo stores, a few thousand orders are fast enough without NumPy.
+"""
+
+import bisect
+import math
+import operator
+from array import array
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+try:
+    import numpy
+except ImportError:  # not installed: the aggregates fall back to the array module and the builtins
+    numpy = None
+
+DEFAULT_PERCENTILES = (50.0, 90.0, 99.0)
+
+
+class OrderColumns(NamedTuple):
+    quantities: array   # "q", one value per order
+    prices: array       # "d"
+    items: array        # "I", index into names
+    names: Sequence[str]
+    users: int          # number of users the orders belong to
+
+
+def empty_columns(names: Sequence[str] = ()) -> OrderColumns:
+    return OrderColumns(array("q"), array("d"), array("I"), names, 0)
+
+
+def _numpy_summary(columns: OrderColumns, percentiles: Sequence[float], bins: int, top: int) -> dict:
+    # views on the arrays, no copy. They must not outlive the call: an array can't grow while a view of it exists
+    quantities = numpy.frombuffer(columns.quantities, dtype=columns.quantities.typecode)
+    prices = numpy.frombuffer(columns.prices, dtype=columns.prices.typecode)
+    items = numpy.frombuffer(columns.items, dtype=columns.items.typecode)
+    spend = prices * quantities
+    counts, edges = numpy.histogram(prices, bins=bins)
+    size = len(columns.names)
+    item_orders = numpy.bincount(items, minlength=size)
+    item_quantities = numpy.bincount(items, weights=quantities, minlength=size)
+    item_spend = numpy.bincount(items, weights=spend, minlength=size)
+    # rank only the items that have orders: a name without any (left by removed orders) mustn't take a place
+    codes = numpy.flatnonzero(item_orders)
+    top_codes = [int(code) for code in codes[numpy.argsort(-item_spend[codes], kind="stable")][:top]]
+    return {
+        "quantity": int(quantities.sum()),
+        "spend": float(spend.sum()),
+        "price": {"min": float(prices.min()), "max": float(prices.max()), "mean": float(prices.mean()),
+                  "percentiles": dict(zip(percentiles, (float(value) for value in numpy.percentile(prices, percentiles))))},
+        "histogram": {"edges": edges.tolist(), "counts": counts.tolist()},
+        "top_items": [(code, int(item_orders[code]), int(item_quantities[code]), float(item_spend[code])) for code in top_codes],
+    }
+
+
+def _percentile(ordered: Sequence[float], percentile: float) -> float:
+    rank = percentile / 100 * (len(ordered) - 1)
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def _histogram(ordered: Sequence[float], bins: int) -> tuple:
+    low, high = ordered[0], ordered[-1]
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    edges = [low + (high - low) * i / bins for i in range(bins)] + [high]
+    # every bin is [edge, next edge), the last one also holds the maximum
+    positions = [bisect.bisect_left(ordered, edge) for edge in edges[:-1]] + [len(ordered)]
+    return [positions[i + 1] - positions[i] for i in range(bins)], edges
+
+
+def _python_summary(columns: OrderColumns, percentiles: Sequence[float], bins: int, top: int) -> dict:
+    quantities, prices = columns.quantities, columns.prices
+    ordered = sorted(prices)
+    counts, edges = _histogram(ordered, bins)
+    item_orders: Dict[int, int] = {}
+    item_quantities: Dict[int, int] = {}
+    item_spend: Dict[int, float] = {}
+    for code, quantity, price in zip(columns.items, quantities, prices):
+        item_orders[code] = item_orders.get(code, 0) + 1
+        item_quantities[code] = item_quantities.get(code, 0) + quantity
+        item_spend[code] = item_spend.get(code, 0.0) + price * quantity
+    top_codes = sorted(item_spend, key=lambda code: (-item_spend[code], code))[:top]
+    return {
+        "quantity": sum(quantities),
+        "spend": math.fsum(map(operator.mul, prices, quantities)),
+        "price": {"min": ordered[0], "max": ordered[-1], "mean": math.fsum(prices) / len(prices),
+                  "percentiles": {percentile: _percentile(ordered, percentile) for percentile in percentiles}},
+        "histogram": {"edges": edges, "counts": counts},
+        "top_items": [(code, item_orders[code], item_quantities[code], item_spend[code]) for code in top_codes],
+    }
+
+
+def summarize(columns: OrderColumns, percentiles: Sequence[float] = DEFAULT_PERCENTILES, bins: int = 10,
+              top: int = 5) -> dict:
+    """
+    order count, total quantity and spend (price * quantity), price min / max / mean / percentiles, a price histogram
+    with `bins` equal width bins and the `top` items by spend.
+    """
+    summary = {"orders": len(columns.prices), "users": columns.users}
+    if not len(columns.prices):
+        return {**summary, "quantity": 0, "spend": 0.0, "price": None, "histogram": None, "top_items": []}
+    aggregate = _numpy_summary if numpy is not None else _python_summary
+    result = aggregate(columns, percentiles, bins, top)
+    result["price"]["percentiles"] = {f"p{percentile:g}": value for percentile, value in result["price"]["percentiles"].items()}
+    result["top_items"] = [{"item": columns.names[code], "orders": orders, "quantity": quantity, "spend": spend}
+                           for code, orders, quantity, spend in result["top_items"]]
+    return {**summary, **result}
+
+
+def columns_from_orders(orders_by_user: Sequence[Sequence[dict]], names: Optional[List[str]] = None) -> OrderColumns:
+    """
+    build OrderColumns from order dicts, one sequence of orders per user
+    """
+    names = [] if names is None else names
+    codes = {name: code for code, name in enumerate(names)}
+    columns = empty_columns(names)
+    for orders in orders_by_user:
+        for order in orders:
+            code = codes.get(order["item"])
+            if code is None:
+                code = codes[order["item"]] = len(names)
+                names.append(order["item"])
+            columns.quantities.append(order["quantity"])
+            columns.prices.append(order["price"])
+            columns.items.append(code)
+    return columns._replace(users=len(orders_by_user))
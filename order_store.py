@@ -0,0 +1,150 @@
+"""
+The in-memory order storage behind the order endpoints of main.py.
+
+dummy_data_2 used to be {user_id: [order, order, ...]}: finding an order meant scanning the user's list, deleting one
+scanned it twice (find + list.remove) and the duplicate check of create_order was another scan.
+Now every user has a UserOrders, an ordered mapping order_id -> order:
+ - get / add / update / delete by order_id are dict operations, O(1) whatever the number of orders
+ - iteration still returns the orders in the order they were created, like the list did
+ - changing an order's order_id keeps its position: orders are stored by an internal sequence number,
+   the order_id -> sequence number map is the only thing that changes
+Each UserOrders also keeps the OrderIndex (order_index.py) used by the filter endpoint up to date.
+
+Every order carries a "version", 1 when it is added and bumped by every update: the ETag of the order, checked
+against If-Match by update_order / delete_order (see concurrency.py). An update stores a new dict instead of changing
+the old one (copy-on-write), so a response that is still being serialised never sees half an update.
+"""
+
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from concurrency import check_version
+from order_index import Order, OrderIndex
+from order_stats import DEFAULT_PERCENTILES, columns_from_orders, summarize
+
+
+class DuplicateOrderError(KeyError):
+    """
+    an order with this order_id already exists for the user
+    """
+
+
+class UserOrders:
+    """
+    One user's orders: ordered by creation, addressable by order_id.
+    """
+
+    def __init__(self, orders: Iterable[Order] = ()):
+        self.index = OrderIndex()
+        self._by_seq: Dict[int, Order] = {}   # sequence number -> order, dicts keep insertion order
+        for order in orders:
+            self.add(order)
+
+    def __len__(self) -> int:
+        return len(self._by_seq)
+
+    def __iter__(self) -> Iterator[Order]:
+        return iter(self._by_seq.values())
+
+    def __contains__(self, order_id: int) -> bool:
+        return self.index.get(order_id) is not None
+
+    def get(self, order_id: int) -> Optional[Order]:
+        return self.index.get(order_id)
+
+    def add(self, order: Order) -> Order:
+        if order["order_id"] in self:
+            raise DuplicateOrderError(order["order_id"])
+        order.setdefault("version", 1)
+        seq = self.index.add(order)
+        self._by_seq[seq] = order
+        return order
+
+    def update(self, order_id: int, changes: dict, if_match: Optional[List[int]] = None) -> Optional[Order]:
+        """
+        apply the non-None values of `changes` to the order, returns the new order. None if there is no such order.
+        :param if_match: only update if the order's version is one of these (VersionConflict otherwise), None skips the check
+        """
+        order = self.index.get(order_id)
+        if order is None:
+            return None
+        check_version(order["version"], if_match)
+        new_order_id = changes.get("order_id")
+        if new_order_id is not None and new_order_id != order_id and new_order_id in self:
+            raise DuplicateOrderError(new_order_id)
+        order = {**order, **{key: value for key, value in changes.items() if value is not None},
+                 "version": order["version"] + 1}
+        # same sequence number, so the order keeps its place in _by_seq
+        self._by_seq[self.index.reindex(order_id, order)] = order
+        return order
+
+    def remove(self, order_id: int, if_match: Optional[List[int]] = None) -> Optional[Order]:
+        order = self.index.get(order_id)
+        if order is None:
+            return None
+        check_version(order["version"], if_match)
+        del self._by_seq[self.index.remove(order_id)]
+        return order
+
+    def to_list(self) -> List[Order]:
+        return list(self._by_seq.values())
+
+    def query(self, item: Optional[str] = None, min_price: Optional[float] = None,
+              max_price: Optional[float] = None, quantity: Optional[int] = None) -> List[Order]:
+        if not item and min_price is None and max_price is None and quantity is None:
+            return self.to_list()
+        return self.index.query(item, min_price, max_price, quantity)
+
+
+class OrderStore(dict):
+    """
+    user_id -> UserOrders. A plain dict, so `user_id in store` / `store[user_id]` / `store.get(user_id)` work as before.
+    """
+
+    def __init__(self, data: Optional[Dict[int, Iterable[Order]]] = None):
+        super().__init__((user_id, UserOrders(orders)) for user_id, orders in (data or {}).items())
+
+    # a DurableStore (storage.py) makes every change through apply() and replays them from its journal
+    def apply(self, op: str, args: dict):
+        if op == "add":
+            return self.add_order(args["user_id"], args["order"])
+        user_orders = self.get(args["user_id"])
+        if user_orders is None:
+            return None
+        if op == "update":
+            return user_orders.update(args["order_id"], args["changes"], args.get("if_match"))
+        if op == "remove":
+            return user_orders.remove(args["order_id"], args.get("if_match"))
+        raise ValueError(f"Unknown order operation {op!r}")
+
+    def snapshot(self) -> list:
+        # [user_id, orders] pairs: JSON object keys would turn the user ids into strings
+        return [[user_id, user_orders.to_list()] for user_id, user_orders in self.items()]
+
+    def restore(self, state: list) -> None:
+        # swap in new UserOrders without emptying the dict first: a reader holding a user's lock keeps reading
+        # the old UserOrders, and `user_id in store` never fails for a user that exists before and after
+        restored = {user_id: UserOrders(orders) for user_id, orders in state}
+        for user_id in [user_id for user_id in self if user_id not in restored]:
+            del self[user_id]
+        super().update(restored)
+
+    def add_order(self, user_id: int, order: Order) -> bool:
+        """
+        add an order, creating the user if needed. Returns True if the user was created.
+        """
+        created = user_id not in self
+        user_orders = self.setdefault(user_id, UserOrders())
+        user_orders.add(order)
+        return created
+
+    def stats(self, user_id: Optional[int] = None, percentiles=DEFAULT_PERCENTILES, bins: int = 10, top: int = 5) -> dict:
+        """
+        summarize() (order_stats.py) over every order, or over one user's orders.
+        The orders are copied into columns first, list() of a dict is atomic, so this needs no lock.
+        """
+        if user_id is None:
+            orders = [user_orders.to_list() for user_orders in list(self.values())]
+        else:
+            user_orders = self.get(user_id)
+            orders = [] if user_orders is None else [user_orders.to_list()]
+        return summarize(columns_from_orders(orders), percentiles, bins, top)
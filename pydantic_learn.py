@@ -1,9 +1,19 @@
+import bisect
+from contextlib import asynccontextmanager
 from enum import IntEnum
-from typing import List, Optional, Any, Coroutine
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
-
-app = FastAPI()
+from typing import Annotated, List, Literal, Optional, Any, Coroutine, Iterable, Iterator, Union
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, TypeAdapter
+from starlette.concurrency import run_in_threadpool
+from fast_json import fast_json
+from response_cache import cached, invalidates, setup_response_cache
+from response_compression import compressed, setup_compression
+from instrumentation import instrument_app
+from storage import DurableStore, StorageSettings, open_store
+from concurrency import VersionConflict, check_version, format_etag, parse_if_match, precondition_failed
+from batch import MAX_BATCH_OPERATIONS, BatchResult, OperationResult, batch_result, parse_batch
+import metrics
 
 class Priority(IntEnum):
     low = 1
@@ -26,6 +36,7 @@ class Todo(TodoBase):
     The To_do model is used to represent a to_do item in the system.
     """
     todo_id: int = Field(..., description="The unique identifier of the todo item")
+    version: int = Field(default=1, description="Bumped by every update, the ETag of the todo item (If-Match on update / delete)")
 
 class TodoUpdate(TodoBase):
     """
@@ -35,78 +46,380 @@ class TodoUpdate(TodoBase):
     todo_description: Optional[str] = Field(None, min_length=5, max_length=200, description="A brief description of the todo item")
     priority: Optional[Priority] = Field(None, description="The priority of the todo item")
 
-# ok so after we defined all models, we can create a list of todos by using the To_do model
-all_todos = [
-    Todo(todo_id=1, todo_name="Learn FastAPI", todo_description="Learn how to build APIs with FastAPI", priority=Priority.high),
-    Todo(todo_id=2, todo_name="Learn Pydantic", todo_description="Learn how to use Pydantic for data validation", priority=Priority.medium),
-    Todo(todo_id=3, todo_name="Build a full-stack App", todo_description="Build a full-stack application using FastAPI and React", priority=Priority.low)
-]
+# ------------------------------
+# TodoStore: an indexed in-memory "table" for the todos
+# ------------------------------
+# Why not a plain list:
+# A list forces every lookup by id to scan the whole collection, delete() scans it twice (find + list.remove)
+# and generating a new id with max(...) is another full scan per insert.
+# This store keeps:
+#  a dict keyed by todo_id -> O(1) get / update / delete.
+#  a monotonic id counter -> O(1) id allocation, ids are never reused even after deletes.
+#  a secondary index per Priority -> GET /todos?priority=high only touches the matching todos.
+#  a sorted list of ids (overall and per priority) -> results always come back ordered by todo_id.
+#  Todo.version, bumped by every update -> the ETag of the todo, checked against If-Match (see concurrency.py).
+# Updates are copy-on-write: the store gets a new Todo, a response that is still being serialised keeps the old one.
+# ------------------------------
+class TodoStore:
+    """
+    In-memory to_do storage with O(1) access by id and a secondary index by priority.
+    """
+
+    def __init__(self, todos: Iterable[Todo] = ()):
+        self._clear()
+        for todo in todos:
+            self.add(todo)
+
+    def _clear(self) -> None:
+        self._todos: dict[int, Todo] = {}
+        self._by_priority: dict[Priority, list[int]] = {priority: [] for priority in Priority}
+        self._ids: list[int] = []
+        self._next_id = 1
+
+    def __len__(self) -> int:
+        return len(self._todos)
+
+    def __iter__(self) -> Iterator[Todo]:
+        return (self._todos[todo_id] for todo_id in self._ids)
+
+    def __contains__(self, todo_id: int) -> bool:
+        return todo_id in self._todos
+
+    def next_id(self) -> int:
+        """
+        allocate a new unique todo_id without scanning the existing todos
+        """
+        todo_id = self._next_id
+        self._next_id += 1
+        return todo_id
+
+    def add(self, todo: Todo) -> Todo:
+        """
+        insert an already built to_do, keeping the id allocator ahead of any explicit id
+        """
+        if todo.todo_id in self._todos:
+            raise KeyError(f"Todo {todo.todo_id} already exists")
+        self._todos[todo.todo_id] = todo
+        self._insert_id(self._ids, todo.todo_id)
+        self._insert_id(self._by_priority[todo.priority], todo.todo_id)
+        self._next_id = max(self._next_id, todo.todo_id + 1)
+        return todo
+
+    def create(self, todo: TodoBase) -> Todo:
+        """
+        build a new to_do from the request body and give it the next id
+        """
+        return self.add(Todo(todo_id=self.next_id(), **todo.model_dump()))
+
+    def get(self, todo_id: int) -> Optional[Todo]:
+        return self._todos.get(todo_id)
+
+    def update(self, todo_id: int, changes: TodoUpdate, if_match: Optional[List[int]] = None) -> Optional[Todo]:
+        """
+        apply a partial update, moving the to_do between priority indexes if its priority changes
+        :param if_match: only update if the to_do's version is one of these (VersionConflict otherwise), None skips the check
+        """
+        todo = self._todos.get(todo_id)
+        if todo is None:
+            return None
+        check_version(todo.version, if_match)
+        update = {"version": todo.version + 1}
+        if changes.todo_name:
+            update["todo_name"] = changes.todo_name
+        if changes.todo_description:
+            update["todo_description"] = changes.todo_description
+        if changes.priority and changes.priority != todo.priority:
+            self._remove_id(self._by_priority[todo.priority], todo_id)
+            self._insert_id(self._by_priority[changes.priority], todo_id)
+            update["priority"] = changes.priority
+        todo = self._todos[todo_id] = todo.model_copy(update=update)
+        return todo
+
+    def delete(self, todo_id: int, if_match: Optional[List[int]] = None) -> Optional[Todo]:
+        todo = self._todos.get(todo_id)
+        if todo is None:
+            return None
+        check_version(todo.version, if_match)
+        del self._todos[todo_id]
+        self._remove_id(self._ids, todo_id)
+        self._remove_id(self._by_priority[todo.priority], todo_id)
+        return todo
+
+    def list_todos(self, priority: Optional[Priority] = None, after_id: Optional[int] = None,
+                   limit: Optional[int] = None) -> List[Todo]:
+        """
+        todos ordered by id, optionally only the ones with the given priority (served from the index).
+        :param after_id: keyset cursor, only todos with a todo_id greater than this are returned (found with bisect, not a scan)
+        :param limit: maximum number of todos to return, None means everything after the cursor
+        """
+        ids = self._ids if priority is None else self._by_priority[priority]
+        start = 0 if after_id is None else bisect.bisect_right(ids, after_id)
+        stop = len(ids) if limit is None else start + limit
+        return [self._todos[todo_id] for todo_id in ids[start:stop]]
+
+    # a DurableStore (storage.py) makes every change through apply() and replays them from its journal,
+    # the args are JSON as they were written to the journal
+    def apply(self, op: str, args: dict) -> Optional[Todo]:
+        if op == "create":
+            return self.create(TodoCreate.model_validate(args["todo"]))
+        if op == "update":
+            return self.update(args["todo_id"], TodoUpdate.model_validate(args["changes"]), args.get("if_match"))
+        if op == "delete":
+            return self.delete(args["todo_id"], args.get("if_match"))
+        raise ValueError(f"Unknown todo operation {op!r}")
+
+    def snapshot(self) -> dict:
+        # next_id is part of the state: ids of deleted todos must not come back after a restart
+        return {"next_id": self._next_id, "todos": [todo.model_dump(mode="json") for todo in self]}
+
+    def restore(self, state: dict) -> None:
+        self._clear()
+        for todo in state["todos"]:
+            self.add(Todo.model_validate(todo))
+        self._next_id = max(self._next_id, state["next_id"])
+
+    # ids are allocated in increasing order, so the common case is a plain append.
+    # bisect is only needed when a to_do moves to another priority index.
+    @staticmethod
+    def _insert_id(ids: list[int], todo_id: int) -> None:
+        if not ids or ids[-1] < todo_id:
+            ids.append(todo_id)
+        else:
+            bisect.insort(ids, todo_id)
+
+    @staticmethod
+    def _remove_id(ids: list[int], todo_id: int) -> None:
+        index = bisect.bisect_left(ids, todo_id)
+        if index < len(ids) and ids[index] == todo_id:
+            del ids[index]
+
+
+# ok so after we defined all models, we can create the store of todos by using the To_do model
+def create_all_todos() -> TodoStore:
+    return TodoStore([
+        Todo(todo_id=1, todo_name="Learn FastAPI", todo_description="Learn how to build APIs with FastAPI", priority=Priority.high),
+        Todo(todo_id=2, todo_name="Learn Pydantic", todo_description="Learn how to use Pydantic for data validation", priority=Priority.medium),
+        Todo(todo_id=3, todo_name="Build a full-stack App", todo_description="Build a full-stack application using FastAPI and React", priority=Priority.low)
+    ])
+
+
+def create_app(settings: Optional[StorageSettings] = None) -> FastAPI:
+    """
+    Build the app. The todo store is opened here (STORAGE_* environment variables when no settings are given, see
+    storage.py), so importing the module doesn't read or create a journal.
+    Run it with:  uvicorn pydantic_learn:app   (or uvicorn pydantic_learn:create_app --factory)
+    """
+    # With STORAGE_BACKEND=wal or sqlite the todos are journaled to disk (the three of create_all_todos() are only the
+    # initial data of a new journal), survive restarts and are shared by every worker process. Reads happen inside
+    # todo_storage.reading(), which picks up the changes of the other workers first, writes go through
+    # todo_storage.execute(). See storage.py.
+    todo_storage = open_store("todos", create_all_todos(), settings)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        yield
+        todo_storage.close()
+
+    app = FastAPI(lifespan=lifespan)
+    # the endpoints get the store from app.state.todo_storage (get_todo_storage), the todos themselves are todo_storage.store
+    app.state.todo_storage = todo_storage
+    app.include_router(router)
+    # the todo read endpoints are @cached, every write to the todos is @invalidates("todos"), see response_cache.py
+    setup_response_cache(app, name="todos")
+    # GET /todos is gzip / zstd encoded for clients that accept it, see response_compression.py
+    setup_compression(app, name="todos")
+    app.include_router(metrics.router)
+    # per-route latency, in-flight requests and byte counts on GET /metrics, PROFILER_ENABLED=true dumps the stacks of slow requests
+    instrument_app(app, name="todos")
+    return app
+
+
+def __getattr__(name: str):
+    # `app` is built on first access (uvicorn pydantic_learn:app), so importing the module or using create_app()
+    # doesn't build a second app
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-@app.get("/")
+
+async def get_todo_storage(request: Request) -> DurableStore:
+    return request.app.state.todo_storage
+
+
+router = APIRouter()
+
+@router.get("/")
 def index() -> dict:
     """
     The index endpoint returns a welcome message.
     """
     return {"message": "Welcome to the Todo API"}
 
-@app.get("/todos")
-def get_todos() -> List[Todo]:
+# ------------------------------
+# Pagination and streaming for GET /todos
+# ------------------------------
+# Keyset (cursor) pagination: the client passes the last todo_id it has seen, e.g. /todos?limit=100&after_id=200
+# and the next page starts right after it. Unlike ?page=N&size=M this never has to skip over the earlier rows.
+# When there are more todos the response carries an X-Next-After-Id header, which is the cursor for the next page.
+# With ?stream=true the todos are written out as NDJSON (one JSON object per line) while being serialised,
+# instead of building one big JSON list in memory first.
+# ------------------------------
+NEXT_CURSOR_HEADER = "X-Next-After-Id"
+
+@router.get("/todos")
+@compressed()
+@cached("todos")
+@fast_json
+def get_todos(response: Response, priority: Optional[Priority] = None, after_id: Optional[int] = None,
+              limit: Optional[int] = Query(None, gt=0, le=1000), stream: bool = False,
+              todo_storage: DurableStore = Depends(get_todo_storage)) -> List[Todo]:
     """
     The get_todos endpoint returns a list of all to_do items.
+    :param priority: optional filter, e.g. /todos?priority=3 only returns the high priority todos (served from the priority index)
+    :param after_id: cursor, only return todos with a todo_id greater than this
+    :param limit: page size, leave it out to get every todo after the cursor
+    :param stream: return the todos as an NDJSON stream instead of a JSON list
     """
-    return all_todos
+    # ask for one extra todo so we know whether another page exists without a second lookup
+    with todo_storage.reading():
+        todos = todo_storage.store.list_todos(priority, after_id, None if limit is None else limit + 1)
+    headers = {}
+    if limit is not None and len(todos) > limit:
+        todos = todos[:limit]
+        headers[NEXT_CURSOR_HEADER] = str(todos[-1].todo_id)
+    if stream:
+        return StreamingResponse((todo.model_dump_json() + "\n" for todo in todos),
+                                 media_type="application/x-ndjson", headers=headers)
+    response.headers.update(headers)
+    return todos
 
-@app.get("/todos/{todo_id}")
-def search_todo(target_todo_id: int) -> Todo | dict:
+@router.get("/todos/{todo_id}")
+@cached("todos")
+@fast_json
+def search_todo(target_todo_id: int, response: Response,
+                todo_storage: DurableStore = Depends(get_todo_storage)) -> Todo | dict:
     """
     search target to_do item by id
     :param target_todo_id: the target to_do item id you want to search for
-    :return: as shown
+    :return: as shown, with the todo's version as the ETag: send it back as If-Match to update / delete only that version
     """
-    for todo in all_todos:
-        if todo.todo_id == target_todo_id:
-            return todo
-    raise HTTPException(status_code=404, detail="Todo not found")
+    with todo_storage.reading():
+        todo = todo_storage.store.get(target_todo_id)
+    if todo is None:
+        raise HTTPException(status_code=404, detail="Todo not found")
+    response.headers["ETag"] = format_etag(todo.version)
+    return todo
 
-@app.post("/todos/create", response_model=Todo | dict)
-async def create_todo(todo: TodoCreate) -> dict[str, str | Todo]:
+@router.post("/todos/create", response_model=Todo | dict)
+@invalidates("todos")
+@fast_json
+def create_todo(todo: TodoCreate, response: Response,
+                todo_storage: DurableStore = Depends(get_todo_storage)) -> dict[str, str | Todo]:
     """
     create a new to_do item
     :return: as shown, should be a dict contains the newly created to_do item
     """
-    new_todo = Todo(
-        todo_id = max(todo.todo_id for todo in all_todos) + 1,
-        todo_name = todo.todo_name,
-        todo_description = todo.todo_description,
-        priority = todo.priority
-    )
-    all_todos.append(new_todo)
+    # the write endpoints are plain def: FastAPI runs them in the threadpool, so the journal's fsync doesn't block the event loop
+    new_todo = todo_storage.execute("create", todo=todo.model_dump(mode="json"))
+    response.headers["ETag"] = format_etag(new_todo.version)
     return {"message": "Todo created successfully", "todo": new_todo}
 
 
-@app.put("/todos/update/{todo_id}", response_model=Todo | dict)
-async def update_todo(target_todo_id: int, updated_todo: TodoUpdate) -> dict[str, Todo] | dict:
+@router.put("/todos/update/{todo_id}", response_model=Todo | dict)
+@invalidates("todos")
+@fast_json
+def update_todo(target_todo_id: int, updated_todo: TodoUpdate, response: Response,
+                if_match: Optional[str] = Header(None),
+                todo_storage: DurableStore = Depends(get_todo_storage)) -> dict[str, Todo] | dict:
     """
     same same just an update operation
+    :param if_match: optional ETag of the version the client read, 412 if the todo has been changed since
     """
-    for todo in all_todos:
-        if todo.todo_id == target_todo_id:
-            if updated_todo.todo_name:
-                todo.todo_name = updated_todo.todo_name
-            if updated_todo.todo_description:
-                todo.todo_description = updated_todo.todo_description
-            if updated_todo.priority:
-                todo.priority = updated_todo.priority
-        return {"message": "Todo updated successfully", "updated_todo": todo}
-    raise HTTPException(status_code=404, detail="Todo not found")
+    try:
+        todo = todo_storage.execute("update", todo_id=target_todo_id, changes=updated_todo.model_dump(mode="json"),
+                                    if_match=parse_if_match(if_match))
+    except VersionConflict as conflict:
+        raise precondition_failed(conflict)
+    if todo is None:
+        raise HTTPException(status_code=404, detail="Todo not found")
+    response.headers["ETag"] = format_etag(todo.version)
+    return {"message": "Todo updated successfully", "updated_todo": todo}
 
-@app.delete("/todos/delete/{todo_id}", response_model = Todo | dict)
-async def delete_todo(target_todo_id: int) -> dict[str, Todo] | dict:
+@router.delete("/todos/delete/{todo_id}", response_model = Todo | dict)
+@invalidates("todos")
+@fast_json
+def delete_todo(target_todo_id: int, if_match: Optional[str] = Header(None),
+                todo_storage: DurableStore = Depends(get_todo_storage)) -> dict[str, Todo] | dict:
     """
     just delete the to_do item by id
+    :param if_match: optional ETag of the version the client read, 412 if the todo has been changed since
+    """
+    try:
+        todo = todo_storage.execute("delete", todo_id=target_todo_id, if_match=parse_if_match(if_match))
+    except VersionConflict as conflict:
+        raise precondition_failed(conflict)
+    if todo is None:
+        raise HTTPException(status_code=404, detail="Todo not found")
+    return {"message": "Todo deleted successfully", "deleted_todo": todo}
+
+
+# ------------------------------
+# POST /batch: several todo changes in one request (see batch.py)
+# ------------------------------
+# e.g. {"atomic": true, "operations": [
+#         {"op": "create", "todo": {"todo_name": "Write tests", "todo_description": "Cover the batch endpoint"}},
+#         {"op": "update", "todo_id": 2, "changes": {"priority": 3}, "if_match": 1},
+#         {"op": "delete", "todo_id": 3}]}
+# ------------------------------
+class CreateTodoOperation(BaseModel):
+    op: Literal["create"]
+    todo: TodoCreate
+
+class UpdateTodoOperation(BaseModel):
+    op: Literal["update"]
+    todo_id: int
+    changes: TodoUpdate
+    if_match: Optional[int] = Field(None, description="only update if the todo is still at this version")
+
+class DeleteTodoOperation(BaseModel):
+    op: Literal["delete"]
+    todo_id: int
+    if_match: Optional[int] = Field(None, description="only delete if the todo is still at this version")
+
+TodoOperation = Annotated[Union[CreateTodoOperation, UpdateTodoOperation, DeleteTodoOperation], Field(discriminator="op")]
+
+class TodoBatch(BaseModel):
+    atomic: bool = Field(False, description="all or nothing: the first failed operation undoes the whole batch")
+    operations: List[TodoOperation] = Field(..., max_length=MAX_BATCH_OPERATIONS)
+
+todo_batch_adapter = TypeAdapter(TodoBatch)
+
+def _todo_command(operation) -> tuple:
+    if operation.op == "create":
+        return "create", {"todo": operation.todo.model_dump(mode="json")}
+    if_match = None if operation.if_match is None else [operation.if_match]
+    if operation.op == "update":
+        return "update", {"todo_id": operation.todo_id, "changes": operation.changes.model_dump(mode="json"), "if_match": if_match}
+    return "delete", {"todo_id": operation.todo_id, "if_match": if_match}
+
+def _todo_applied(operation, todo: Todo) -> OperationResult:
+    status = 201 if operation.op == "create" else 200
+    return OperationResult(status=status, etag=format_etag(todo.version), result=todo)
+
+@router.post("/batch", response_model=BatchResult)
+@invalidates("todos")
+@fast_json
+async def batch_todos(request: Request, todo_storage: DurableStore = Depends(get_todo_storage)) -> BatchResult:
+    """
+    apply an ordered list of create / update / delete operations, see batch.py.
+    The body is a TodoBatch, read from the raw request so it is parsed and validated in one pass.
+    :return: committed (false when an atomic batch was undone) and one result per operation, in order
     """
-    for todo in all_todos:
-        if todo.todo_id == target_todo_id:
-            all_todos.remove(todo)
-            return {"message": "Todo deleted successfully", "deleted_todo": todo}
-    raise HTTPException(status_code=404, detail="Todo not found")
\ No newline at end of file
+    batch = await parse_batch(request, todo_batch_adapter)
+    # the journal's fsync runs in the threadpool, like the single write endpoints
+    results, committed = await run_in_threadpool(todo_storage.execute_batch,
+                                                  [_todo_command(operation) for operation in batch.operations], batch.atomic)
+    return batch_result(batch.operations, results, committed, _todo_applied, "Todo not found")
+
@@ -0,0 +1,498 @@
+"""
+Response cache for the read endpoints of the apps in this repo (main.py, pydantic_learn.py, the /items/ endpoints).
+
+A GET that was answered before is served from the cache: no handler call, no database query, no re-serialisation,
+the stored bytes are sent as they are. Endpoints opt in with decorators, the ResponseCacheMiddleware does the rest:
+
+    @app.get("/users/{user_id}/")
+    @cached("orders:{user_id}")              # cache 200 responses, tagged with the user's orders
+    async def get_user_orders(user_id: int, ...): ...
+
+    @app.post("/create_order/{user_id}")
+    @invalidates("orders:{user_id}")         # a 2xx response drops everything tagged orders:<user_id>
+    async def create_order(user_id: int, order: Order): ...
+
+- The key is the tag, the path and the sorted query parameters, so /todos?limit=5&priority=3 and
+  /todos?priority=3&limit=5 share an entry. Tags are formatted with the path parameters of the request.
+- Invalidation bumps a generation number per tag that is part of every key, old entries are simply never read again.
+  That works the same for a shared backend, where the workers can't enumerate each other's keys.
+  The generation is read before the handler runs, so a response computed while a write happens is stored under
+  the old generation and can't shadow the new data.
+- Every cached response gets a strong ETag and Cache-Control: no-cache, a conditional GET with If-None-Match gets an
+  empty 304, straight from the cache. The ETag is the endpoint's own if it sets one (the version of a todo, see
+  concurrency.py), otherwise a hash of the body.
+- Only complete 200 responses up to max_entry_bytes are stored: streamed responses (?stream=true) and errors pass through.
+
+Backends:
+ memory: MemoryBackend, a bounded LRU (max_entries / max_bytes) with a TTL, per worker process. The default.
+ redis:  SharedBackend over redis-py, shared by every worker and app instance. Needs the redis package,
+         without it the cache falls back to memory (like the async database driver in database.py).
+ fake:   SharedBackend over FakeSharedClient, an in-process stand-in with the same interface as the redis client,
+         to exercise the shared code path (serialisation, shared generations) without a server.
+Hits, misses, 304s, entries and bytes are exported on GET /metrics (response_cache_*), ResponseCache.stats() returns
+the same numbers as a dict.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Literal, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+import anyio
+from fastapi import FastAPI
+from pydantic import BaseModel, Field
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+POLICY_ATTRIBUTE = "__response_cache__"
+
+
+class CacheSettings(BaseModel):
+    """
+    Response cache settings. Every field can be overridden with an environment variable named CACHE_<FIELD NAME>,
+    e.g. CACHE_TTL=5 or CACHE_BACKEND=redis.
+    """
+    backend: Literal["memory", "redis", "fake", "none"] = Field(default="memory", description="where entries are kept, none disables the cache")
+    ttl: float = Field(default=30, gt=0, description="seconds an entry is served before the handler runs again")
+    max_entries: int = Field(default=1024, ge=1, description="memory backend: entries kept, least recently used ones are evicted first")
+    max_bytes: int = Field(default=32 * 1024 * 1024, ge=1, description="memory backend: total size of the kept responses")
+    max_entry_bytes: int = Field(default=1024 * 1024, ge=1, description="bigger responses are not cached")
+    redis_url: str = Field(default="redis://localhost:6379/0", description="redis backend: server to connect to")
+
+    @classmethod
+    def from_env(cls, prefix: str = "CACHE_", **overrides) -> "CacheSettings":
+        values = {}
+        for name in cls.model_fields:
+            env_value = os.getenv(prefix + name.upper())
+            if env_value is not None:
+                values[name] = env_value
+        values.update(overrides)
+        return cls(**values)
+
+
+# ------------------------------
+# Endpoint decorators
+# ------------------------------
+@dataclass(frozen=True)
+class CachePolicy:
+    tags: Tuple[str, ...]
+    invalidate: bool = False
+    ttl: Optional[float] = None
+
+
+def cached(tag: str, ttl: Optional[float] = None) -> Callable:
+    """
+    cache the GET responses of the decorated endpoint under `tag` (formatted with the path parameters).
+    Put it below the @app.get(...) decorator, it only marks the function.
+    """
+    def mark(endpoint):
+        setattr(endpoint, POLICY_ATTRIBUTE, CachePolicy((tag,), False, ttl))
+        return endpoint
+    return mark
+
+
+def invalidates(*tags: str) -> Callable:
+    """
+    drop the cached responses of `tags` whenever the decorated endpoint answers with a 2xx status
+    """
+    def mark(endpoint):
+        setattr(endpoint, POLICY_ATTRIBUTE, CachePolicy(tags, True))
+        return endpoint
+    return mark
+
+
+# ------------------------------
+# Entries and backends
+# ------------------------------
+@dataclass
+class CachedResponse:
+    status: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+    etag: str
+
+    @property
+    def size(self) -> int:
+        # what an entry roughly costs in memory: the body, the headers and a few hundred bytes of object overhead
+        return len(self.body) + sum(len(name) + len(value) for name, value in self.headers) + 256
+
+    def to_bytes(self) -> bytes:
+        meta = json.dumps({"status": self.status, "etag": self.etag,
+                           "headers": [[name.decode("latin-1"), value.decode("latin-1")] for name, value in self.headers]})
+        return meta.encode() + b"\n" + self.body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CachedResponse":
+        meta, body = data.split(b"\n", 1)
+        values = json.loads(meta)
+        return cls(values["status"], [(name.encode("latin-1"), value.encode("latin-1")) for name, value in values["headers"]],
+                   body, values["etag"])
+
+
+class CacheBackend(ABC):
+    """
+    Where the entries and the tag generations live. `blocking` backends do network I/O,
+    the middleware calls them in a worker thread so the event loop isn't held up.
+    """
+    blocking = False
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[CachedResponse]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, entry: CachedResponse, ttl: float, tag: str) -> None:
+        ...
+
+    @abstractmethod
+    def generation(self, tag: str) -> int:
+        ...
+
+    @abstractmethod
+    def bump(self, tag: str) -> None:
+        ...
+
+    def stats(self) -> Dict[str, int]:
+        """
+        entries / bytes / evictions, as far as the backend knows them
+        """
+        return {}
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Bounded LRU with a per-entry expiry time. Entries of a tag are dropped as soon as the tag is bumped,
+    so invalidated responses don't sit in memory until the LRU gets to them.
+    Sync endpoints run in the threadpool, so everything happens under a lock.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[float, str, CachedResponse]]" = OrderedDict()  # key -> (expires, tag, entry)
+        self._by_tag: Dict[str, Set[str]] = {}
+        self._generations: Dict[str, int] = {}
+        self._bytes = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def _drop(self, key: str) -> None:
+        _, tag, entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        keys = self._by_tag.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_tag[tag]
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return item[2]
+
+    def set(self, key: str, entry: CachedResponse, ttl: float, tag: str) -> None:
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + ttl, tag, entry)
+            self._by_tag.setdefault(tag, set()).add(key)
+            self._bytes += entry.size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self._evictions += 1
+
+    def generation(self, tag: str) -> int:
+        return self._generations.get(tag, 0)
+
+    def bump(self, tag: str) -> None:
+        with self._lock:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            for key in list(self._by_tag.get(tag, ())):
+                self._drop(key)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "bytes": self._bytes, "evictions": self._evictions}
+
+
+class FakeSharedClient:
+    """
+    The handful of redis client methods SharedBackend uses, on a dict in this process.
+    Values are stored as bytes, exactly what would travel to a real server.
+    """
+
+    def __init__(self):
+        self._values: Dict[str, Tuple[Optional[float], bytes]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._values.get(name)
+            if item is None or (item[0] is not None and item[0] < time.monotonic()):
+                self._values.pop(name, None)
+                return None
+            return item[1]
+
+    def set(self, name: str, value: bytes, ex: Optional[float] = None) -> None:
+        with self._lock:
+            self._values[name] = (None if ex is None else time.monotonic() + ex, bytes(value))
+
+    def incr(self, name: str) -> int:
+        with self._lock:
+            value = int(self._values.get(name, (None, b"0"))[1]) + 1
+            self._values[name] = (None, str(value).encode())
+            return value
+
+    def dbsize(self) -> int:
+        return len(self._values)
+
+
+class SharedBackend(CacheBackend):
+    """
+    Entries and generations in a key-value server every worker talks to (redis, or FakeSharedClient).
+    Invalidated entries are not deleted, they expire on their own: the server's memory policy bounds the size.
+    """
+    blocking = True
+
+    def __init__(self, client, prefix: str):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        data = self.client.get(f"{self.prefix}:entry:{key}")
+        return CachedResponse.from_bytes(data) if data is not None else None
+
+    def set(self, key: str, entry: CachedResponse, ttl: float, tag: str) -> None:
+        # redis wants whole seconds
+        self.client.set(f"{self.prefix}:entry:{key}", entry.to_bytes(), ex=max(1, round(ttl)))
+
+    def generation(self, tag: str) -> int:
+        value = self.client.get(f"{self.prefix}:generation:{tag}")
+        return int(value) if value is not None else 0
+
+    def bump(self, tag: str) -> None:
+        self.client.incr(f"{self.prefix}:generation:{tag}")
+
+
+def create_backend(settings: CacheSettings, name: str) -> Optional[CacheBackend]:
+    if settings.backend == "none":
+        return None
+    if settings.backend == "fake":
+        return SharedBackend(FakeSharedClient(), f"response-cache:{name}")
+    if settings.backend == "redis":
+        try:
+            import redis
+            return SharedBackend(redis.Redis.from_url(settings.redis_url), f"response-cache:{name}")
+        except ImportError as error:
+            logger.warning("redis not available for the response cache (%s), using the in-process cache", error)
+    return MemoryBackend(settings.max_entries, settings.max_bytes)
+
+
+# ------------------------------
+# Metrics
+# ------------------------------
+CACHE_REQUESTS = REGISTRY.counter(
+    "response_cache_requests_total", "GET requests to cached endpoints, by result (hit, miss, not_modified, uncacheable)",
+    ["cache", "result"])
+CACHE_INVALIDATIONS = REGISTRY.counter("response_cache_invalidations_total", "Tag invalidations", ["cache", "tag"])
+
+_caches: List["ResponseCache"] = []
+
+def _backend_stat(stat: str):
+    def collect():
+        for cache in list(_caches):
+            value = cache.backend.stats().get(stat)
+            if value is not None:
+                yield (cache.name,), value
+    return collect
+
+def _hit_ratio():
+    for cache in list(_caches):
+        yield (cache.name,), cache.stats()["hit_ratio"]
+
+REGISTRY.gauge("response_cache_entries", "Responses currently cached", ["cache"], callback=_backend_stat("entries"))
+REGISTRY.gauge("response_cache_bytes", "Approximate memory used by the cached responses", ["cache"], callback=_backend_stat("bytes"))
+REGISTRY.gauge("response_cache_evictions", "Entries evicted to stay within max_entries / max_bytes", ["cache"], callback=_backend_stat("evictions"))
+REGISTRY.gauge("response_cache_hit_ratio", "Share of cacheable GETs answered from the cache (304s included)", ["cache"], callback=_hit_ratio)
+
+
+# ------------------------------
+# Cache + middleware
+# ------------------------------
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def canonical_query(query_string: bytes) -> str:
+    return urlencode(sorted(parse_qsl(query_string.decode("latin-1"), keep_blank_values=True)))
+
+
+@dataclass
+class ResponseCache:
+    backend: CacheBackend
+    name: str
+    ttl: float = 30
+    max_entry_bytes: int = 1024 * 1024
+    _routes: Optional[list] = field(default=None, repr=False)
+
+    def __post_init__(self):
+        _caches.append(self)
+
+    def _call(self, fn: Callable, *args):
+        if self.backend.blocking:
+            return anyio.to_thread.run_sync(fn, *args)
+        async def direct():
+            return fn(*args)
+        return direct()
+
+    def match(self, scope: Scope) -> Tuple[Optional[CachePolicy], dict]:
+        """
+        the policy of the route that will handle the request, like starlette's router finds it
+        """
+        if self._routes is None:
+            # the routes are all registered by the time the first request comes in
+            self._routes = [(route, getattr(getattr(route, "endpoint", None), POLICY_ATTRIBUTE, None))
+                            for route in scope["app"].router.routes]
+        for route, policy in self._routes:
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                return policy, child_scope.get("path_params", {})
+        return None, {}
+
+    async def key(self, tag: str, scope: Scope) -> str:
+        generation = await self._call(self.backend.generation, tag)
+        return f"{tag}#{generation}:{scope['path']}?{canonical_query(scope.get('query_string', b''))}"
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        return await self._call(self.backend.get, key)
+
+    async def set(self, key: str, entry: CachedResponse, ttl: Optional[float], tag: str) -> None:
+        await self._call(self.backend.set, key, entry, ttl or self.ttl, tag)
+
+    async def invalidate(self, tag: str) -> None:
+        await self._call(self.backend.bump, tag)
+        CACHE_INVALIDATIONS.inc(cache=self.name, tag=tag.split(":", 1)[0])
+
+    def stats(self) -> Dict[str, float]:
+        counts = {result: CACHE_REQUESTS.value(cache=self.name, result=result)
+                  for result in ("hit", "not_modified", "miss", "uncacheable")}
+        served = counts["hit"] + counts["not_modified"]
+        lookups = served + counts["miss"]
+        return {**counts, "hit_ratio": served / lookups if lookups else 0.0, **self.backend.stats()}
+
+
+class ResponseCacheMiddleware:
+    def __init__(self, app: ASGIApp, cache: ResponseCache):
+        self.app = app
+        self.cache = cache
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        policy, path_params = self.cache.match(scope)
+        if policy is None:
+            return await self.app(scope, receive, send)
+        tags = [tag.format(**path_params) for tag in policy.tags]
+        if policy.invalidate:
+            return await self._invalidating(tags, scope, receive, send)
+        if scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+
+        tag = tags[0]
+        key = await self.cache.key(tag, scope)
+        request_headers = Headers(scope=scope)
+        entry = await self.cache.get(key)
+        if entry is not None:
+            return await self._send_entry(entry, request_headers, send, "hit")
+
+        start: Optional[Message] = None
+        passing_through = False
+
+        async def capture(message: Message) -> None:
+            nonlocal start, passing_through
+            if passing_through:
+                return await send(message)
+            if message["type"] == "http.response.start":
+                # hold the start until the body shows whether the response can be cached
+                start = message
+                return
+            headers = Headers(raw=start["headers"])
+            body = message.get("body", b"")
+            if (message.get("more_body", False) or start["status"] != 200 or "set-cookie" in headers
+                    or len(body) > self.cache.max_entry_bytes):
+                passing_through = True
+                CACHE_REQUESTS.inc(cache=self.cache.name, result="uncacheable")
+                await send(start)
+                return await send(message)
+            entry = CachedResponse(start["status"], list(start["headers"]), body, headers.get("etag") or make_etag(body))
+            await self.cache.set(key, entry, policy.ttl, tag)
+            await self._send_entry(entry, request_headers, send, "miss")
+
+        await self.app(scope, receive, capture)
+
+    async def _invalidating(self, tags: List[str], scope: Scope, receive: Receive, send: Send) -> None:
+        async def invalidate_first(message: Message) -> None:
+            # invalidate before the client sees the response, a GET it sends right after must not get the old data
+            if message["type"] == "http.response.start" and 200 <= message["status"] < 300:
+                for tag in tags:
+                    await self.cache.invalidate(tag)
+            await send(message)
+        await self.app(scope, receive, invalidate_first)
+
+    async def _send_entry(self, entry: CachedResponse, request_headers: Headers, send: Send, result: str) -> None:
+        headers = MutableHeaders(raw=list(entry.headers))
+        headers["etag"] = entry.etag
+        headers.setdefault("cache-control", "no-cache")
+        headers["x-cache"] = "HIT" if result == "hit" else "MISS"
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None and etag_matches(if_none_match, entry.etag):
+            if result == "hit":
+                result = "not_modified"
+            del headers["content-length"]
+            del headers["content-type"]
+            CACHE_REQUESTS.inc(cache=self.cache.name, result=result)
+            await send({"type": "http.response.start", "status": 304, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        CACHE_REQUESTS.inc(cache=self.cache.name, result=result)
+        await send({"type": "http.response.start", "status": entry.status, "headers": headers.raw})
+        await send({"type": "http.response.body", "body": entry.body})
+
+
+def setup_response_cache(app: FastAPI, name: str, settings: Optional[CacheSettings] = None) -> Optional[ResponseCache]:
+    """
+    add the cache middleware to `app` (settings from CACHE_* environment variables by default).
+    The cache is also put on app.state.response_cache, None when CACHE_BACKEND=none.
+    """
+    settings = settings or CacheSettings.from_env()
+    backend = create_backend(settings, name)
+    cache = None
+    if backend is not None:
+        cache = ResponseCache(backend, name, settings.ttl, settings.max_entry_bytes)
+        app.add_middleware(ResponseCacheMiddleware, cache=cache)
+    app.state.response_cache = cache
+    return cache
@@ -0,0 +1,273 @@
+"""
+Compressed responses for the big JSON list endpoints of the apps in this repo (GET /todos, /users, /items ...).
+
+JSON lists compress 5-20x, which is most of the egress of these apps. Endpoints opt in with a decorator, the
+CompressionMiddleware does the rest, like the response cache (response_cache.py):
+
+    @app.get("/todos")
+    @compressed()                 # or @compressed(min_size=64 * 1024)
+    def get_todos(...): ...
+
+ - Content negotiation: the encoding is the first one of ENCODINGS the client accepts in Accept-Encoding
+   (q-values honoured, "*" included). zstd needs the optional zstandard package, without it only gzip is offered.
+ - Responses below min_size (COMPRESSION_MIN_SIZE, per endpoint with @compressed(min_size=...)) are sent as they are:
+   under a kilobyte or so the CPU and the gzip framing cost more than the bytes saved.
+ - Streamed responses (?stream=true) are compressed chunk by chunk, each chunk is flushed so the client still gets the
+   rows as they are produced.
+ - A compressed response gets Vary: Accept-Encoding, and its ETag becomes weak (W/"..."): the bytes differ from the
+   uncompressed ones, but If-None-Match (a weak comparison) still matches, so the 304s of the response cache keep
+   working whatever encoding the client got.
+ - Responses that already have a Content-Encoding, aren't a 200, or aren't JSON / text pass through.
+The middleware sits outside the response cache: the cache keeps the uncompressed bytes, and every client gets the
+encoding it asked for. Bytes in and out per encoding are exported on GET /metrics (response_compression_bytes_total).
+
+The codecs (compressor(), decompressor(), negotiate()) are also what the file-upload backend stores compressed
+files with (see file-upload-app/backend/blob_encoding.py).
+"""
+
+import os
+import zlib
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from fastapi import FastAPI
+from pydantic import BaseModel, Field
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from metrics import REGISTRY
+
+try:
+    import zstandard
+except ImportError:  # optional, gzip only without it
+    zstandard = None
+
+POLICY_ATTRIBUTE = "__response_compression__"
+
+# in order of preference
+ENCODINGS: Tuple[str, ...] = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+DEFAULT_LEVELS = {"gzip": 5, "zstd": 3}
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+COMPRESSION_BYTES = REGISTRY.counter(
+    "response_compression_bytes_total", "Response body bytes before (identity) and after compression",
+    ["app", "encoding"])
+
+
+class CompressionSettings(BaseModel):
+    """
+    Every field can be overridden with an environment variable named COMPRESSION_<FIELD NAME>, e.g. COMPRESSION_MIN_SIZE=4096.
+    """
+    enabled: bool = Field(default=True, description="compress the responses of the @compressed endpoints")
+    min_size: int = Field(default=1024, ge=0, description="smaller responses are sent uncompressed")
+    gzip_level: int = Field(default=DEFAULT_LEVELS["gzip"], ge=1, le=9)
+    zstd_level: int = Field(default=DEFAULT_LEVELS["zstd"], ge=1, le=22)
+
+    @classmethod
+    def from_env(cls, prefix: str = "COMPRESSION_", **overrides) -> "CompressionSettings":
+        values = {}
+        for name in cls.model_fields:
+            env_value = os.getenv(prefix + name.upper())
+            if env_value is not None:
+                values[name] = env_value
+        values.update(overrides)
+        return cls(**values)
+
+
+# ------------------------------
+# Codecs
+# ------------------------------
+class Compressor:
+    """
+    streaming compressor with the same interface for every encoding:
+    compress() returns what is ready, sync() also what is buffered (the output so far can be decoded), finish() the rest
+    """
+
+    def __init__(self, encoding: str, level: Optional[int] = None):
+        self.encoding = encoding
+        level = level or DEFAULT_LEVELS[encoding]
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 16 + 15: gzip header and trailer
+            self._sync = zlib.Z_SYNC_FLUSH
+        elif encoding == "zstd" and zstandard is not None:
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self._sync = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            raise ValueError(f"Unsupported encoding {encoding!r}")
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def sync(self) -> bytes:
+        return self._compressor.flush(self._sync)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+def compressor(encoding: str, level: Optional[int] = None) -> Compressor:
+    return Compressor(encoding, level)
+
+
+def decompressor(encoding: str):
+    """
+    an object whose decompress(data) returns the decoded bytes so far
+    """
+    if encoding == "gzip":
+        return zlib.decompressobj(31)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unsupported encoding {encoding!r}")
+
+
+def compress(data: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    codec = compressor(encoding, level)
+    return codec.compress(data) + codec.finish()
+
+
+def negotiate(accept_encoding: Optional[str], offered: Sequence[str] = ENCODINGS) -> Optional[str]:
+    """
+    the first of `offered` the Accept-Encoding header accepts (q > 0, by name or through "*"), None if none is
+    """
+    if not accept_encoding:
+        return None
+    qualities: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+    for encoding in offered:
+        if qualities.get(encoding, qualities.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+# ------------------------------
+# Middleware
+# ------------------------------
+class CompressionPolicy:
+    def __init__(self, min_size: Optional[int]):
+        self.min_size = min_size
+
+
+def compressed(min_size: Optional[int] = None) -> Callable:
+    """
+    compress the endpoint's responses of at least min_size bytes (COMPRESSION_MIN_SIZE when None)
+    """
+    def mark(endpoint):
+        setattr(endpoint, POLICY_ATTRIBUTE, CompressionPolicy(min_size))
+        return endpoint
+    return mark
+
+
+def _compressible(headers: Headers) -> bool:
+    return "content-encoding" not in headers and headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+
+
+def _varied_headers(start: Message) -> MutableHeaders:
+    headers = MutableHeaders(raw=list(start["headers"]))
+    headers.add_vary_header("Accept-Encoding")
+    etag = headers.get("etag")
+    if etag is not None and not etag.startswith("W/"):
+        headers["etag"] = "W/" + etag
+    return headers
+
+
+def _compressed_headers(start: Message, encoding: str) -> MutableHeaders:
+    headers = _varied_headers(start)
+    headers["content-encoding"] = encoding
+    return headers
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, name: str, settings: CompressionSettings):
+        self.app = app
+        self.name = name
+        self.settings = settings
+        self._routes: Optional[list] = None
+
+    def match(self, scope: Scope) -> Optional[CompressionPolicy]:
+        if self._routes is None:
+            # the routes are all registered by the time the first request comes in
+            self._routes = [(route, getattr(getattr(route, "endpoint", None), POLICY_ATTRIBUTE, None))
+                            for route in scope["app"].router.routes]
+        for route, policy in self._routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return policy
+        return None
+
+    def _level(self, encoding: str) -> int:
+        return self.settings.zstd_level if encoding == "zstd" else self.settings.gzip_level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+        policy = self.match(scope)
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding")) if policy is not None else None
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        min_size = self.settings.min_size if policy.min_size is None else policy.min_size
+
+        start: Optional[Message] = None
+        codec: Optional[Compressor] = None
+        passing_through = False
+
+        async def compressing(message: Message) -> None:
+            nonlocal start, codec, passing_through
+            if passing_through:
+                return await send(message)
+            if message["type"] == "http.response.start":
+                # hold the start until the first body chunk shows whether the response is worth compressing
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if codec is None:
+                headers = Headers(raw=start["headers"])
+                if start["status"] != 200 or not _compressible(headers) or (not more_body and len(body) < min_size):
+                    passing_through = True
+                    if start["status"] == 304:
+                        # the 304 stands for the representation the client would get, so it has the same validators
+                        start = {**start, "headers": _varied_headers(start).raw}
+                    await send(start)
+                    return await send(message)
+                codec = compressor(encoding, self._level(encoding))
+                compressed_headers = _compressed_headers(start, encoding)
+                if more_body:
+                    # streamed: the compressed length isn't known up front
+                    del compressed_headers["content-length"]
+                    await send({**start, "headers": compressed_headers.raw})
+                else:
+                    data = codec.compress(body) + codec.finish()
+                    compressed_headers["content-length"] = str(len(data))
+                    self._count(len(body), len(data), encoding)
+                    await send({**start, "headers": compressed_headers.raw})
+                    return await send({"type": "http.response.body", "body": data})
+            data = codec.compress(body) + (codec.sync() if more_body else codec.finish())
+            self._count(len(body), len(data), encoding)
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, compressing)
+
+    def _count(self, identity: int, encoded: int, encoding: str) -> None:
+        COMPRESSION_BYTES.inc(identity, app=self.name, encoding="identity")
+        COMPRESSION_BYTES.inc(encoded, app=self.name, encoding=encoding)
+
+
+def setup_compression(app: FastAPI, name: str, settings: Optional[CompressionSettings] = None) -> None:
+    """
+    add the compression middleware to `app` (settings from COMPRESSION_* environment variables by default).
+    Call it after setup_response_cache(), so the cache keeps the uncompressed responses.
+    """
+    settings = settings or CompressionSettings.from_env()
+    if settings.enabled:
+        app.add_middleware(CompressionMiddleware, name=name, settings=settings)
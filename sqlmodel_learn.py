@@ -1,80 +1,92 @@
-# sqlmodel is a modern ORM library for Python, built on top of SQLAlchemy and Pydantic.
-from sqlmodel import SQLModel, Field, select
-from typing import Optional, List, Any, Coroutine, Sequence
 # asynccontextmanager is used to create an async context manager runs when the fastapi app starts
 from contextlib import asynccontextmanager
+from typing import Optional
 from fastapi import FastAPI
 
-# first, we define the database model class
-class Item(SQLModel, table=True):
-    """
-
-    """
-    id: Optional[int] = Field(default=None, primary_key=True)
-    name: str
-    price: float
-    is_offered: bool = False
-
-from sqlmodel import create_engine, Session
+# first, we define the database model class.
+# The Item model (and its /items/ endpoints) lives in item_service.py, because superbase_learn.py serves the very same API.
+from item_service import Item, prepare_item_schema, router as item_router
+from database import Database, DatabaseSettings
+from admission import Limit, setup_admission
+from response_cache import setup_response_cache
+from response_compression import setup_compression
+from instrumentation import instrument_app
+import metrics
 
 sqlite_file_name = "database.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
-# create the database engine
-engine = create_engine(sqlite_url, echo=True)
 
-def create_db_and_tables():
+def create_app(settings: Optional[DatabaseSettings] = None) -> FastAPI:
     """
-    Create the database and tables if they do not exist.
+    Build the app. Pool size, echo, timeouts etc. come from DB_* environment variables when no settings are given,
+    see DatabaseSettings. Nothing here connects to the database or even creates the engines: that happens in the
+    background once the app has started, see database.Database.
+    Run it with:  uvicorn sqlmodel_learn:create_app --factory   (or uvicorn sqlmodel_learn:app)
     """
-    SQLModel.metadata.create_all(engine)
+    settings = settings or DatabaseSettings.from_env(sqlite_url)
 
+    def prepare(engine):
+        """
+        Create the database and tables if they do not exist, with the indexes and the name search structure for the
+        filters of GET /items/ (FTS5 on SQLite). Skipped when the schema version stored in the database matches.
+        """
+        app.state.item_name_fts = prepare_item_schema(engine)
 
+    # the database engines: the async engine (aiosqlite) is what the /items/ endpoints use, so a query doesn't block
+    # the event loop. Set DB_USE_ASYNC=false (or don't install aiosqlite) to use the sync engine instead, the endpoints
+    # then run their queries in the threadpool.
+    database = Database(settings, name="sqlite", prepare=prepare)
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """
-    This function is called when the FastAPI app starts and stops.
-    It creates the database and tables when the app starts.
-    •	asynccontextmanager lets you use yield to define what happens when the app starts (before yield) and what happens when the app stops (after yield).
-	•	When FastAPI starts the app, it runs the code before yield (in this case, setting up DB/tables).
-	•	The app stays “running” while “paused” at yield.
-	•	When the app is shutting down, FastAPI continues after yield (where you can put cleanup code: closing DB connections, cleaning temp files, etc.).
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        """
+        This function is called when the FastAPI app starts and stops.
+        It creates the database and tables when the app starts.
+        •	asynccontextmanager lets you use yield to define what happens when the app starts (before yield) and what happens when the app stops (after yield).
+        •	When FastAPI starts the app, it runs the code before yield (in this case, setting up DB/tables).
+        •	The app stays “running” while “paused” at yield.
+        •	When the app is shutting down, FastAPI continues after yield (where you can put cleanup code: closing DB connections, cleaning temp files, etc.).
 
-	1.	App starts:
-	•	Runs everything before yield (setup).
-	2.	App is running:
-	•	Paused at yield (serving requests, etc.).
-	3.	App stops:
-	•	Runs code after yield (cleanup).
-    """
-    create_db_and_tables()
-    yield
-    # Here you can add any cleanup code if needed when the app stops, e.g: shutdown, closing connections, etc.
+        1.	App starts:
+        •	Runs everything before yield (setup).
+        2.	App is running:
+        •	Paused at yield (serving requests, etc.).
+        3.	App stops:
+        •	Runs code after yield (cleanup).
+        """
+        # create the tables and open a few pooled connections in the background, so the app is up at once and the
+        # first /items/ requests wait for it instead of paying for connecting themselves
+        database.start()
+        yield
+        # cleanup when the app stops: close every pooled connection
+        await database.dispose()
 
-app = FastAPI(lifespan=lifespan)
+    app = FastAPI(lifespan=lifespan)
 
+    # the /items/ endpoints read the engines from app.state.database, so they use the SQLite database of this app
+    app.state.database = database
+    app.include_router(item_router)
+    # the /items/ endpoints are admitted as many at a time as the pool has connections, the others wait up to
+    # ADMISSION_QUEUE_TIMEOUT seconds instead of pool_timeout, or get a 429 / 503 with Retry-After once the queue is full
+    setup_admission(app, name="sqlite", limits={"db": Limit(concurrency=settings.pool_size + settings.max_overflow)})
+    # GET /items/ responses are cached until an insert through this app invalidates them (CACHE_* settings,
+    # CACHE_BACKEND=redis shares the cache and its invalidations between workers)
+    setup_response_cache(app, name="sqlite")
+    # GET /items/ is gzip / zstd encoded for clients that accept it (COMPRESSION_* settings, see response_compression.py)
+    setup_compression(app, name="sqlite")
+    # per-route latency, in-flight requests, byte counts and DB time per request, PROFILER_ENABLED=true dumps the stacks of slow requests
+    instrument_app(app, name="sqlite")
+    # GET /metrics, includes the connection pool metrics (checkout wait time, connections in use)
+    app.include_router(metrics.router)
+    return app
 
-from fastapi import Depends
-@app.post("/items/", response_model=Item)
-async def create_item(item: Item) -> Item:
-    """
-    This path operation function creates a new item in the database.
-    :param item: The item to be created, should be an instance of the Item model.
-    :return: the created item.
-    """
-    with Session(engine) as session:
-        session.add(item)
-        session.commit()
-        session.refresh(item)
-        return item
 
-@app.get("/items/", response_model=List[Item])
-async def get_items() -> Sequence[Item]:
-    """
-    This path operation function retrieves all items from the database.
-    :return:
-    """
-    with Session(engine) as session:
-        items = session.exec(select(Item)).all()
-        return items
+def __getattr__(name: str):
+    # `app` is built on first access (uvicorn sqlmodel_learn:app), so importing the module or using create_app()
+    # doesn't build a second app
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,640 @@
+"""
+Durable storage for the in-memory stores of this repo: TodoStore (pydantic_learn.py) and OrderStore (order_store.py).
+
+The stores stay what they are, indexed in-memory "tables" that answer every read. What this module adds is a journal
+of every change, so the data survives a restart and several worker processes (uvicorn --workers N) can share it:
+
+ - A change is a command, ("create", {"todo": {...}}) or ("update", {"user_id": 101, "order_id": 5001, ...}).
+   DurableStore.execute() applies it to the store and appends it, numbered, to the journal.
+   Applying a command is deterministic, so replaying the journal on top of the last snapshot rebuilds the same store.
+ - Every snapshot_every changes the whole store is written as a snapshot and the journal before it is dropped,
+   so a restart loads one snapshot and replays at most snapshot_every changes.
+ - Every worker applies the changes the other workers appended before it reads the store (reading()), and a write
+   holds a lock shared by all the processes while it catches up, applies its command and appends it. The ids handed
+   out, the duplicate checks etc. are decided on the latest data, whichever worker runs them. The fsync comes after
+   that lock is released, so the next write doesn't wait for it, and a read only takes a lock when the journal has
+   changes it hasn't applied yet.
+
+Backends (STORAGE_BACKEND):
+ memory: no journal, the data lives and dies with the process. The default, it is what the apps always did.
+ wal:    STORAGE_PATH/<name>/wal.log, an append-only file with one "<crc32> <json>" line per change, fsync'ed before
+         the request returns, and snapshot.json. A torn or corrupt last line (crash during a write) is dropped when
+         the log is read. The cross-process lock is a flock() on STORAGE_PATH/<name>/lock.
+ sqlite: STORAGE_PATH/<name>.sqlite3, the journal and the snapshot as two tables in a SQLite database in WAL mode.
+         A write is one BEGIN IMMEDIATE transaction, SQLite is the lock.
+
+With several workers, use CACHE_BACKEND=redis (or none): the in-process response cache of one worker doesn't see
+the invalidations of the others.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from contextlib import ExitStack, contextmanager, nullcontext
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Hashable, Iterator, List, Literal, Optional, Protocol, Tuple
+
+from pydantic import BaseModel, Field
+
+from concurrency import KeyedLocks, VersionConflict
+from metrics import REGISTRY
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, the wal backend is then only safe with a single worker process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+Record = dict                  # {"seq": 7, "op": "create", "args": {...}}
+Snapshot = Tuple[int, Any]     # (seq of the last change it contains, state)
+
+# what a store's apply() raises to reject a change (a stale if_match, an id that already exists), see execute_batch()
+REJECTIONS = (VersionConflict, KeyError)
+
+
+class StorageSettings(BaseModel):
+    """
+    Every field can be overridden with an environment variable named STORAGE_<FIELD NAME>, e.g. STORAGE_BACKEND=sqlite.
+    """
+    backend: Literal["memory", "wal", "sqlite"] = Field(default="memory", description="where the changes are journaled, memory keeps nothing")
+    path: str = Field(default="data", description="directory of the journal files")
+    snapshot_every: int = Field(default=1000, ge=1, description="changes between two snapshots, i.e. the most a restart replays")
+    fsync: bool = Field(default=True, description="fsync every change before answering, off trades the last changes on power loss for speed")
+
+    @classmethod
+    def from_env(cls, prefix: str = "STORAGE_", **overrides) -> "StorageSettings":
+        values = {}
+        for name in cls.model_fields:
+            env_value = os.getenv(prefix + name.upper())
+            if env_value is not None:
+                values[name] = env_value
+        values.update(overrides)
+        return cls(**values)
+
+
+class Journaled(Protocol):
+    """
+    What a store needs to be kept in a DurableStore.
+    apply() must either make the whole change or raise without changing anything (e.g. a duplicate id), it returns None
+    when there was nothing to change (e.g. an unknown id), such a change isn't journaled.
+    """
+
+    def apply(self, op: str, args: dict) -> Any: ...
+
+    def snapshot(self) -> Any: ...
+
+    def restore(self, state: Any) -> None: ...
+
+
+# ------------------------------
+# Journals
+# ------------------------------
+class Journal(ABC):
+    """
+    read(seq) returns what a store that has applied every change up to `seq` is missing:
+    (None, newer records) or, when it has nothing yet (seq < 0) or those records were compacted away, (snapshot, records after it).
+    append() and compact() are only called inside lock(), right after a read() that brought the caller up to date.
+    lock() excludes the other threads of this process as well as the other processes. read() is also called without
+    it, but never by two threads at once (the DurableStore's lock), changed() by any thread at any time.
+    """
+    durable = True
+
+    @abstractmethod
+    def lock(self) -> ContextManager:
+        ...
+
+    @abstractmethod
+    def read(self, seq: int) -> Tuple[Optional[Snapshot], List[Record]]:
+        ...
+
+    @abstractmethod
+    def append(self, *records: Record) -> None:
+        """
+        add consecutive records, durable together (one fsync / one commit)
+        """
+
+    @abstractmethod
+    def compact(self, seq: int, state: Any) -> None:
+        ...
+
+    def changed(self, seq: int) -> bool:
+        """
+        False only when the journal certainly has nothing after `seq`, without taking a lock: the check a read makes
+        before it bothers to catch up
+        """
+        return True
+
+    def make_durable(self, seq: int) -> None:
+        """
+        called after lock() was released: return once the records up to `seq` are durable
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryJournal(Journal):
+    durable = False
+
+    def lock(self) -> ContextManager:
+        return nullcontext()
+
+    def read(self, seq: int) -> Tuple[Optional[Snapshot], List[Record]]:
+        return None, []
+
+    def append(self, *records: Record) -> None:
+        pass
+
+    def compact(self, seq: int, state: Any) -> None:
+        pass
+
+    def changed(self, seq: int) -> bool:
+        return False
+
+
+def _fsync_dir(path: Path) -> None:
+    # makes a rename in `path` durable, not possible (nor needed) on Windows
+    if os.name == "posix":
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class FileJournal(Journal):
+    """
+    The wal backend: snapshot.json plus wal.log in `directory`.
+
+    Compacting writes a new snapshot.json and swaps in an empty wal.log, both with an atomic rename. The other
+    processes notice the swap (the inode of wal.log changed) and reload from the snapshot. A crash between the two
+    renames leaves records in wal.log that the snapshot already contains, they are skipped by their seq.
+
+    append() only writes, the fsync comes in make_durable(), after the lock is released: while one writer waits for
+    its fsync the next one appends, and a single fsync makes everything appended before it durable (group commit).
+    The other workers can read a change before it is fsync'ed, as the threads of the writer's own process always could.
+    """
+
+    def __init__(self, directory: Path, fsync: bool = True):
+        self.directory = directory
+        self.fsync = fsync
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.wal_path = directory / "wal.log"
+        self.snapshot_path = directory / "snapshot.json"
+        self._lock_file = open(directory / "lock", "a+b")
+        self._thread_lock = threading.Lock()
+        self._fsync_lock = threading.Lock()     # one fsync at a time, and self._wal isn't swapped during one
+        self._wal = None
+        self._wal_inode = None
+        self._offset = 0        # end of the last complete record read from or written to self._wal
+        self._seq = -1          # seq of that record, -1 when nothing was read yet
+        self._durable = -1      # records up to this seq are known to be fsync'ed
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reopen)
+
+    def _reopen(self) -> None:
+        # a forked worker (e.g. gunicorn --preload) shares the parent's open files, and flock() locks belong to the open
+        # file, so parent and child wouldn't exclude each other: the child opens its own
+        self._lock_file = open(self.directory / "lock", "a+b")
+        self._wal = None
+        self._seq = self._durable = -1
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        # flock() doesn't exclude the threads of one process, they share the open file it locks
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _open_wal(self) -> None:
+        with self._fsync_lock:
+            # whatever was appended to the old wal.log is durable: whoever swapped it compacted those records
+            # into an fsync'ed snapshot first
+            self._durable = max(self._durable, self._seq)
+            if self._wal is not None:
+                self._wal.close()
+            self.wal_path.touch()
+            self._wal = open(self.wal_path, "r+b")
+            self._wal_inode = os.fstat(self._wal.fileno()).st_ino
+            self._offset = 0
+
+    def _wal_replaced(self) -> bool:
+        try:
+            return os.stat(self.wal_path).st_ino != self._wal_inode
+        except FileNotFoundError:
+            return True
+
+    def changed(self, seq: int) -> bool:
+        # one stat(): wal.log is still the file we read and ends where we stopped reading
+        if seq < 0 or seq != self._seq or self._wal is None:
+            return True
+        try:
+            stat = os.stat(self.wal_path)
+        except FileNotFoundError:
+            return True
+        return stat.st_ino != self._wal_inode or stat.st_size != self._offset
+
+    def _read_records(self) -> List[Record]:
+        """
+        the complete records after self._offset, stops at a partial or corrupt line: a write in progress or torn by a crash
+        """
+        self._wal.seek(self._offset)
+        records = []
+        for line in self._wal:
+            if not line.endswith(b"\n"):
+                break
+            checksum, _, payload = line[:-1].partition(b" ")
+            try:
+                if int(checksum, 16) != zlib.crc32(payload):
+                    break
+                record = json.loads(payload)
+            except ValueError:
+                break
+            self._offset += len(line)
+            if record["seq"] > self._seq:
+                records.append(record)
+                self._seq = record["seq"]
+        return records
+
+    def read(self, seq: int) -> Tuple[Optional[Snapshot], List[Record]]:
+        if seq >= 0 and seq == self._seq and self._wal is not None and not self._wal_replaced():
+            return None, self._read_records()
+        # first read, or another process compacted: start over from the snapshot.
+        # Readers don't hold the lock, if a compaction replaced the snapshot while we were at it, read both again:
+        # an old snapshot with the new wal.log would miss the changes in between.
+        while True:
+            snapshot, identity = None, self._snapshot_identity()
+            if identity is not None:
+                data = json.loads(self.snapshot_path.read_bytes())
+                snapshot = (data["seq"], data["state"])
+            self._open_wal()
+            if self._snapshot_identity() == identity:
+                break
+        self._seq = snapshot[0] if snapshot else -1
+        return snapshot, self._read_records()
+
+    def _snapshot_identity(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def append(self, *records: Record) -> None:
+        lines = []
+        for record in records:
+            payload = json.dumps(record, separators=(",", ":")).encode()
+            lines.append(b"%08x %s\n" % (zlib.crc32(payload), payload))
+        data = b"".join(lines)
+        # drop whatever a crashed writer left after the last complete record
+        self._wal.seek(self._offset)
+        self._wal.truncate()
+        self._wal.write(data)
+        self._wal.flush()
+        self._offset += len(data)
+        self._seq = records[-1]["seq"]
+
+    def make_durable(self, seq: int) -> None:
+        if not self.fsync:
+            return
+        with self._fsync_lock:
+            # the writers that queued here behind an fsync often find their records already covered by it
+            if self._durable >= seq:
+                return
+            written = self._seq
+            os.fsync(self._wal.fileno())
+            self._durable = written
+
+    def compact(self, seq: int, state: Any) -> None:
+        temp = self.snapshot_path.with_suffix(".tmp")
+        with open(temp, "wb") as file:
+            file.write(json.dumps({"seq": seq, "state": state}, separators=(",", ":")).encode())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, self.snapshot_path)
+        _fsync_dir(self.directory)
+        empty = self.wal_path.with_suffix(".tmp")
+        empty.write_bytes(b"")
+        os.replace(empty, self.wal_path)
+        _fsync_dir(self.directory)
+        self._open_wal()
+        self._seq = seq
+
+    def close(self) -> None:
+        with self._fsync_lock:
+            if self._wal is not None:
+                self._wal.close()
+        self._lock_file.close()
+
+
+class SQLiteJournal(Journal):
+    """
+    The sqlite backend: tables journal(seq, record) and snapshot(seq, state) in one database file.
+    Writes go through one connection, in the BEGIN IMMEDIATE transaction of lock(), reads through a second one: in WAL
+    mode a read doesn't wait for a write transaction, so a reader catching up never queues behind a commit (the fsync).
+    Finding out that there is nothing new is one lookup of the last seq in the primary key index.
+    """
+
+    def __init__(self, path: Path, fsync: bool = True):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.fsync = fsync
+        self._thread_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._connect()
+        self._db.execute("CREATE TABLE IF NOT EXISTS journal (seq INTEGER PRIMARY KEY, record TEXT NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS snapshot "
+                         "(id INTEGER PRIMARY KEY CHECK (id = 1), seq INTEGER NOT NULL, state TEXT NOT NULL)")
+        if hasattr(os, "register_at_fork"):
+            # a SQLite connection must not be used by two processes, a forked worker gets its own
+            os.register_at_fork(after_in_child=self._connect)
+
+    def _connect(self) -> None:
+        # the connections are shared by the threads, self._thread_lock and self._read_lock take turns for them
+        self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"PRAGMA synchronous={'FULL' if self.fsync else 'NORMAL'}")
+        self._reader = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        with self._thread_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def changed(self, seq: int) -> bool:
+        if seq < 0:
+            return True
+        with self._read_lock:
+            (last,) = self._reader.execute(
+                "SELECT max(coalesce((SELECT max(seq) FROM journal), -1), coalesce((SELECT seq FROM snapshot), -1))"
+            ).fetchone()
+        return last > seq
+
+    def read(self, seq: int) -> Tuple[Optional[Snapshot], List[Record]]:
+        with self._read_lock:
+            # one read transaction: a compaction committed between the two queries would drop records from under us
+            self._reader.execute("BEGIN")
+            try:
+                snapshot = None
+                row = self._reader.execute("SELECT seq, state FROM snapshot").fetchone()
+                if row is not None and (seq < 0 or (row[0] > seq and self._reader.execute(
+                        "SELECT 1 FROM journal WHERE seq = ?", (seq + 1,)).fetchone() is None)):
+                    snapshot = (row[0], json.loads(row[1]))
+                    seq = row[0]
+                records = [json.loads(record) for (record,) in
+                           self._reader.execute("SELECT record FROM journal WHERE seq > ? ORDER BY seq", (seq,))]
+            finally:
+                self._reader.execute("COMMIT")
+        return snapshot, records
+
+    def append(self, *records: Record) -> None:
+        self._db.executemany("INSERT INTO journal (seq, record) VALUES (?, ?)",
+                             [(record["seq"], json.dumps(record, separators=(",", ":"))) for record in records])
+
+    def compact(self, seq: int, state: Any) -> None:
+        self._db.execute("INSERT OR REPLACE INTO snapshot (id, seq, state) VALUES (1, ?, ?)",
+                         (seq, json.dumps(state, separators=(",", ":"))))
+        self._db.execute("DELETE FROM journal WHERE seq <= ?", (seq,))
+
+    def close(self) -> None:
+        self._reader.close()
+        self._db.close()
+
+
+def create_journal(settings: StorageSettings, name: str) -> Journal:
+    if settings.backend == "wal":
+        return FileJournal(Path(settings.path) / name, settings.fsync)
+    if settings.backend == "sqlite":
+        return SQLiteJournal(Path(settings.path) / f"{name}.sqlite3", settings.fsync)
+    return MemoryJournal()
+
+
+# ------------------------------
+# Metrics
+# ------------------------------
+STORAGE_CHANGES = REGISTRY.counter(
+    "storage_changes_total", "Changes applied to a durable store, by source (local: written by this process, "
+    "replayed: read from the journal at startup or written by another worker)", ["store", "source"])
+STORAGE_APPEND = REGISTRY.histogram(
+    "storage_append_seconds", "Time to apply a change and make it durable, including waiting for the lock",
+    ["store"], buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5))
+STORAGE_SNAPSHOTS = REGISTRY.counter("storage_snapshots_total", "Snapshots written", ["store"])
+
+
+# ------------------------------
+# DurableStore
+# ------------------------------
+class DurableStore:
+    """
+    A Journaled store and its journal. Read the store inside reading(), make every change through execute().
+
+    lock_key maps the args of a change to the KeyedLocks key it takes (see concurrency.py), e.g. the user_id of an
+    order. A reader holds the lock of what it reads, so it never sees a change half applied.
+    restore() runs under the key None: a store whose readers use other keys must swap in new objects there,
+    not change the ones a reader may be looking at.
+    """
+
+    def __init__(self, name: str, store: Journaled, journal: Journal, snapshot_every: int = 1000,
+                 lock_key: Callable[[dict], Hashable] = lambda args: None):
+        self.name = name
+        self.store = store
+        self.journal = journal
+        self.snapshot_every = snapshot_every
+        self.lock_key = lock_key
+        self.locks = KeyedLocks()
+        self.seq = -1               # last change applied to self.store
+        self._snapshot_seq = -1
+        # held while the store catches up with the journal or a change is applied and appended, not during the fsync
+        self._lock = threading.RLock()
+
+    def open(self) -> "DurableStore":
+        """
+        load the snapshot and replay the journal. A new journal starts with a snapshot of what the store holds now,
+        e.g. the demo data it was created with.
+        """
+        started = time.perf_counter()
+        with self.journal.lock(), self._lock:
+            snapshot, records = self.journal.read(-1)
+            if snapshot is None and not records:
+                if self.journal.durable:
+                    self.journal.compact(0, self.store.snapshot())
+                self.seq = self._snapshot_seq = 0
+            else:
+                self._catch_up(snapshot, records)
+        if self.journal.durable:
+            logger.info("store %s loaded at change %d (%d replayed) in %.1f ms", self.name, self.seq,
+                        self.seq - self._snapshot_seq, (time.perf_counter() - started) * 1000)
+        return self
+
+    def _catch_up(self, snapshot: Optional[Snapshot], records: List[Record]) -> None:
+        if snapshot is not None:
+            with self.locks.hold(None):
+                self.store.restore(snapshot[1])
+            self.seq = self._snapshot_seq = snapshot[0]
+        for record in records:
+            self._apply(record["op"], record["args"])
+            self.seq = record["seq"]
+        if records:
+            STORAGE_CHANGES.inc(len(records), store=self.name, source="replayed")
+
+    def _apply(self, op: str, args: dict) -> Any:
+        with self.locks.hold(self.lock_key(args)):
+            return self.store.apply(op, args)
+
+    def sync(self) -> None:
+        """
+        apply the changes other processes made since the last call. When there are none it is one check of the
+        journal and takes no lock, so a read doesn't queue behind the writers.
+        """
+        if self.journal.changed(self.seq):
+            with self._lock:
+                self._read_journal()
+
+    def _read_journal(self) -> None:
+        if self.journal.changed(self.seq):
+            self._catch_up(*self.journal.read(self.seq))
+
+    def _rebuild(self) -> None:
+        # the store has changes the journal doesn't: rebuild it from what was journaled
+        with self._lock:
+            self.seq = -1
+            self.sync()
+
+    @contextmanager
+    def reading(self, key: Hashable = None) -> Iterator[None]:
+        """
+        catch up with the other processes, then hold the lock of `key` while the store is read
+        """
+        self.sync()
+        with self.locks.hold(key):
+            yield
+
+    def execute(self, op: str, **args) -> Any:
+        """
+        apply a change and journal it, returns what the store's apply() returned.
+        `args` must be JSON serialisable: they are replayed from the journal as they are.
+        """
+        started = time.perf_counter()
+        applied = False
+        try:
+            with self.journal.lock(), self._lock:
+                self._read_journal()
+                result = self._apply(op, args)
+                if result is None:
+                    return None
+                applied = True
+                self.journal.append({"seq": self.seq + 1, "op": op, "args": args})
+                self.seq += 1
+                seq = self.seq
+                if self.journal.durable and self.seq - self._snapshot_seq >= self.snapshot_every:
+                    self.journal.compact(self.seq, self.store.snapshot())
+                    self._snapshot_seq = self.seq
+                    STORAGE_SNAPSHOTS.inc(store=self.name)
+        except BaseException:
+            if applied:
+                self._rebuild()
+            raise
+        # outside the locks: the next writer doesn't wait for this fsync, and may be made durable by it
+        self.journal.make_durable(seq)
+        STORAGE_CHANGES.inc(store=self.name, source="local")
+        STORAGE_APPEND.observe(time.perf_counter() - started, store=self.name)
+        return result
+
+    def execute_batch(self, operations: List[Tuple[str, dict]], atomic: bool = False) -> Tuple[List[Any], bool]:
+        """
+        Apply several changes in one go: one catch up, one acquisition of the locks and one append to the journal
+        (one fsync) for all of them. Returns (results, committed), one result per operation: what the store's apply()
+        returned, or the exception it rejected the change with (one of REJECTIONS: a VersionConflict, a duplicate id).
+        A rejected change doesn't stop the others. Any other exception is a bug: the whole batch is undone before
+        anything is journaled (restored, or rebuilt from the journal) and the exception propagates.
+        atomic: stop at the first operation that is rejected or returns None and undo the ones before it, nothing is
+        journaled and committed is False; results then end with the failed operation. Undoing restores a snapshot of
+        the store taken before the batch, so an atomic batch (any batch with the memory backend) costs a pass over
+        the store.
+        The locks of every key the operations touch are held for the whole batch (and the key None when it can be
+        undone, restore() runs under it): a reader sees either none or all of the batch's changes to what it reads.
+        """
+        # without a durable journal there is nothing to rebuild from, a failed batch is undone by restore()
+        undoable = atomic or not self.journal.durable
+        keys = {self.lock_key(args) for _, args in operations}
+        if undoable:
+            keys.add(None)
+        started = time.perf_counter()
+        results: List[Any] = []
+        changed = False
+        try:
+            with self.journal.lock(), self._lock:
+                self._read_journal()
+                with ExitStack() as held:
+                    # always in the same order, and readers only ever hold one key: no deadlock
+                    for key in sorted(keys, key=repr):
+                        held.enter_context(self.locks.hold(key))
+                    before = self.store.snapshot() if undoable else None
+                    records = []
+                    for op, args in operations:
+                        try:
+                            result = self.store.apply(op, args)
+                        except REJECTIONS as error:
+                            result = error
+                        except Exception:
+                            # a bug, not a rejected change: nothing of the batch is kept, the error propagates
+                            if before is not None and changed:
+                                self.store.restore(before)
+                                changed = False
+                            raise
+                        results.append(result)
+                        if result is None or isinstance(result, Exception):
+                            if atomic:
+                                if changed:
+                                    self.store.restore(before)
+                                return results, False
+                            continue
+                        changed = True
+                        records.append({"seq": self.seq + len(records) + 1, "op": op, "args": args})
+                    if not records:
+                        return results, True
+                    self.journal.append(*records)
+                    self.seq += len(records)
+                    seq = self.seq
+                    if self.journal.durable and self.seq - self._snapshot_seq >= self.snapshot_every:
+                        self.journal.compact(self.seq, self.store.snapshot())
+                        self._snapshot_seq = self.seq
+                        STORAGE_SNAPSHOTS.inc(store=self.name)
+        except BaseException:
+            if changed:
+                self._rebuild()
+            raise
+        self.journal.make_durable(seq)
+        STORAGE_CHANGES.inc(len(records), store=self.name, source="local")
+        STORAGE_APPEND.observe(time.perf_counter() - started, store=self.name)
+        return results, True
+
+    def close(self) -> None:
+        self.journal.close()
+
+
+def open_store(name: str, store: Journaled, settings: Optional[StorageSettings] = None,
+               lock_key: Callable[[dict], Hashable] = lambda args: None) -> DurableStore:
+    """
+    wrap `store` in a DurableStore with the journal selected by the STORAGE_* settings and load it
+    """
+    settings = settings or StorageSettings.from_env()
+    return DurableStore(name, store, create_journal(settings, name), settings.snapshot_every, lock_key).open()
@@ -1,58 +1,80 @@
 connection_uri="put your connection URI here"
 
-from sqlmodel import SQLModel, Field, select
-from typing import Optional, List
+from sqlmodel import SQLModel
+# The Item model and the /items/ endpoints are shared with sqlmodel_learn.py, see item_service.py
+from item_service import Item, prepare_item_schema, router as item_router
+from database import Database, DatabaseSettings, create_engines, forget_schema
+from admission import Limit, setup_admission
+from response_cache import setup_response_cache
+from response_compression import setup_compression
+from instrumentation import instrument_app
+import metrics
 
-class Item(SQLModel, table=True):
+from typing import Optional
+from fastapi import FastAPI
+from contextlib import asynccontextmanager
+
+
+def create_app(settings: Optional[DatabaseSettings] = None) -> FastAPI:
     """
-    Represents an item in the database.
+    Build the app. Pool settings come from DB_* environment variables when no settings are given (see DatabaseSettings).
+    Size the pool against the Supabase connection limit: every uvicorn worker can open up to DB_POOL_SIZE + DB_MAX_OVERFLOW
+    connections per engine.
+    The same connection URI is also used with the asyncpg driver, the /items/ endpoints await their queries instead of
+    blocking the event loop. DB_USE_ASYNC=false (or asyncpg not installed) falls back to the sync engine, run in the threadpool.
+    Building the app doesn't connect to Supabase: the engines are created, the schema checked and the pool warmed up
+    in the background once the app has started, see database.Database.
+    Run it with:  uvicorn superbase_learn:create_app --factory   (or uvicorn superbase_learn:app)
     """
-    id: Optional[int] = Field(default=None, primary_key=True)
-    name: str
-    price: float
-    is_offered: bool = False
+    settings = settings or DatabaseSettings.from_env(connection_uri)
 
-from sqlmodel import create_engine, Session
+    def prepare(engine):
+        # the table, its indexes and the name search structure for the filters of GET /items/ (a pg_trgm index on
+        # Supabase). A start with an up to date schema only reads its stored version, one query instead of one per
+        # table and index.
+        app.state.item_name_fts = prepare_item_schema(engine)
 
-engine = create_engine(connection_uri, echo=True)
+    database = Database(settings, name="supabase", prepare=prepare)
 
-from fastapi import FastAPI
-from contextlib import asynccontextmanager
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        """
+        This function is called when the FastAPI app starts and stops.
+        It creates the database and tables when the app starts.
+        """
+        database.start()
+        yield
+        # close every pooled connection, so Supabase gets its connection slots back right away
+        await database.dispose()
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    app = FastAPI(lifespan=lifespan)
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """
-    This function is called when the FastAPI app starts and stops.
-    It creates the database and tables when the app starts.
-    """
-    create_db_and_tables()
-    yield
-    # Here you can add any cleanup code if needed when the app stops, e.g: shutdown, closing connections, etc.
+    # the /items/ endpoints read the engines from app.state.database, so they use the Supabase database of this app
+    app.state.database = database
+    app.include_router(item_router)
+    # the /items/ endpoints are admitted as many at a time as the pool has connections, the others wait up to
+    # ADMISSION_QUEUE_TIMEOUT seconds instead of pool_timeout, or get a 429 / 503 with Retry-After once the queue is full
+    setup_admission(app, name="supabase", limits={"db": Limit(concurrency=settings.pool_size + settings.max_overflow)})
+    # GET /items/ responses are cached until an insert through this app invalidates them (CACHE_* settings,
+    # CACHE_BACKEND=redis shares the cache and its invalidations between workers)
+    setup_response_cache(app, name="supabase")
+    # GET /items/ is gzip / zstd encoded for clients that accept it (COMPRESSION_* settings, see response_compression.py)
+    setup_compression(app, name="supabase")
+    # per-route latency, in-flight requests, byte counts and DB time per request, PROFILER_ENABLED=true dumps the stacks of slow requests
+    instrument_app(app, name="supabase")
+    app.include_router(metrics.router)
+    return app
 
-app = FastAPI(lifespan=lifespan)
 
-@app.post("/items/", response_model=Item)
-async def create_item(item: Item) -> Item:
-    """
-    Create a new item in the database.
-    """
-    with Session(engine) as session:
-        session.add(item)
-        session.commit()
-        session.refresh(item)
-    return item
+def __getattr__(name: str):
+    # `app` is built on first access (uvicorn superbase_learn:app), so importing the module or using create_app()
+    # doesn't build a second app
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-@app.get("/items/", response_model=List[Item])
-async def get_items() -> List[Item]:
-    """
-    Retrieve all items from the database.
-    """
-    with Session(engine) as session:
-        items = session.exec(select(Item)).all()
-    return items
 
 def drop_table():
     """
@@ -62,11 +84,14 @@ def drop_table():
         # For PostgreSQL/Supabase:
         connection.execute("DROP TABLE IF EXISTS item CASCADE;")
     """
+    engine, _ = create_engines(DatabaseSettings.from_env(connection_uri, use_async=False), name="supabase")
     SQLModel.metadata.drop_all(engine, tables=[Item.__table__])
+    # and its stored schema version, or the next start would take the table for still being there
+    forget_schema(engine, "item")
 
 
 # Use the if __name__ == "__main__": block so it only runs when you run the script directly (not when uvicorn imports it):
 # if you run uvicorn superbase_learning:app --reload, the drop_table() line won’t run. To drop the table, explicit run `python superbase_learning.py` in your terminal.
 if __name__ == "__main__":
     # This will ONLY run if you do: python superbase_learning.py
-    drop_table()
\ No newline at end of file
+    drop_table()